@@ -1,5 +1,9 @@
 from os import getenv
-from typing import Union, Dict
+import hashlib
+import json
+from pathlib import Path
+from typing import Union, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 from unicodedata import decimal
 import requests
 from rest_framework import status as drf_status
@@ -14,8 +18,16 @@ console = Console()
 
 from . import diagnostics
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
 CRUNCH_URL_KEY = "CRUNCH_URL"
 CRUNCH_TOKEN_KEY = "CRUNCH_TOKEN"
+CRUNCH_CACHE_DIR_KEY = "CRUNCH_CACHE_DIR"
 
 class CrunchAPIException(Exception):
     """ Raised when there is an error getting information from the API of a crunch site. """
@@ -26,7 +38,7 @@ class Connection():
     """
     An object to manage calls to the REST API of a crunch hosted site.
     """
-    def __init__(self, base_url:str = None, token:str = None, verbose:bool = False):
+    def __init__(self, base_url:str = None, token:str = None, verbose:bool = False, cache_dir:Union[Path,str,None] = None):
         """
         An object to manage calls to the REST API of a crunch hosted site.
 
@@ -35,6 +47,11 @@ class Connection():
                 If not provided then it attempts to use the 'CRUNCH_URL' environment variable.
             token (str, optional): An access token for a user on the crunch hosted site. 
                 If not provided then it attempts to use the 'CRUNCH_TOKEN' environment variable.
+            verbose (bool, optional): Whether or not to print details of the requests. Defaults to False.
+            cache_dir (Path, optional): A directory to cache GET responses in. 
+                Cached responses are revalidated with the site and are reused if they have not been modified.
+                If not provided then it attempts to use the 'CRUNCH_CACHE_DIR' environment variable 
+                and if that is not set then responses are not cached.
 
         Raises:
             CrunchAPIException: If the `base_url` is not provided and it is not available using the 'CRUNCH_URL' environment variable.
@@ -50,6 +67,9 @@ class Connection():
 
         self.verbose = verbose
 
+        cache_dir = cache_dir or getenv(CRUNCH_CACHE_DIR_KEY, None)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+
     def get_headers(self) -> dict:
         """
         Creates the headers needed to API calls to the REST API on a crunch hosted site.
@@ -88,6 +108,20 @@ class Connection():
             console.print(result.json())
         return result
 
+    def post_json(self, relative_url:str, data) -> requests.Response:
+        """ Posts data encoded as JSON to the API (e.g. for lists which cannot be sent as form data). """
+        url = self.absolute_url(relative_url)
+        if self.verbose:
+            console.print(f"Posting JSON to {url}")
+
+        result = requests.post(url, headers=self.get_headers(), json=data)
+        if self.verbose:
+            console.print(f"Response {result.status_code}: {result.reason}")
+
+        if result.status_code >= 400:
+            console.print(f"Failed posting to {url}")
+        return result
+
     def add_project(self, project:str, description:str="", details:str="") -> requests.Response:
         """
         Creates a new project on a hosted django-crunch site.
@@ -439,10 +473,149 @@ class Connection():
 
         return result
 
+    def index_files(self, dataset:str, files:List[Dict]) -> requests.Response:
+        """
+        Adds files which have been uploaded to storage to the index of files for a dataset.
+
+        Args:
+            dataset (str): The slug of the dataset.
+            files (List[Dict]): A dictionary for each file with the 'path' relative to the base file path of the dataset
+                and optionally the 'size', 'md5' and 'last_modified' time.
+
+        Raises:
+            CrunchAPIException: If there was an error posting the files to the API.
+
+        Returns:
+            requests.Response: The resulting response from the request to the API.
+        """
+        result = self.post_json(f"api/datasets/{dataset}/files/", files)
+        if result.status_code >= 400:
+            raise CrunchAPIException(f"Failed indexing files.\n{result.status_code}: {result.reason}")
+
+        return result
+
+    def cache_paths(self, url:str) -> Tuple[Path, Path]:
+        """ Returns the paths to the metadata and the body of the cached response for a URL. """
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return self.cache_dir/f"{key}.json", self.cache_dir/f"{key}.body"
+
+    def cached_response(self, url:str) -> Optional[Tuple[Dict, bytes]]:
+        """ Returns the metadata and the body of the cached response for a URL or None if it has not been cached. """
+        metadata_path, body_path = self.cache_paths(url)
+        try:
+            metadata = json.loads(metadata_path.read_text())
+            body = body_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+
+        if metadata.get("url") != url:
+            return None
+        return metadata, body
+
+    def cache_response(self, url:str, response:requests.Response):
+        """ Saves a response in the cache if it has an ETag or a Last-Modified header so that it can be revalidated later. """
+        headers = getattr(response, "headers", None) or {}
+        if not headers.get("ETag") and not headers.get("Last-Modified"):
+            return
+
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        metadata_path, body_path = self.cache_paths(url)
+        metadata = dict(
+            url=url,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            content_type=headers.get("Content-Type"),
+        )
+        # Remove the old metadata before writing the body so that it never refers to a partially written body
+        metadata_path.unlink(missing_ok=True)
+        body_path.write_bytes(response.content)
+        metadata_path.write_text(json.dumps(metadata))
+
     def get_request(self, relative_url:str):
         url = self.absolute_url(relative_url)
-        return requests.get(url, headers=self.get_headers())
+        headers = self.get_headers()
+
+        cached = self.cached_response(url) if self.cache_dir else None
+        if cached:
+            metadata, body = cached
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        # Ask for the more compact MessagePack format if it can be decoded here (compression is negotiated by requests)
+        if msgpack is not None:
+            headers.setdefault("Accept", f"{MSGPACK_MEDIA_TYPE}, application/json;q=0.9")
+
+        response = requests.get(url, headers=headers)
+
+        if cached and response.status_code == drf_status.HTTP_304_NOT_MODIFIED:
+            if self.verbose:
+                console.print(f"Using cached response for {url}")
+            cached_response = requests.Response()
+            cached_response.status_code = drf_status.HTTP_200_OK
+            cached_response.reason = "OK"
+            cached_response.url = url
+            cached_response._content = body
+            if metadata.get("content_type"):
+                cached_response.headers["Content-Type"] = metadata["content_type"]
+            if metadata.get("etag"):
+                cached_response.headers["ETag"] = metadata["etag"]
+            return cached_response
+
+        if self.cache_dir and response.status_code == drf_status.HTTP_200_OK:
+            self.cache_response(url, response)
+
+        return response
         
+    def stream_lines(self, relative_url:str) -> Iterator[bytes]:
+        """
+        Requests a streaming response from the API of a crunch hosted site and iterates over its lines.
+
+        The response is not loaded into memory all at once.
+
+        Args:
+            relative_url (str): The URL path relative to the base URL of the endpoint for the project on the crunch hosted site.
+
+        Raises:
+            CrunchAPIException: Raises exception if the response has an error status code.
+
+        Yields:
+            Iterator[bytes]: Each line of the response.
+        """
+        url = self.absolute_url(relative_url)
+        with requests.get(url, headers=self.get_headers(), stream=True) as response:
+            if response.status_code >= 400:
+                raise CrunchAPIException(f"Error getting response from URL '{url}':\n{response.status_code}: {response.reason}")
+            yield from response.iter_lines()
+
+    def export_project(self, project:str) -> Iterator[bytes]:
+        """
+        Iterates over the lines of newline-delimited JSON describing a project with all its datasets, items and attributes.
+
+        Args:
+            project (str): The slug of the project.
+
+        Yields:
+            Iterator[bytes]: A line of JSON for each item in the project (without the newline).
+        """
+        yield from self.stream_lines(f"api/projects/{project}/export/")
+
+    def decode_response(self, response:requests.Response):
+        """
+        Decodes the data in a response from the API of a crunch hosted site according to its content type.
+
+        Args:
+            response (requests.Response): The response from the API in either JSON or MessagePack.
+
+        Returns:
+            The decoded data.
+        """
+        headers = getattr(response, "headers", None) or {}
+        if msgpack is not None and headers.get("Content-Type", "").startswith(MSGPACK_MEDIA_TYPE):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
     def get_json_response( self, relative_url:str ) -> Dict:
         """
         Requests JSON data from the API of a crunch hosted site and returns it as a dictionary.
@@ -457,7 +630,7 @@ class Connection():
             Dict: The JSON data from the API encoded as a dictionary.
         """
         response = self.get_request(relative_url)
-        json_response = response.json()
+        json_response = self.decode_response(response)
         
         if len(json_response.keys()) == 1 and "detail" in json_response:
             raise CrunchAPIException(
@@ -466,3 +639,48 @@ class Connection():
             )
 
         return json_response
+
+    def relative_url(self, url:str) -> str:
+        """
+        Converts a URL on the crunch hosted site (e.g. a link to the next page of results) to a URL relative to the base URL.
+
+        Args:
+            url (str): The absolute URL.
+
+        Returns:
+            str: The URL relative to the base URL including any query string.
+        """
+        path = urlsplit(url).path
+        base_path = urlsplit(self.base_url).path.rstrip("/")
+        if base_path and path.startswith(base_path):
+            path = path[len(base_path):]
+        query = urlsplit(url).query
+        return f"{path}?{query}" if query else path
+
+    def iterate_results(self, relative_url:str, page_size:int=None) -> Iterator[Dict]:
+        """
+        Iterates over every result of a paginated collection on the API of a crunch hosted site.
+
+        It follows the link to the next page given in each response until there are no more pages.
+
+        Args:
+            relative_url (str): The URL path of the collection relative to the base URL, e.g. "api/items/".
+            page_size (int, optional): The number of results to request in each page. 
+                If not given then the default page size of the site is used.
+
+        Raises:
+            CrunchAPIException: Raises exception if there is an error getting a JSON response from the API.
+
+        Yields:
+            Iterator[Dict]: The JSON data for each result encoded as a dictionary.
+        """
+        if page_size:
+            separator = "&" if "?" in relative_url else "?"
+            relative_url = f"{relative_url}{separator}page_size={page_size}"
+
+        while relative_url:
+            json_response = self.get_json_response(relative_url)
+            yield from json_response.get("results", [])
+
+            next_url = json_response.get("next")
+            relative_url = self.relative_url(next_url) if next_url else None
@@ -1,10 +1,11 @@
 from pathlib import Path
+from typing import List
 import typer
 from rich.console import Console
 
 console = Console()
 
-from crunch.django.app import storages
+from crunch.django.app import storages, packing, chunking
 from . import connections
 from .diagnostics import get_diagnostics
 from .enums import WorkflowType
@@ -52,6 +53,65 @@ path_arg = typer.Option(None, help="The path to the workflow file.")
 download_arg = typer.Option(True, help="Whether or not to download the data from storage in the setup of a run.")
 upload_arg = typer.Option(True, help="Whether or not to upload the data to storage after a run.")
 cleanup_arg = typer.Option(False, help="Whether or not to delete the local data after a run.")
+include_arg = typer.Option(
+    None, 
+    help="A glob pattern for the paths of files (relative to the dataset) to download. Can be given multiple times. "
+    "If not given then all files are downloaded.",
+)
+exclude_arg = typer.Option(
+    None, 
+    help="A glob pattern for the paths of files or directories (relative to the dataset) not to download. Can be given multiple times.",
+)
+upload_include_arg = typer.Option(
+    None, 
+    help="A glob pattern for the paths of files (relative to the dataset) to upload after the workflow. Can be given multiple times. "
+    "These are added to the patterns for the project.",
+)
+upload_exclude_arg = typer.Option(
+    None, 
+    help="A glob pattern for the paths of files or directories (relative to the dataset) not to upload. Can be given multiple times. "
+    "These are added to the patterns for the project. The '.snakemake' directory is never uploaded.",
+)
+outputs_only_arg = typer.Option(
+    False, 
+    help="Whether to only upload the files which Snakemake has recorded as outputs of the workflow.",
+)
+pack_arg = typer.Option(
+    False, 
+    help="Whether to pack small files into tar archives when uploading so that fewer objects are saved to storage.",
+)
+pack_compression_arg = typer.Option("none", help=f"The compression for packed archives {packing.COMPRESSIONS}.")
+shard_size_arg = typer.Option(
+    packing.DEFAULT_SHARD_SIZE // (1024 * 1024), 
+    help="The size in megabytes of the files to pack into each archive.",
+)
+chunk_arg = typer.Option(
+    False, 
+    help="Whether to split large files into chunks by their content when uploading so that only the changed parts of modified files are uploaded.",
+)
+chunk_file_size_arg = typer.Option(
+    chunking.DEFAULT_CHUNKED_FILE_SIZE // (1024 * 1024), 
+    help="The size in megabytes from which files are split into chunks.",
+)
+deduplicate_arg = typer.Option(
+    False, 
+    help="Whether to upload files as blobs named by their contents which are shared by all datasets so that identical files are only stored once. This cannot be combined with --pack.",
+)
+lazy_arg = typer.Option(
+    False, 
+    help="Whether to only download a manifest of the files in setup and to fetch each file when a Snakemake rule needs it as an input.",
+)
+cache_arg = typer.Option(
+    True, 
+    help="Whether or not to cache responses from the site in the directory so that unchanged resources are not downloaded again.",
+)
+
+
+def get_connection(url:str, token:str, directory:Path, cache:bool) -> connections.Connection:
+    """ Creates a connection which caches responses in the directory if requested. """
+    cache_dir = Path(directory)/".cache" if cache else None
+    return connections.Connection(url, token, cache_dir=cache_dir)
+
 
 @app.command()
 def run(
@@ -66,12 +126,25 @@ def run(
     download:bool = download_arg,
     upload:bool = upload_arg,
     cleanup:bool = cleanup_arg,
+    cache:bool = cache_arg,
+    include:List[str] = include_arg,
+    exclude:List[str] = exclude_arg,
+    lazy:bool = lazy_arg,
+    upload_include:List[str] = upload_include_arg,
+    upload_exclude:List[str] = upload_exclude_arg,
+    outputs_only:bool = outputs_only_arg,
+    pack:bool = pack_arg,
+    pack_compression:str = pack_compression_arg,
+    shard_size:int = shard_size_arg,
+    chunk:bool = chunk_arg,
+    chunk_file_size:int = chunk_file_size_arg,
+    deduplicate:bool = deduplicate_arg,
 ):
     """
     Processes a dataset.
     """
     r = Run(
-        connection=connections.Connection(url, token), 
+        connection=get_connection(url, token, directory, cache), 
         dataset_slug=dataset, 
         working_directory=Path(directory),
         workflow_type=workflow, 
@@ -81,6 +154,18 @@ def run(
         download_from_storage=download,
         upload_to_storage=upload,
         cleanup=cleanup,
+        include=include,
+        exclude=exclude,
+        lazy_download=lazy,
+        upload_include=upload_include,
+        upload_exclude=upload_exclude,
+        upload_outputs_only=outputs_only,
+        pack=pack,
+        pack_compression=pack_compression,
+        pack_shard_size=shard_size * 1024 * 1024,
+        chunk=chunk,
+        chunk_file_size=chunk_file_size * 1024 * 1024,
+        deduplicate=deduplicate,
     )
 
     r()
@@ -102,13 +187,26 @@ def next(
     download:bool = download_arg,
     upload:bool = upload_arg,
     cleanup:bool = cleanup_arg,
+    cache:bool = cache_arg,
+    include:List[str] = include_arg,
+    exclude:List[str] = exclude_arg,
+    lazy:bool = lazy_arg,
+    upload_include:List[str] = upload_include_arg,
+    upload_exclude:List[str] = upload_exclude_arg,
+    outputs_only:bool = outputs_only_arg,
+    pack:bool = pack_arg,
+    pack_compression:str = pack_compression_arg,
+    shard_size:int = shard_size_arg,
+    chunk:bool = chunk_arg,
+    chunk_file_size:int = chunk_file_size_arg,
+    deduplicate:bool = deduplicate_arg,
 ):
     """
     Processes the next dataset in a project.
     """
     console.print(f"Processing the next dataset from {url}")
 
-    connection = connections.Connection(url, token)
+    connection = get_connection(url, token, directory, cache)
 
     next_url = f"api/projects/{project}/next/" if project else "api/next/"
     next = connection.get_json_response(next_url)
@@ -126,6 +224,19 @@ def next(
             download=download,
             upload=upload,
             cleanup=cleanup,
+            cache=cache,
+            include=include,
+            exclude=exclude,
+            lazy=lazy,
+            upload_include=upload_include,
+            upload_exclude=upload_exclude,
+            outputs_only=outputs_only,
+            pack=pack,
+            pack_compression=pack_compression,
+            shard_size=shard_size,
+            chunk=chunk,
+            chunk_file_size=chunk_file_size,
+            deduplicate=deduplicate,
         )
     else:
         console.print("No more datasets to process.")
@@ -148,6 +259,19 @@ def loop(
     download:bool = download_arg,
     upload:bool = upload_arg,
     cleanup:bool = cleanup_arg,
+    cache:bool = cache_arg,
+    include:List[str] = include_arg,
+    exclude:List[str] = exclude_arg,
+    lazy:bool = lazy_arg,
+    upload_include:List[str] = upload_include_arg,
+    upload_exclude:List[str] = upload_exclude_arg,
+    outputs_only:bool = outputs_only_arg,
+    pack:bool = pack_arg,
+    pack_compression:str = pack_compression_arg,
+    shard_size:int = shard_size_arg,
+    chunk:bool = chunk_arg,
+    chunk_file_size:int = chunk_file_size_arg,
+    deduplicate:bool = deduplicate_arg,
 ):
     """
     Loops through all the datasets in a project and stops when complete.
@@ -169,6 +293,19 @@ def loop(
                 download=download,
                 upload=upload,
                 cleanup=cleanup,
+                cache=cache,
+                include=include,
+                exclude=exclude,
+                lazy=lazy,
+                upload_include=upload_include,
+                upload_exclude=upload_exclude,
+                outputs_only=outputs_only,
+                pack=pack,
+                pack_compression=pack_compression,
+                shard_size=shard_size,
+                chunk=chunk,
+                chunk_file_size=chunk_file_size,
+                deduplicate=deduplicate,
             )
         except NoDatasets:
             console.print("Loop concluded.")
@@ -406,6 +543,25 @@ def diagnostics():
     console.print(get_diagnostics())
 
 
+@app.command()
+def export(
+    project: str = typer.Argument(..., help="The slug for the project."),
+    output: Path = typer.Option(None, help="The path to write the newline-delimited JSON to. If not given then it is written to stdout."),
+    url: str = url_arg,
+    token: str = token_arg,
+):
+    """Exports a project with all its datasets, items and attributes as newline-delimited JSON."""
+    connection = connections.Connection(url, token)
+    lines = connection.export_project(project)
+    if output:
+        with open(output, "wb") as f:
+            for line in lines:
+                f.write(line + b"\n")
+    else:
+        for line in lines:
+            typer.echo(line.decode())
+
+
 @app.command()
 def files(
     dataset: str = dataset_slug_arg,
@@ -415,7 +571,7 @@ def files(
 ):
     """Displays the files for a dataset."""
     connection = connections.Connection(url, token)
-    dataset_data = connection.get_json_response(f"/api/datasets/{dataset}/")
+    dataset_data = connection.get_json_response(f"/api/datasets/{dataset}/?fields=base_file_path")
     base_file_path = dataset_data.get("base_file_path")
 
     storage = storages.get_storage_with_settings(storage_settings)
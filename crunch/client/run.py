@@ -1,16 +1,19 @@
-from typing import Dict, Union
-from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from datetime import datetime, timezone
 import requests
 from functools import cached_property
 from pathlib import Path
 import traceback
+import os
 import subprocess
 import json
+import re
+import posixpath
 import shutil
 from django.core.files.storage import DefaultStorage
 
 from crunch.django.app.enums import Stage, State
-from crunch.django.app import storages
+from crunch.django.app import storages, packing, chunking, blobs
 from rich.console import Console
 
 console = Console()
@@ -20,6 +23,107 @@ from .connections import Connection
 from .enums import WorkflowType, RunResult
 
 STAGE_STYLE = "bold red"
+MANIFEST_FILENAME = "manifest.json"
+# Snakemake's records and caches are never uploaded
+DEFAULT_UPLOAD_EXCLUDE = [".snakemake"]
+FETCHED_CHECKSUMS_FILENAME = "fetched_md5_checksums.jsonl"
+# Storage settings given as a dictionary are passed to the lazy Snakefile as JSON in this environment variable
+LAZY_STORAGE_SETTINGS_VARIABLE = "CRUNCH_LAZY_STORAGE_SETTINGS"
+
+LAZY_SNAKEFILE = """\
+# The first rule of the workflow is still the default target
+workflow.include({workflow_path!r}, overwrite_default_target=True)
+
+import os
+import json
+from pathlib import Path
+from snakemake.exceptions import WorkflowError
+from crunch.client.run import fetch_from_storage
+
+CRUNCH_MANIFEST = set(json.loads(Path({manifest_path!r}).read_text())["files"])
+
+
+def crunch_fetch_input(wildcards):
+    # Snakemake uses the rules of the workflow instead for files in the same directories which are not in the manifest
+    if wildcards.crunch_path not in CRUNCH_MANIFEST:
+        raise WorkflowError(f"'{{wildcards.crunch_path}}' is not in the manifest of files in storage.")
+    return []
+
+
+rule crunch_fetch:
+    input:
+        crunch_fetch_input
+    output:
+        "{{crunch_path}}"
+    wildcard_constraints:
+        crunch_path={pattern!r}
+    run:
+        fetch_from_storage({working_directory!r}, wildcards.crunch_path, {storage_settings})
+
+
+# Files in the manifest are fetched rather than made again by the rules of the workflow
+for crunch_rule in list(workflow.rules):
+    if crunch_rule.name != "crunch_fetch":
+        workflow.ruleorder("crunch_fetch", crunch_rule.name)
+"""
+
+
+def manifest_wildcard_pattern(paths:Iterable[str]) -> str:
+    """
+    Creates a regular expression which matches the files in the directories of the paths in a manifest.
+
+    The pattern only lists the directories so it stays small for manifests with very many files.
+    The lazy Snakefile checks whether a matching file is actually in the manifest.
+
+    Args:
+        paths (Iterable[str]): The paths of the files relative to the working directory.
+
+    Returns:
+        str: The regular expression. If there are no paths then it never matches.
+    """
+    directories = {posixpath.dirname(path) for path in paths}
+    if not directories:
+        return "(?!)"
+
+    subdirectories = sorted(directory for directory in directories if directory)
+    if not subdirectories:
+        return "[^/]+"
+
+    prefix = "(?:" + "|".join(re.escape(directory) for directory in subdirectories) + ")/"
+    if "" in directories:
+        prefix = f"(?:{prefix})?"
+    return prefix + "[^/]+"
+
+
+def fetch_from_storage(working_directory:Union[str,Path], path:str, storage_settings:Union[Dict,Path]) -> str:
+    """
+    Fetches a file listed in the manifest of a run from storage.
+
+    This is called by the Snakemake rule which fetches files lazily when a run only downloads the manifest of the files.
+    Snakemake can run the rule in a separate process so the storage is configured again from the storage settings.
+    The MD5 checksum of the file is recorded so that the file is not uploaded again unless it is changed by the workflow.
+
+    Args:
+        working_directory (Union[str,Path]): The working directory for the dataset.
+        path (str): The path of the file relative to the working directory.
+        storage_settings (Union[Dict,Path]): The settings for the storage as given to `get_storage_with_settings`.
+
+    Returns:
+        str: The MD5 checksum of the file.
+    """
+    working_directory = Path(working_directory)
+    crunch_subdir = working_directory/".crunch"
+    manifest = json.loads((crunch_subdir/MANIFEST_FILENAME).read_text())
+
+    local_path = working_directory/path
+    storage = storages.get_storage_with_settings(storage_settings)
+    storages.copy_from_storage(str(Path(manifest["base_file_path"], path)), local_path, storage=storage)
+
+    md5 = utils.file_md5(local_path)
+    with open(crunch_subdir/FETCHED_CHECKSUMS_FILENAME, "a", encoding="utf-8") as f:
+        f.write(json.dumps({path: md5}) + "\n")
+    return md5
+
 
 class Run():
     """
@@ -37,13 +141,35 @@ class Run():
         upload_to_storage:bool=True,
         cleanup:bool=False,
         cores:str="1",
+        shared_directory:Path=None,
+        include:Optional[List[str]]=None,
+        exclude:Optional[List[str]]=None,
+        lazy_download:bool=False,
+        upload_include:Optional[List[str]]=None,
+        upload_exclude:Optional[List[str]]=None,
+        upload_outputs_only:bool=False,
+        pack:bool=False,
+        pack_compression:str="none",
+        pack_shard_size:int=packing.DEFAULT_SHARD_SIZE,
+        chunk:bool=False,
+        chunk_file_size:int=chunking.DEFAULT_CHUNKED_FILE_SIZE,
+        deduplicate:bool=False,
     ):
         self.connection = connection
         self.dataset_slug = dataset_slug
 
         if not self.dataset_slug:
             raise ValueError("Please specifiy dataset.")
-
+        if lazy_download and workflow_type != WorkflowType.snakemake:
+            raise ValueError("Files can only be downloaded lazily for Snakemake workflows.")
+        if upload_outputs_only and workflow_type != WorkflowType.snakemake:
+            raise ValueError("Only the outputs can be uploaded for Snakemake workflows.")
+        if deduplicate and pack:
+            raise ValueError("Files cannot be both deduplicated and packed into archives.")
+        if pack:
+            packing.check_compression(pack_compression)
+
+        # The full details are requested once because they are also saved in .crunch/dataset.json for the workflow
         self.dataset_data = connection.get_json_response(f"/api/datasets/{dataset_slug}/")
         self.workflow_type = workflow_type
         self.workflow_path = workflow_path
@@ -53,6 +179,19 @@ class Run():
         self.download_from_storage = download_from_storage
         self.upload_to_storage = upload_to_storage
         self.cleanup = cleanup
+        self.include = include
+        self.exclude = exclude
+        self.lazy_download = lazy_download
+        self.upload_include = upload_include
+        self.upload_exclude = upload_exclude
+        self.upload_outputs_only = upload_outputs_only
+        self.pack = pack
+        self.pack_compression = pack_compression
+        self.pack_shard_size = pack_shard_size
+        self.chunk = chunk
+        self.chunk_file_size = chunk_file_size
+        self.deduplicate = deduplicate
+        self.project_data = dict()
 
         # TODO raise exception
         assert self.dataset_data["slug"] == dataset_slug
@@ -64,6 +203,9 @@ class Run():
         my_working_directory.mkdir(exist_ok=True, parents=True)
         self.working_directory = my_working_directory
 
+        # Workflows and conda environments are kept outside the directory for the dataset so they can be reused by other runs
+        self.shared_directory = Path(shared_directory) if shared_directory else Path(working_directory, ".shared")
+
     def send_status(self, state, note:str="") -> requests.Response:
         """ Sends a status update about the processing of this dataset. """
         return self.connection.send_status(
@@ -80,6 +222,13 @@ class Run():
         crunch_subdir.mkdir(exist_ok=True, parents=True)
         return crunch_subdir
 
+    @cached_property
+    def conda_prefix(self) -> Path:
+        """ Returns the path to the directory where Snakemake keeps the conda environments so that they are reused by other runs. """
+        conda_prefix = (self.shared_directory/"conda").resolve()
+        conda_prefix.mkdir(exist_ok=True, parents=True)
+        return conda_prefix
+
     @cached_property
     def storage(self) -> DefaultStorage:
         """ Gets the default storage object. """
@@ -91,11 +240,16 @@ class Run():
         
         This involves:
 
-        - Copying the initial data from storage
+        - Copying the initial data from storage (only the files selected by the include and exclude patterns)
+          or writing a manifest of the files in ``.crunch/manifest.json`` so they can be fetched when the workflow needs them
+        - Extracting the small files which were packed into archives when they were uploaded,
+          rebuilding the large files which were split into chunks and copying the files which are stored as shared blobs.
+          If a file has been uploaded in more than one of these ways then only its most recent copy is used.
         - Saving the MD5 checksums for all the initial data in ``.crunch/setup_md5_checksums.json``
         - Saves the metadata for the dataset in ``.crunch/dataset.json``
         - Saves the metadata for the project in ``.crunch/project.json``
-        - Creates the script to run the workflow (either a bash script or a Snakefile for Snakemake)
+        - Creates the script to run the workflow (either a bash script or a Snakefile for Snakemake) in the shared directory
+          if this version of the workflow has not been written already
 
 
         Returns:
@@ -105,13 +259,36 @@ class Run():
         console.print(f"Setup stage {self.dataset_slug}", style=STAGE_STYLE)
         try:
             self.send_status(State.START)
+
+            # get project details first because they have the patterns for the files to upload
+            project_data = self.connection.get_json_response(f"/api/projects/{self.project}/")
+            # TODO raise exception
+            assert project_data["slug"] == self.project
+            self.project_data = project_data
             
             # Pull data from storage
             if self.download_from_storage:
-                storages.copy_recursive_from_storage(
-                    self.base_file_path, self.working_directory, storage=self.storage
-                )
-                self.setup_md5_checksums = utils.md5_checksums(self.working_directory)
+                if self.lazy_download:
+                    files = list(storages.iter_latest_files(
+                        self.base_file_path, storage=self.storage, include=self.include, exclude=self.exclude,
+                    ))
+                    self.write_manifest([path for path, entry in files if entry is None])
+                    indexed = {path: entry for path, entry in files if entry is not None}
+                else:
+                    indexed = storages.copy_recursive_from_storage(
+                        self.base_file_path, 
+                        self.working_directory, 
+                        storage=self.storage, 
+                        include=self.include, 
+                        exclude=self.exclude,
+                    )
+
+                # Files which are packed, chunked or shared are always copied because fetching them one at a time would be slow
+                self.copy_indexed_files(indexed)
+
+                # Files which will never be uploaded do not need checksums
+                include, exclude = self.upload_patterns()
+                self.setup_md5_checksums = utils.md5_checksums(self.working_directory, include=include, exclude=exclude)
                 with open(self.crunch_subdir / "setup_md5_checksums.json", "w", encoding="utf-8") as f:
                     json.dump(self.setup_md5_checksums, f, ensure_ascii=False, indent=4)
 
@@ -119,20 +296,15 @@ class Run():
             with open(self.crunch_subdir / "dataset.json", "w", encoding="utf-8") as f:
                 json.dump(self.dataset_data, f, ensure_ascii=False, indent=4)
 
-            # get project details
-            project_data = self.connection.get_json_response(f"/api/projects/{self.project}/")
-            # TODO raise exception
-            assert project_data["slug"] == self.project
-
             # TODO check to see if project.json already exists
             with open(self.crunch_subdir / "project.json", "w", encoding="utf-8") as f:
                 json.dump(project_data, f, ensure_ascii=False, indent=4)
 
             # get snakefile or script
             if not self.workflow_path:
-                self.workflow_path = utils.write_workflow(
+                self.workflow_path = utils.write_shared_workflow(
                     project_data["workflow"], 
-                    working_directory=self.crunch_subdir,
+                    shared_directory=self.shared_directory,
                     workflow_type=self.workflow_type,
                 )
 
@@ -145,6 +317,106 @@ class Run():
         
         return RunResult.SUCCESS
 
+    def copy_indexed_files(self, files:Dict[str, Dict]):
+        """
+        Copies the files which are not stored by themselves to the working directory.
+
+        Args:
+            files (Dict[str, Dict]): The most recent entries for the files from the indexes in storage keyed by path
+                (see `crunch.django.app.storages.iter_latest_files`).
+        """
+        layouts = {directory: dict() for directory in storages.INDEX_DIRECTORIES}
+        for path, entry in files.items():
+            layouts[storages.index_layout(entry)][path] = entry
+
+        storages.copy_manifest_files_from_storage(
+            self.base_file_path, self.working_directory, storage=self.storage, files=layouts[storages.MANIFESTS_DIRECTORY],
+        )
+        packing.unpack_from_storage(
+            self.base_file_path, self.working_directory, storage=self.storage, files=layouts[storages.PACKS_DIRECTORY],
+        )
+        chunking.reassemble_from_storage(
+            self.base_file_path, self.working_directory, storage=self.storage, files=layouts[storages.CHUNKS_DIRECTORY],
+        )
+
+    def write_manifest(self, files:List[str]) -> Path:
+        """
+        Writes the list of the files for the dataset in storage to ``.crunch/manifest.json`` without downloading them.
+
+        Args:
+            files (List[str]): The paths relative to the base file path of the dataset of the files stored by themselves
+                which can be fetched when they are needed.
+
+        Returns:
+            Path: The path to the manifest.
+        """
+        manifest_path = self.crunch_subdir/MANIFEST_FILENAME
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(dict(base_file_path=str(self.base_file_path), files=files), f, ensure_ascii=False, indent=4)
+        return manifest_path
+
+    def write_lazy_snakefile(self) -> Path:
+        """
+        Writes a Snakefile which includes the workflow and adds a rule to fetch the files in the manifest from storage.
+
+        Snakemake only runs the rule for files which are needed as inputs and which have not been fetched yet.
+        The rule only matches files in the directories of the manifest (see `manifest_wildcard_pattern`)
+        and the paths in the manifest are loaded into a set when Snakemake parses the Snakefile
+        so that a large manifest does not make an enormous regular expression.
+        The Snakefile is written in the shared directory rather than the working directory so that it is not uploaded.
+        Storage settings given as a dictionary can have credentials so they are not written in the Snakefile.
+        Instead the rule reads them from the environment variable `LAZY_STORAGE_SETTINGS_VARIABLE`
+        which is set while the workflow runs.
+
+        Returns:
+            Path: The path to the Snakefile.
+        """
+        manifest_path = self.crunch_subdir/MANIFEST_FILENAME
+        manifest = json.loads(manifest_path.read_text())
+        pattern = manifest_wildcard_pattern(manifest["files"])
+        if isinstance(self.storage_settings, Path):
+            storage_settings = f"Path({str(self.storage_settings.resolve())!r})"
+        else:
+            storage_settings = f"json.loads(os.environ[{LAZY_STORAGE_SETTINGS_VARIABLE!r}])"
+
+        lazy_directory = self.shared_directory/"lazy"
+        lazy_directory.mkdir(exist_ok=True, parents=True)
+        snakefile = lazy_directory/f"{self.working_directory.name}.smk"
+        snakefile.write_text(LAZY_SNAKEFILE.format(
+            workflow_path=str(Path(self.workflow_path).resolve()),
+            pattern=pattern,
+            manifest_path=str(manifest_path.resolve()),
+            working_directory=str(self.working_directory.resolve()),
+            storage_settings=storage_settings,
+        ))
+        return snakefile
+
+    def upload_patterns(self) -> Tuple[List[str], List[str]]:
+        """
+        Combines the glob patterns for the files to upload from the options of this run and from the project.
+
+        The project has one pattern per line in its 'upload_include' and 'upload_exclude' fields.
+        Snakemake's ``.snakemake`` directory is always excluded.
+
+        Returns:
+            Tuple[List[str], List[str]]: The patterns to include and the patterns to exclude.
+        """
+        def project_patterns(field:str) -> List[str]:
+            return [line.strip() for line in (self.project_data.get(field) or "").splitlines() if line.strip()]
+
+        include = list(self.upload_include or []) + project_patterns("upload_include")
+        exclude = DEFAULT_UPLOAD_EXCLUDE + list(self.upload_exclude or []) + project_patterns("upload_exclude")
+        return include, exclude
+
+    def fetched_md5_checksums(self) -> Dict[str, str]:
+        """ Reads the MD5 checksums of the files which were fetched lazily from storage as the workflow ran. """
+        checksums = dict()
+        fetched_path = self.crunch_subdir/FETCHED_CHECKSUMS_FILENAME
+        if fetched_path.exists():
+            for line in fetched_path.read_text().splitlines():
+                checksums.update(json.loads(line))
+        return checksums
+
     def workflow(self) -> RunResult:
         """ 
         Runs the workflow on a dataset that has been set up.
@@ -161,18 +433,26 @@ class Run():
             if self.workflow_type == WorkflowType.snakemake:
                 import snakemake
 
+                snakefile = self.write_lazy_snakefile() if self.lazy_download else self.workflow_path
                 args = [
-                    f"--snakefile={self.workflow_path}",
+                    f"--snakefile={snakefile}",
                     "--use-conda",
                     f"--cores={self.cores}",
                     f"--directory={self.working_directory}",
-                    f"--conda-frontend={utils.conda_frontend()}"
+                    f"--conda-frontend={utils.conda_frontend()}",
+                    f"--conda-prefix={self.conda_prefix}",
                 ]
 
+                pass_storage_settings = self.lazy_download and not isinstance(self.storage_settings, Path)
+                if pass_storage_settings:
+                    os.environ[LAZY_STORAGE_SETTINGS_VARIABLE] = json.dumps(self.storage_settings)
                 try:
                     snakemake.main(args)
                 except SystemExit as result:
                     print(f"result {result}")
+                finally:
+                    if pass_storage_settings:
+                        os.environ.pop(LAZY_STORAGE_SETTINGS_VARIABLE, None)
             elif self.workflow_type == WorkflowType.script:
                 result = subprocess.run(f"{self.workflow_path.resolve()}", capture_output=True, cwd=self.working_directory)
                 if result.returncode:
@@ -187,10 +467,51 @@ class Run():
         
         return RunResult.SUCCESS
 
+    def file_index_entries(self, paths:List[Path], shards:Optional[Dict[str, str]]=None) -> List[Dict]:
+        """
+        Describes uploaded files for the index of the files of the dataset on the site.
+
+        Args:
+            paths (List[Path]): The local paths of the uploaded files in the working directory.
+            shards (Dict[str, str], optional): The archive for each file which was packed with other small files
+                or the index of the chunks for each file which was split into chunks
+                or the manifest for each file which was stored as a shared blob.
+
+        Returns:
+            List[Dict]: The path relative to the working directory, size, MD5 checksum, modification time 
+                and archive, index of chunks or manifest (if not stored by itself) of each file.
+        """
+        checksums = getattr(self, "upload_md5_checksums", {})
+        shards = shards or {}
+        entries = []
+        for path in paths:
+            relative_path = str(Path(path).relative_to(self.working_directory))
+            stat = Path(path).stat()
+            md5 = checksums.get(relative_path) or utils.file_md5(path)
+            entry = dict(
+                path=relative_path,
+                size=stat.st_size,
+                md5=md5,
+                last_modified=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc).isoformat(),
+            )
+            shard = shards.get(Path(relative_path).as_posix())
+            if shard:
+                entry["shard"] = shard
+            entries.append(entry)
+        return entries
+
     def upload(self) -> RunResult:
         """
         Uploads new or modified files to the storage for the dataset.
 
+        Only the files which match the upload patterns of the run and the project (see `upload_patterns`) are hashed and uploaded.
+        If `upload_outputs_only` is set then only the files which Snakemake has recorded as outputs are considered.
+        If `pack` is set then the small files are packed into archives (see `crunch.django.app.packing.pack_to_storage`).
+        If `chunk` is set then files of at least `chunk_file_size` bytes are split into chunks 
+        and only the chunks which are not already in storage are uploaded (see `crunch.django.app.chunking.chunk_to_storage`).
+        If `deduplicate` is set then the other files are stored as blobs shared by all datasets 
+        and are only uploaded if no dataset has uploaded the same contents before (see `crunch.django.app.blobs.deduplicate_to_storage`).
+
         It also creates the following files:
         - .crunch/upload_md5_checksums.json which lists all MD5 checksums after the dataset has finished.
         - .crunch/deleted.txt which lists all files that were present after setup but which were deleted as the workflow ran.
@@ -204,20 +525,34 @@ class Run():
             self.send_status(State.START)
 
             if self.upload_to_storage:
-                # calculate checksums
-                self.upload_md5_checksums = utils.md5_checksums(self.working_directory)
+                # calculate checksums only for the files which can be uploaded
+                include, exclude = self.upload_patterns()
+                if self.upload_outputs_only:
+                    outputs = [
+                        path for path in utils.snakemake_outputs(self.working_directory) 
+                        if storages.path_included(Path(path).as_posix(), include, exclude)
+                    ]
+                    self.upload_md5_checksums = {path: utils.file_md5(self.working_directory/path) for path in outputs}
+                else:
+                    self.upload_md5_checksums = utils.md5_checksums(self.working_directory, include=include, exclude=exclude)
                 upload_md5_checksums_path = self.crunch_subdir / "upload_md5_checksums.json"
                 with open(upload_md5_checksums_path, "w", encoding="utf-8") as f:
                     json.dump(self.upload_md5_checksums, f, ensure_ascii=False, indent=4)
 
-                setup_files = set(self.setup_md5_checksums.keys())
+                # Files fetched lazily by the workflow are only uploaded if they have been modified
+                setup_md5_checksums = {
+                    path: md5 
+                    for path, md5 in {**self.fetched_md5_checksums(), **self.setup_md5_checksums}.items()
+                    if storages.path_included(Path(path).as_posix(), include, exclude)
+                }
+                setup_files = set(setup_md5_checksums.keys())
                 upload_files = set(self.upload_md5_checksums.keys())
                 new_files = upload_files - setup_files
-                deleted_files = setup_files - upload_files
+                deleted_files = set(file for file in setup_files if not (self.working_directory/file).exists())
                 remaining_files = setup_files.intersection(upload_files)
                 modified_files = set(
                     file for file in remaining_files 
-                    if self.upload_md5_checksums[file] != self.setup_md5_checksums[file]
+                    if self.upload_md5_checksums[file] != setup_md5_checksums[file]
                 )
                 deleted_log_path = self.crunch_subdir / "deleted.txt"
                 deleted_log_path.write_text("\n".join(deleted_files))
@@ -225,12 +560,47 @@ class Run():
                 files_to_upload = modified_files | new_files | set([upload_md5_checksums_path, deleted_log_path])
                 paths_to_upload = [self.working_directory/file for file in files_to_upload]
 
-                storages.copy_to_storage(
-                    paths_to_upload, 
-                    local_dir=self.working_directory,
-                    base=self.base_file_path, 
-                    storage=self.storage,
-                )
+                shards = dict()
+                unchunked_paths = paths_to_upload
+                if self.chunk:
+                    large_paths = [path for path in paths_to_upload if path.stat().st_size >= self.chunk_file_size]
+                    shards.update(chunking.chunk_to_storage(
+                        large_paths, 
+                        local_dir=self.working_directory,
+                        base=self.base_file_path, 
+                        storage=self.storage,
+                        checksums=self.upload_md5_checksums,
+                    ))
+                    unchunked_paths = [path for path in paths_to_upload if path not in large_paths]
+
+                if self.deduplicate:
+                    shards.update(blobs.deduplicate_to_storage(
+                        unchunked_paths, 
+                        local_dir=self.working_directory,
+                        base=self.base_file_path, 
+                        storage=self.storage,
+                        checksums=self.upload_md5_checksums,
+                    ))
+                elif self.pack:
+                    shards.update(packing.pack_to_storage(
+                        unchunked_paths, 
+                        local_dir=self.working_directory,
+                        base=self.base_file_path, 
+                        storage=self.storage,
+                        compression=self.pack_compression,
+                        shard_size=self.pack_shard_size,
+                        checksums=self.upload_md5_checksums,
+                    ))
+                else:
+                    storages.copy_to_storage(
+                        unchunked_paths, 
+                        local_dir=self.working_directory,
+                        base=self.base_file_path, 
+                        storage=self.storage,
+                    )
+
+                # Record the uploaded files so that the site does not need to list the storage to show them
+                self.connection.index_files(self.dataset_slug, self.file_index_entries(paths_to_upload, shards=shards))
 
             # Option to delete on remote storage?
             if self.cleanup:
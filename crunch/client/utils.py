@@ -1,8 +1,13 @@
+import os
 import stat
 import subprocess
 from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+import base64
+import binascii
 import hashlib
 
+from crunch.django.app import storages
 from .enums import WorkflowType
 
 
@@ -25,15 +30,19 @@ def conda_frontend() -> str:
     return "mamba" if has_mamba() else "conda"
 
 
+def workflow_filename(workflow_type:WorkflowType) -> str:
+    if workflow_type == WorkflowType.snakemake:
+        return "Snakefile"
+    elif workflow_type == WorkflowType.script:
+        return "script.sh"
+
+
 def write_workflow(data:str, working_directory:Path, workflow_type:WorkflowType) -> Path:
     assert data
     working_directory = Path(working_directory)
     working_directory.mkdir(exist_ok=True, parents=True)
     
-    if workflow_type == WorkflowType.snakemake:
-        workflow_path = working_directory / "Snakefile"
-    elif workflow_type == WorkflowType.script:
-        workflow_path = working_directory / "script.sh"
+    workflow_path = working_directory / workflow_filename(workflow_type)
     
     with open(workflow_path, "w", encoding="utf-8") as f:
         f.write(data.replace('\r\n', '\n'))
@@ -44,15 +53,99 @@ def write_workflow(data:str, working_directory:Path, workflow_type:WorkflowType)
     return workflow_path
 
 
-def md5_checksums(directory):
+def write_shared_workflow(data:str, shared_directory:Path, workflow_type:WorkflowType) -> Path:
+    """
+    Writes a workflow to a location in a shared directory which is determined by the contents of the workflow.
+
+    Each version of a workflow is only written once so that every dataset processed with it uses the same file
+    and Snakemake does not see a new workflow for every dataset.
+
+    Args:
+        data (str): The contents of the workflow.
+        shared_directory (Path): The directory shared between runs.
+        workflow_type (WorkflowType): The type of the workflow.
+
+    Returns:
+        Path: The path to the workflow.
+    """
+    assert data
+    data = data.replace('\r\n', '\n')
+    digest = hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+    workflow_directory = Path(shared_directory, "workflows", digest)
+    workflow_path = workflow_directory / workflow_filename(workflow_type)
+    if workflow_path.exists() and workflow_path.read_text(encoding="utf-8") == data:
+        return workflow_path
+
+    # Write to a temporary file and then move it so that other runs never see a partially written workflow
+    temporary_directory = write_workflow(data, workflow_directory / f".tmp-{os.getpid()}", workflow_type).parent
+    os.replace(temporary_directory / workflow_path.name, workflow_path)
+    temporary_directory.rmdir()
+
+    return workflow_path
+
+
+def file_md5(path:Path) -> str:
+    """ Calculates the MD5 checksum of a local file without reading it all into memory at once. """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def md5_checksums(directory, include:Optional[Iterable[str]]=None, exclude:Optional[Iterable[str]]=None) -> Dict[str, str]:
+    """
+    Calculates the MD5 checksums of the files in a directory and its subdirectories.
+
+    Args:
+        directory (Union[str,Path]): The directory with the files.
+        include (Iterable[str], optional): Glob patterns for the paths relative to the directory of the files to include.
+            If not given then all files are included.
+        exclude (Iterable[str], optional): Glob patterns for the paths relative to the directory of files or subdirectories to leave out.
+            Excluded subdirectories are not searched.
+
+    Returns:
+        Dict[str, str]: The MD5 checksum for the path of each file relative to the directory.
+    """
     directory = Path(directory)
     result = dict()
-    for path in directory.rglob("*"):
-        if path.is_dir():
-            continue
-        
-        relative_path = path.relative_to(directory)
-        md5 = hashlib.md5(path.read_bytes()).hexdigest()
-        result[str(relative_path)] = md5
+    for dirpath, dirnames, filenames in os.walk(directory):
+        relative_dir = Path(dirpath).relative_to(directory)
+        if exclude:
+            dirnames[:] = [dirname for dirname in dirnames if not storages.path_matches((relative_dir/dirname).as_posix(), exclude)]
+
+        for filename in filenames:
+            relative_path = relative_dir/filename
+            if storages.path_included(relative_path.as_posix(), include, exclude):
+                result[str(relative_path)] = file_md5(Path(dirpath, filename))
 
     return result
+
+
+def snakemake_outputs(directory) -> Set[str]:
+    """
+    Finds the files which Snakemake has recorded as outputs of jobs run in a directory.
+
+    Snakemake keeps a record for each output file in ``.snakemake/metadata`` named with the path of the file encoded in URL-safe base64
+    (split into subdirectories prefixed with '@' if the name is too long).
+
+    Args:
+        directory (Union[str,Path]): The working directory of the workflow.
+
+    Returns:
+        Set[str]: The paths relative to the directory of the output files which still exist.
+    """
+    directory = Path(directory)
+    metadata_dir = directory/".snakemake"/"metadata"
+    outputs = set()
+    for dirpath, _, filenames in os.walk(metadata_dir):
+        parts = [part.lstrip("@") for part in Path(dirpath).relative_to(metadata_dir).parts]
+        for filename in filenames:
+            try:
+                path = base64.urlsafe_b64decode("".join(parts + [filename])).decode()
+            except (binascii.Error, UnicodeDecodeError):
+                # Temporary files while Snakemake writes a record
+                continue
+            if (directory/path).is_file():
+                outputs.add(str(Path(path)))
+    return outputs
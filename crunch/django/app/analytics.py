@@ -0,0 +1,194 @@
+from io import BytesIO
+from typing import Dict, Type, Union
+from pathlib import Path
+import pandas as pd
+
+from .models import Item, Attribute
+from .export import attribute_models, attribute_value_fields
+
+
+LAYOUTS = ("long", "wide")
+FORMATS = ("parquet", "arrow")
+
+FIELD_DTYPES = {
+    "CharField": "string",
+    "TextField": "string",
+    "FloatField": "float64",
+    "DecimalField": "float64",
+    "IntegerField": "Int64",
+    "BigIntegerField": "Int64",
+    "PositiveIntegerField": "Int64",
+    "PositiveBigIntegerField": "Int64",
+    "BooleanField": "boolean",
+}
+
+
+class AttributeTableException(Exception):
+    """ Raised when an attribute table cannot be created or written. """
+    pass
+
+
+def attribute_type_name(model: Type[Attribute]) -> str:
+    """ Returns a short name for an attribute model, e.g. 'float' for FloatAttribute. """
+    name = model._meta.model_name
+    if name.endswith("attribute"):
+        name = name[: -len("attribute")]
+    return name
+
+
+def convert_column(series: pd.Series, internal_type: str) -> pd.Series:
+    """ Converts a column of values from the database to the native dtype for the type of field they came from. """
+    if internal_type == "DateTimeField":
+        return pd.to_datetime(series, utc=True)
+    if internal_type == "DateField":
+        # pyarrow stores columns of Python dates as date32
+        return series.astype("object")
+    return series.astype(FIELD_DTYPES.get(internal_type, "object"))
+
+
+def attribute_frames(project: Item) -> Dict[Type[Attribute], pd.DataFrame]:
+    """
+    Retrieves the attributes of a project and all its descendants with a single query for each type of attribute.
+
+    Args:
+        project (Item): The project (or any other item) with the attributes.
+
+    Returns:
+        Dict[Type[Attribute], pd.DataFrame]: A dataframe for each type of attribute with the columns
+            'lft', 'item_id', 'item', 'key' and the value fields for that type converted to native dtypes.
+    """
+    frames = {}
+    for model in attribute_models():
+        value_fields = attribute_value_fields(model)
+        rows = (
+            model.objects.non_polymorphic()
+            .filter(item__tree_id=project.tree_id, item__lft__gte=project.lft, item__rght__lte=project.rght)
+            .order_by("item__lft", "pk")
+            .values_list("item__lft", "item_id", "item__slug", "key", *value_fields)
+        )
+        frame = pd.DataFrame.from_records(list(rows), columns=["lft", "item_id", "item", "key", *value_fields])
+        frame["item"] = frame["item"].astype("string")
+        frame["key"] = frame["key"].astype("string")
+        for field_name in value_fields:
+            internal_type = model._meta.get_field(field_name).get_internal_type()
+            frame[field_name] = convert_column(frame[field_name], internal_type)
+        frames[model] = frame
+    return frames
+
+
+def long_attribute_table(project: Item) -> pd.DataFrame:
+    """
+    Creates a table with a row for each attribute of a project and its descendants.
+
+    Each type of attribute has its own column(s) for its value with a native dtype (e.g. 'float', 'datetime' or 'latitude' and 'longitude').
+    The 'type' column gives which of these columns is used for each row.
+
+    Args:
+        project (Item): The project (or any other item) with the attributes.
+
+    Returns:
+        pd.DataFrame: The attributes in the long layout.
+    """
+    frames = []
+    for model, frame in attribute_frames(project).items():
+        type_name = attribute_type_name(model)
+        frame = frame.rename(columns={"value": type_name})
+        frame.insert(4, "type", type_name)
+        frames.append(frame)
+
+    table = pd.concat(frames, ignore_index=True)
+    table["type"] = table["type"].astype("category")
+    table = table.sort_values("lft", kind="mergesort").drop(columns="lft")
+    return table.reset_index(drop=True)
+
+
+def wide_attribute_table(project: Item) -> pd.DataFrame:
+    """
+    Creates a table with a row for each item in a project and a column for each attribute key.
+
+    Each column has the native dtype for the type of the attribute.
+    Attributes with more than one value field (e.g. latitude and longitude) get a column for each field named '<key>_<field>'.
+    If an item has more than one attribute with the same key then the last one is used.
+
+    Args:
+        project (Item): The project (or any other item) with the attributes.
+
+    Returns:
+        pd.DataFrame: The attributes in the wide layout.
+    """
+    items = (
+        Item.objects.non_polymorphic()
+        .filter(tree_id=project.tree_id, lft__gte=project.lft, rght__lte=project.rght)
+        .order_by("lft")
+        .values_list("pk", "slug")
+    )
+    table = pd.DataFrame.from_records(list(items), columns=["item_id", "item"]).set_index("item_id")
+    table["item"] = table["item"].astype("string")
+
+    for model, frame in attribute_frames(project).items():
+        if frame.empty:
+            continue
+        value_fields = attribute_value_fields(model)
+        frame = frame.drop_duplicates(["item_id", "key"], keep="last")
+        for field_name in value_fields:
+            columns = frame.pivot(index="item_id", columns="key", values=field_name)
+            column_names = {}
+            for key in columns.columns:
+                name = key if len(value_fields) == 1 else f"{key}_{field_name}"
+                if name in table.columns or name in column_names.values():
+                    name = f"{name}_{attribute_type_name(model)}"
+                column_names[key] = name
+            columns = columns.rename(columns=column_names)
+            columns.columns.name = None
+            table = table.join(columns)
+
+    return table.reset_index()
+
+
+def attribute_table(project: Item, layout: str = "long") -> pd.DataFrame:
+    """
+    Creates a table of all the attributes of a project and its descendants.
+
+    Args:
+        project (Item): The project (or any other item) with the attributes.
+        layout (str, optional): Either 'long' for a row for each attribute or 'wide' for a row for each item. Defaults to "long".
+
+    Raises:
+        AttributeTableException: If the layout is not recognized.
+
+    Returns:
+        pd.DataFrame: The table of attributes.
+    """
+    if layout == "long":
+        return long_attribute_table(project)
+    if layout == "wide":
+        return wide_attribute_table(project)
+    raise AttributeTableException(f"Layout '{layout}' not recognized. Please use one of: {', '.join(LAYOUTS)}.")
+
+
+def write_attribute_table(table: pd.DataFrame, destination: Union[str, Path, BytesIO], format: str = "parquet"):
+    """
+    Writes a table of attributes to a Parquet file or to an Arrow IPC (Feather) file.
+
+    This requires pyarrow to be installed.
+
+    Args:
+        table (pd.DataFrame): The table of attributes.
+        destination (Union[str, Path, BytesIO]): The path or buffer to write to.
+        format (str, optional): Either 'parquet' or 'arrow'. Defaults to "parquet".
+
+    Raises:
+        AttributeTableException: If the format is not recognized or pyarrow is not installed.
+    """
+    if format not in FORMATS:
+        raise AttributeTableException(f"Format '{format}' not recognized. Please use one of: {', '.join(FORMATS)}.")
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise AttributeTableException("Writing attribute tables requires pyarrow. Please install it with 'pip install pyarrow'.")
+
+    if format == "parquet":
+        table.to_parquet(destination, index=False)
+    else:
+        table.to_feather(destination)
@@ -0,0 +1,339 @@
+import time
+import gzip
+import json
+import statistics
+import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+
+from . import models, enums, serializers
+
+
+BENCHMARK_PREFIX = "Benchmark"
+
+
+class BenchmarkRollback(Exception):
+    """ Raised internally to roll back the synthetic data generated for a benchmark. """
+    pass
+
+
+def create_synthetic_attribute(item: models.Item, index: int) -> models.Attribute:
+    """
+    Creates an attribute on an item, cycling through the typed attribute classes according to the index.
+
+    Args:
+        item (models.Item): The item to attach the attribute to.
+        index (int): The index of the attribute on this item. This determines its type.
+
+    Returns:
+        models.Attribute: The newly created attribute.
+    """
+    key = f"attribute-{index}"
+    factories = [
+        lambda: models.CharAttribute.objects.create(item=item, key=key, value=f"value {index}"),
+        lambda: models.FloatAttribute.objects.create(item=item, key=key, value=index / 10),
+        lambda: models.IntegerAttribute.objects.create(item=item, key=key, value=index),
+        lambda: models.FilesizeAttribute.objects.create(item=item, key=key, value=1_000 * (index + 1)),
+        lambda: models.BooleanAttribute.objects.create(item=item, key=key, value=bool(index % 2)),
+        lambda: models.DateTimeAttribute.objects.create(item=item, key=key, value=timezone.now()),
+        lambda: models.DateAttribute.objects.create(item=item, key=key, value=datetime.date.today()),
+        lambda: models.URLAttribute.objects.create(item=item, key=key, value=f"https://www.example.com/{index}"),
+        lambda: models.LatLongAttribute.objects.create(
+            item=item, key=key, latitude=(index * 7) % 180 - 90, longitude=(index * 13) % 360 - 180
+        ),
+    ]
+    return factories[index % len(factories)]()
+
+
+def create_synthetic_statuses(dataset: models.Dataset, index: int, statuses: int):
+    """
+    Creates status updates for a dataset so that datasets are spread between being
+    unprocessed, running, failed and completed.
+    """
+    category = index % 4
+    if category == 0 or statuses < 1:
+        # unprocessed
+        return
+
+    for status_index in range(statuses):
+        stage = enums.Stage.SETUP
+        state = enums.State.START
+        if status_index == statuses - 1:
+            if category == 2:
+                stage, state = enums.Stage.WORKFLOW, enums.State.FAIL
+            elif category == 3:
+                stage, state = enums.Stage.UPLOAD, enums.State.SUCCESS
+        models.Status.objects.create(dataset=dataset, stage=stage, state=state)
+
+
+def generate_synthetic_tree(
+    projects: int = 2,
+    datasets: int = 10,
+    items: int = 5,
+    attributes: int = 5,
+    statuses: int = 3,
+    prefix: str = BENCHMARK_PREFIX,
+) -> List[models.Project]:
+    """
+    Generates a synthetic tree of projects, datasets, items, attributes and statuses.
+
+    Args:
+        projects (int, optional): The number of projects. Defaults to 2.
+        datasets (int, optional): The number of datasets in each project. Defaults to 10.
+        items (int, optional): The number of items in each dataset. Defaults to 5.
+        attributes (int, optional): The number of attributes on each project, dataset and item. Defaults to 5.
+        statuses (int, optional): The number of statuses for each dataset which has been processed. Defaults to 3.
+        prefix (str, optional): A prefix for the names of the projects. Defaults to 'Benchmark'.
+
+    Returns:
+        List[models.Project]: The projects created.
+    """
+    created_projects = []
+    with models.Item.objects.delay_mptt_updates():
+        for project_index in range(projects):
+            project = models.Project.objects.create(
+                name=f"{prefix} Project {project_index}",
+                workflow="echo 'benchmark'",
+            )
+            created_projects.append(project)
+            for attribute_index in range(attributes):
+                create_synthetic_attribute(project, attribute_index)
+
+            for dataset_index in range(datasets):
+                dataset = models.Dataset.objects.create(
+                    name=f"{project.name} Dataset {dataset_index}",
+                    parent=project,
+                )
+                for attribute_index in range(attributes):
+                    create_synthetic_attribute(dataset, attribute_index)
+
+                for item_index in range(items):
+                    item = models.Item.objects.create(
+                        name=f"{dataset.name} Item {item_index}",
+                        parent=dataset,
+                    )
+                    for attribute_index in range(attributes):
+                        create_synthetic_attribute(item, attribute_index)
+
+                create_synthetic_statuses(dataset, dataset_index, statuses)
+
+    return [models.Project.objects.get(pk=project.pk) for project in created_projects]
+
+
+def measure(name: str, func: Callable, repeat: int = 3) -> Dict:
+    """
+    Times a function and counts the number of SQL queries it makes.
+
+    The queries are counted on the first call and the timings are taken across all calls.
+
+    Args:
+        name (str): The name of this measurement.
+        func (Callable): The function to measure. Querysets returned should already be evaluated.
+        repeat (int, optional): The number of times to call the function. Defaults to 3.
+
+    Returns:
+        Dict: The name, query count and timings (in seconds) of this measurement.
+    """
+    timings = []
+    queries = 0
+    for iteration in range(max(repeat, 1)):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        if iteration == 0:
+            queries = len(context.captured_queries)
+
+    return dict(
+        name=name,
+        queries=queries,
+        repeat=len(timings),
+        min=min(timings),
+        mean=statistics.mean(timings),
+        max=max(timings),
+    )
+
+
+def benchmark_queries(project: models.Project, repeat: int = 3) -> List[Dict]:
+    """ Measures the hot querysets of the data model. """
+    dataset = project.items().first()
+    return [
+        measure("Dataset.unprocessed", lambda: list(models.Dataset.unprocessed()), repeat),
+        measure("Dataset.running", lambda: list(models.Dataset.running()), repeat),
+        measure("Dataset.failed", lambda: list(models.Dataset.failed()), repeat),
+        measure("Dataset.completed", lambda: list(models.Dataset.completed()), repeat),
+        measure("Dataset.next_unprocessed", lambda: models.Dataset.next_unprocessed(), repeat),
+        measure("Project.unprocessed_datasets", lambda: list(project.unprocessed_datasets()), repeat),
+        measure("Project.running_datasets", lambda: list(project.running_datasets()), repeat),
+        measure("Project.failed_datasets", lambda: list(project.failed_datasets()), repeat),
+        measure("Project.completed_datasets", lambda: list(project.completed_datasets()), repeat),
+        measure("Item.descendant_total_filesize", lambda: project.descendant_total_filesize(), repeat),
+        measure("Item.descendant_attributes", lambda: list(project.descendant_attributes()), repeat),
+        measure("DatasetSerializer", lambda: serializers.DatasetSerializer(dataset).data, repeat),
+    ]
+
+
+def benchmark_endpoints(project: models.Project, repeat: int = 3) -> List[Dict]:
+    """ Measures the API endpoints and pages with a test client logged in as a superuser. """
+    from rest_framework.test import APIClient
+
+    User = get_user_model()
+    user = User.objects.create_superuser(username=f"{BENCHMARK_PREFIX.lower()}-{time.time_ns()}", password=None)
+    client = APIClient()
+    client.force_authenticate(user=user)
+    client.force_login(user)
+
+    dataset = project.items().first()
+    urls = {
+        "GET /api/projects/": "/api/projects/",
+        "GET /api/projects/<slug>/": f"/api/projects/{project.slug}/",
+        "GET /api/datasets/": "/api/datasets/",
+        "GET /api/datasets/<slug>/": f"/api/datasets/{dataset.slug}/",
+        "GET /api/items/": "/api/items/",
+        "GET /api/statuses/": "/api/statuses/",
+        "GET /api/next/": "/api/next/",
+        "GET /api/projects/<slug>/next/": f"/api/projects/{project.slug}/next/",
+        "GET /projects/<slug>/": project.get_absolute_url(),
+        "GET /projects/<project>/datasets/<slug>": dataset.get_absolute_url(),
+    }
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code < 400, f"{url} returned {response.status_code}"
+        return response
+
+    return [measure(name, lambda url=url: get(url), repeat) for name, url in urls.items()]
+
+
+def benchmark_payloads(dataset: models.Dataset, repeat: int = 3) -> List[Dict]:
+    """
+    Compares the size of the API response for a dataset in each of the formats and encodings the API can send
+    and the time taken for a client to decode it.
+
+    Args:
+        dataset (models.Dataset): The dataset to serialize.
+        repeat (int, optional): The number of times to time the decoding. Defaults to 3.
+
+    Returns:
+        List[Dict]: The measurements of the time to decode each payload with its size in bytes.
+    """
+    from rest_framework.renderers import JSONRenderer
+    from . import compression, renderers
+
+    data = serializers.DatasetSerializer(dataset).data
+    json_payload = JSONRenderer().render(data)
+    payloads = {
+        "json": (json_payload, json.loads),
+        "json+gzip": (compression.compress_gzip(json_payload), lambda payload: json.loads(gzip.decompress(payload))),
+    }
+    if compression.brotli:
+        payloads["json+br"] = (
+            compression.compress_brotli(json_payload),
+            lambda payload: json.loads(compression.brotli.decompress(payload)),
+        )
+    if renderers.msgpack_available():
+        msgpack_payload = renderers.MessagePackRenderer().render(data)
+        payloads["msgpack"] = (msgpack_payload, lambda payload: renderers.msgpack.unpackb(payload, raw=False))
+        payloads["msgpack+gzip"] = (
+            compression.compress_gzip(msgpack_payload),
+            lambda payload: renderers.msgpack.unpackb(gzip.decompress(payload), raw=False),
+        )
+
+    results = []
+    for name, (payload, decode) in payloads.items():
+        measurement = measure(f"decode {name}", lambda payload=payload, decode=decode: decode(payload), repeat)
+        measurement["size"] = len(payload)
+        results.append(measurement)
+    return results
+
+
+def run_benchmark(
+    projects: int = 2,
+    datasets: int = 10,
+    items: int = 5,
+    attributes: int = 5,
+    statuses: int = 3,
+    repeat: int = 3,
+    endpoints: bool = True,
+    keep: bool = False,
+) -> Dict:
+    """
+    Generates a synthetic tree and measures the hot queries and API endpoints against it.
+
+    Unless `keep` is True, the synthetic data is generated inside a transaction which is rolled back afterwards.
+
+    Returns:
+        Dict: The parameters of the benchmark, details of the database and the measurements.
+    """
+    parameters = dict(
+        projects=projects,
+        datasets=datasets,
+        items=items,
+        attributes=attributes,
+        statuses=statuses,
+        repeat=repeat,
+    )
+    result = dict(
+        parameters=parameters,
+        database=dict(vendor=connection.vendor, name=str(connection.settings_dict.get("NAME", ""))),
+        created=timezone.now().isoformat(),
+        results=[],
+    )
+
+    try:
+        with transaction.atomic():
+            start = time.perf_counter()
+            generated = generate_synthetic_tree(
+                projects=projects, datasets=datasets, items=items, attributes=attributes, statuses=statuses
+            )
+            result["generation_time"] = time.perf_counter() - start
+
+            project = generated[0]
+            result["results"] += benchmark_queries(project, repeat=repeat)
+            result["payloads"] = benchmark_payloads(project.items().first(), repeat=repeat)
+            if endpoints:
+                result["results"] += benchmark_endpoints(project, repeat=repeat)
+
+            if not keep:
+                raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+
+    return result
+
+
+def write_results(result: Dict, path: Union[str, Path]):
+    """ Writes the results of a benchmark to a JSON file. """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+
+
+def compare_results(baseline: Dict, current: Dict, tolerance: float = 0.5) -> List[str]:
+    """
+    Compares the results of a benchmark with a baseline.
+
+    Args:
+        baseline (Dict): The results of a previous benchmark.
+        current (Dict): The results of the current benchmark.
+        tolerance (float, optional): The fractional increase in mean time allowed before it is a regression. Defaults to 0.5.
+
+    Returns:
+        List[str]: A description of each regression found. Any increase in the number of queries is a regression.
+    """
+    baseline_results = {measurement["name"]: measurement for measurement in baseline.get("results", [])}
+    regressions = []
+    for measurement in current.get("results", []):
+        name = measurement["name"]
+        if name not in baseline_results:
+            continue
+        previous = baseline_results[name]
+        if measurement["queries"] > previous["queries"]:
+            regressions.append(f"{name}: queries increased from {previous['queries']} to {measurement['queries']}")
+        if measurement["mean"] > previous["mean"] * (1.0 + tolerance):
+            regressions.append(f"{name}: mean time increased from {previous['mean']:.6f}s to {measurement['mean']:.6f}s")
+
+    return regressions
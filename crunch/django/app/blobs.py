@@ -0,0 +1,193 @@
+import os
+import json
+import hashlib
+import tempfile
+import datetime
+import posixpath
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from . import storages
+
+
+# Unreferenced blobs younger than this are not removed because the manifest for them may still be being written by a run
+DEFAULT_GARBAGE_MIN_AGE = datetime.timedelta(hours=24)
+
+
+def file_sha256(path:Path) -> str:
+    """ Calculates the SHA256 hash of a file reading it in chunks. """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(storages.COPY_BUFFER_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def touch_blob(name:str, local_path:Path, storage) -> None:
+    """
+    Updates the modified time of a blob already in storage so that `collect_garbage` treats it as recent.
+
+    The blob is touched on a local filesystem or copied onto itself in S3.
+    For other storages it is saved again from the local file which has the same contents.
+    """
+    try:
+        os.utime(storage.path(name))
+        return
+    except (NotImplementedError, FileNotFoundError):
+        pass
+
+    bucket = getattr(storage, "bucket", None)
+    normalize_name = getattr(storage, "_normalize_name", None)
+    if bucket is not None and normalize_name is not None and hasattr(bucket, "Object"):
+        key = normalize_name(name)
+        # S3 only allows an object to be copied onto itself if its metadata is replaced
+        bucket.Object(key).copy_from(CopySource=dict(Bucket=bucket.name, Key=key), MetadataDirective="REPLACE")
+        return
+
+    with local_path.open(mode="rb") as f:
+        storage._save(name, File(f, name=posixpath.basename(name)))
+
+
+def deduplicate_to_storage(
+    paths: Iterable[Path],
+    local_dir: Path,
+    base = "/",
+    storage = None,
+    checksums: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Copies files to storage as blobs named by their SHA256 hashes which are shared by all datasets.
+
+    A file is only uploaded if no dataset has uploaded a file with the same contents before.
+    Otherwise the existing blob is touched (see `touch_blob`) so that `collect_garbage` does not delete it
+    before the manifest which references it is written.
+    A manifest in ``.crunch/manifests`` under the base path lists the blob for each file.
+
+    Args:
+        paths (Iterable[Path]): The local paths of the files to copy.
+        local_dir (Path): The local directory which the paths are relative to.
+        base (Union[str,Path], optional): The base path of the dataset in storage. Defaults to "/".
+        storage (optional): The storage to copy to. Defaults to the default storage.
+        checksums (Dict[str, str], optional): The MD5 checksums of the files keyed by path relative to the local directory to put in the manifest.
+
+    Returns:
+        Dict[str, str]: The path of the manifest (relative to the base path) for the path of each file.
+    """
+    if storage is None:
+        storage = default_storage
+    local_dir = Path(local_dir)
+    checksums = checksums or {}
+
+    files = []
+    for local_path in sorted(Path(path) for path in paths):
+        if local_path.is_dir():
+            continue
+
+        digest = file_sha256(local_path)
+        name = storages.blob_name(digest)
+        if storage.exists(name):
+            print(f"Using blob '{digest}' already in storage for '{local_path}'")
+            touch_blob(name, local_path, storage)
+        else:
+            print(f"Copying '{local_path}' to storage at '{name}'")
+            with local_path.open(mode="rb") as f:
+                storage._save(name, File(f, name=digest))
+
+        relative_path = local_path.relative_to(local_dir)
+        files.append(dict(
+            path=relative_path.as_posix(),
+            size=local_path.stat().st_size,
+            md5=checksums.get(str(relative_path), ""),
+            blob=digest,
+        ))
+
+    if not files:
+        return {}
+
+    # The names start with the time so that the most recent manifest is read last
+    manifest_id = f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    manifest_name = (storages.MANIFESTS_DIRECTORY/f"{manifest_id}.json").as_posix()
+    manifest = dict(created=datetime.datetime.utcnow().isoformat(), files=files)
+    with tempfile.TemporaryFile() as f:
+        f.write(json.dumps(manifest, indent=4).encode("utf-8"))
+        f.seek(0)
+        storage._save(str(Path(base, manifest_name)), File(f, name=f"{manifest_id}.json"))
+
+    return {file["path"]: manifest_name for file in files}
+
+
+def referenced_blobs(base_paths:Iterable[str], storage=None) -> Set[str]:
+    """
+    Finds the hashes of the blobs listed in any manifest of the datasets at the base paths.
+
+    Every manifest is used, not just the most recent entry for each file, so that older manifests can still be read.
+    """
+    return {
+        entry["blob"]
+        for base_path in base_paths
+        for _, manifest in storages.read_indexes(base_path, storages.MANIFESTS_DIRECTORY, storage=storage)
+        for entry in manifest["files"]
+    }
+
+
+def collect_garbage(
+    referenced:Set[str],
+    storage=None,
+    min_age:datetime.timedelta=DEFAULT_GARBAGE_MIN_AGE,
+    dry_run:bool=False,
+) -> List[str]:
+    """
+    Deletes the blobs in storage which are not referenced by any manifest.
+
+    Runs touch the blobs which they reuse before writing their manifests (see `deduplicate_to_storage`)
+    so the modified time of each blob is checked again immediately before it is deleted.
+    This leaves only the short window between that check and the deletion in which a run could start using the blob.
+
+    Args:
+        referenced (Set[str]): The hashes of the blobs which are referenced (see `referenced_blobs`).
+        storage (optional): The storage with the blobs. Defaults to the default storage.
+        min_age (datetime.timedelta, optional): Blobs modified more recently than this are kept. Defaults to DEFAULT_GARBAGE_MIN_AGE.
+        dry_run (bool, optional): Whether to only find the unreferenced blobs without deleting them. Defaults to False.
+
+    Returns:
+        List[str]: The names in storage of the unreferenced blobs.
+    """
+    if storage is None:
+        storage = default_storage
+
+    try:
+        prefixes, _ = storage.listdir(storages.blobs_path())
+    except FileNotFoundError:
+        return []
+
+    def is_old(name:str) -> bool:
+        try:
+            return storage.get_modified_time(name) <= timezone.now() - min_age
+        except NotImplementedError:
+            return True
+        except FileNotFoundError:
+            return False
+
+    candidates = [
+        storages.blob_name(digest)
+        for prefix in sorted(prefixes)
+        for digest in sorted(storage.listdir(posixpath.join(storages.blobs_path(), prefix))[1])
+        if digest not in referenced
+    ]
+    candidates = [name for name in candidates if is_old(name)]
+    if dry_run:
+        return candidates
+
+    unreferenced = []
+    for name in candidates:
+        # A run may have reused the blob since the listing so it is checked again just before deleting
+        if not is_old(name):
+            continue
+        storage.delete(name)
+        unreferenced.append(name)
+
+    return unreferenced
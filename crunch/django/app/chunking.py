@@ -0,0 +1,259 @@
+import json
+import hashlib
+import tempfile
+import datetime
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional
+import numpy as np
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from . import storages
+
+
+# Files at least this size are split into chunks when chunking is used for an upload
+DEFAULT_CHUNKED_FILE_SIZE = 64 * 1024 * 1024
+# The sizes of the chunks. The average size must be a power of two.
+MIN_CHUNK_SIZE = 1024 * 1024
+AVERAGE_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# The number of bytes read at a time when looking for the boundaries of the chunks
+BOUNDARY_BLOCK_SIZE = 8 * 1024 * 1024
+# The number of bytes which determine the hash at each position
+WINDOW_SIZE = 32
+
+# A fixed random 32 bit number for each byte value. These must never change or files would be chunked differently.
+GEAR = np.array(
+    [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:4], "little") for value in range(256)],
+    dtype=np.uint32,
+)
+
+
+class ChunkingException(Exception):
+    """ Raised when files cannot be split into chunks or reassembled. """
+    pass
+
+
+def gear_hashes(data:np.ndarray) -> np.ndarray:
+    """
+    Calculates the gear hash at each position of an array of bytes.
+
+    The hash at a position is the sum of the gear values of the previous `WINDOW_SIZE` bytes shifted by their distance from it.
+    This is the same as the rolling hash ``h = (h << 1) + GEAR[byte]`` in 32 bits but is calculated for the whole array
+    in a few passes by doubling the size of the window each time.
+
+    Args:
+        data (np.ndarray): The bytes as an array of uint8.
+
+    Returns:
+        np.ndarray: The hash for each position as an array of uint32.
+    """
+    hashes = GEAR.take(data)
+    # The shifted values are written to a separate array because adding overlapping views in place makes numpy copy them each time
+    shifted = np.empty_like(hashes)
+    width = 1
+    while width < min(WINDOW_SIZE, len(hashes)):
+        np.left_shift(hashes[:len(hashes) - width], np.uint32(width), out=shifted[width:])
+        hashes[width:] += shifted[width:]
+        width *= 2
+    return hashes
+
+
+def chunk_boundaries(
+    f:BinaryIO,
+    min_size:int=MIN_CHUNK_SIZE,
+    average_size:int=AVERAGE_CHUNK_SIZE,
+    max_size:int=MAX_CHUNK_SIZE,
+) -> Iterator[int]:
+    """
+    Finds where to split a file into chunks by its content so that an edit to part of a file only changes the chunks around it.
+
+    A chunk ends after a byte where the top bits of the gear hash are all zero (with the number of bits given by the average size)
+    unless the chunk would be smaller than the minimum size. Chunks are cut at the maximum size if no boundary is found before it.
+
+    Args:
+        f (BinaryIO): The file to read.
+        min_size (int, optional): The minimum size of a chunk in bytes. Defaults to MIN_CHUNK_SIZE.
+        average_size (int, optional): The average size of a chunk in bytes. Must be a power of two. Defaults to AVERAGE_CHUNK_SIZE.
+        max_size (int, optional): The maximum size of a chunk in bytes. Defaults to MAX_CHUNK_SIZE.
+
+    Yields:
+        int: The offset of the end of each chunk. The last is the size of the file.
+    """
+    bits = average_size.bit_length() - 1
+    if average_size != 1 << bits or bits > 32:
+        raise ChunkingException(f"The average chunk size must be a power of two no larger than 2^32 (not {average_size}).")
+    mask = np.uint32(((1 << bits) - 1) << (32 - bits))
+
+    history = b""
+    offset = 0
+    last = 0
+    for block in iter(lambda: f.read(BOUNDARY_BLOCK_SIZE), b""):
+        # The bytes from the end of the previous block are included so that the hashes do not depend on where blocks start
+        hashes = gear_hashes(np.frombuffer(history + block, dtype=np.uint8))[len(history):]
+        for position in np.flatnonzero((hashes & mask) == 0):
+            end = offset + int(position) + 1
+            while end - last > max_size:
+                last += max_size
+                yield last
+            if end - last >= min_size:
+                last = end
+                yield last
+
+        offset += len(block)
+        history = (history + block)[-(WINDOW_SIZE - 1):]
+        while offset - last > max_size:
+            last += max_size
+            yield last
+
+    if offset > last:
+        yield offset
+
+
+def iter_chunks(path:Path, **kwargs) -> Iterator[bytes]:
+    """ Yields the content of each chunk of a file. The keyword arguments are passed to `chunk_boundaries`. """
+    with open(path, "rb") as boundaries_file, open(path, "rb") as f:
+        start = 0
+        for end in chunk_boundaries(boundaries_file, **kwargs):
+            yield f.read(end - start)
+            start = end
+
+
+def objects_path(base) -> Path:
+    """ The path in storage of the directory with the chunks for the dataset at a base path. """
+    return Path(base, storages.CHUNKS_DIRECTORY, "objects")
+
+
+def chunk_to_storage(
+    paths: Iterable[Path],
+    local_dir: Path,
+    base = "/",
+    storage = None,
+    checksums: Optional[Dict[str, str]] = None,
+    **kwargs,
+) -> Dict[str, str]:
+    """
+    Copies files to storage as chunks named by their SHA256 hashes so that chunks which are already in storage are not uploaded again.
+
+    When a large file is modified slightly, only the chunks around the changes are new and need to be uploaded.
+    The chunks are saved in ``.crunch/chunks/objects`` under the base path
+    with an index in ``.crunch/chunks`` which lists the chunks of each file in order.
+
+    Args:
+        paths (Iterable[Path]): The local paths of the files to copy.
+        local_dir (Path): The local directory which the paths are relative to.
+        base (Union[str,Path], optional): The base path in storage. Defaults to "/".
+        storage (optional): The storage to copy to. Defaults to the default storage.
+        checksums (Dict[str, str], optional): The MD5 checksums of the files keyed by path relative to the local directory to put in the index.
+        **kwargs: The sizes of the chunks which are passed to `chunk_boundaries`.
+
+    Returns:
+        Dict[str, str]: The path of the index (relative to the base path) for the path of each file.
+    """
+    if storage is None:
+        storage = default_storage
+    local_dir = Path(local_dir)
+    checksums = checksums or {}
+
+    try:
+        _, existing = storage.listdir(str(objects_path(base)))
+        existing = set(existing)
+    except FileNotFoundError:
+        existing = set()
+
+    files = []
+    for local_path in sorted(Path(path) for path in paths):
+        if local_path.is_dir():
+            continue
+
+        chunks = []
+        uploaded = 0
+        for data in iter_chunks(local_path, **kwargs):
+            digest = hashlib.sha256(data).hexdigest()
+            if digest not in existing:
+                storage._save(str(objects_path(base)/digest), ContentFile(data, name=digest))
+                existing.add(digest)
+                uploaded += len(data)
+            chunks.append(dict(hash=digest, size=len(data)))
+
+        relative_path = local_path.relative_to(local_dir)
+        size = sum(chunk["size"] for chunk in chunks)
+        print(f"Copied '{local_path}' to storage in {len(chunks)} chunks with {uploaded} of {size} bytes uploaded")
+        files.append(dict(path=relative_path.as_posix(), size=size, md5=checksums.get(str(relative_path), ""), chunks=chunks))
+
+    if not files:
+        return {}
+
+    # The names start with the time so that the most recent index is read last
+    index_id = f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    index_name = (storages.CHUNKS_DIRECTORY/f"{index_id}.json").as_posix()
+    index = dict(created=datetime.datetime.utcnow().isoformat(), files=files)
+    with tempfile.TemporaryFile() as f:
+        f.write(json.dumps(index, indent=4).encode("utf-8"))
+        f.seek(0)
+        storage._save(str(Path(base, index_name)), File(f, name=f"{index_id}.json"))
+
+    return {file["path"]: index_name for file in files}
+
+
+def reassemble_from_storage(
+    base = "/",
+    local_dir: Path = ".",
+    storage = None,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+    files: Optional[Dict[str, Dict]] = None,
+) -> List[str]:
+    """
+    Rebuilds the files which were copied to storage as chunks for a dataset.
+
+    Only the most recently chunked version of each file is rebuilt.
+    Use `files` with the chunked files from `crunch.django.app.storages.copy_recursive_from_storage`
+    to only rebuild the files which have not been uploaded again in another way since they were chunked.
+
+    Args:
+        base (Union[str,Path], optional): The base path of the dataset in storage. Defaults to "/".
+        local_dir (Path, optional): The local directory to write the files in. Defaults to ".".
+        storage (optional): The storage with the chunks. Defaults to the default storage.
+        include (Iterable[str], optional): Glob patterns for the paths of the files to rebuild. If not given then all files are rebuilt.
+        exclude (Iterable[str], optional): Glob patterns for the paths of files or directories not to rebuild.
+        files (Dict[str, Dict], optional): The entries from the indexes of the files to rebuild keyed by path.
+            Defaults to the most recent entry for each file in the indexes of the chunks of the dataset.
+
+    Raises:
+        ChunkingException: If a file is outside the local directory or a chunk does not have the SHA256 hash and size given in the index.
+
+    Returns:
+        List[str]: The paths relative to the local directory of the rebuilt files.
+    """
+    if storage is None:
+        storage = default_storage
+    local_dir = Path(local_dir)
+
+    if files is None:
+        files = storages.chunked_files(base, storage=storage)
+
+    rebuilt = []
+    for path, entry in sorted(files.items()):
+        if not storages.path_included(path, include, exclude):
+            continue
+
+        relative_path = PurePosixPath(path)
+        if relative_path.is_absolute() or ".." in relative_path.parts:
+            raise ChunkingException(f"Cannot write '{path}' from '{entry['shard']}' outside of '{local_dir}'.")
+
+        print(f"Rebuilding '{path}' from {len(entry['chunks'])} chunks in storage")
+        local_path = local_dir/relative_path
+        local_path.parent.mkdir(exist_ok=True, parents=True)
+        with open(local_path, "wb") as target:
+            for chunk in entry["chunks"]:
+                with storage.open(str(objects_path(base)/chunk["hash"]), "rb") as source:
+                    data = source.read()
+                if len(data) != chunk["size"] or hashlib.sha256(data).hexdigest() != chunk["hash"]:
+                    raise ChunkingException(f"The chunk '{chunk['hash']}' of '{path}' in storage does not match its hash and size.")
+                target.write(data)
+        rebuilt.append(path)
+
+    return rebuilt
@@ -0,0 +1,95 @@
+import gzip
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+from django.utils.text import compress_sequence
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DEFAULT_MIN_SIZE = 1024
+# Only the content types of the API are compressed.
+# HTML pages (and other text) may contain CSRF tokens next to content from the request which BREACH attacks can recover from compressed responses
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/geo+json",
+    "application/msgpack",
+    "application/x-ndjson",
+)
+
+re_accepts_gzip = _lazy_re_compile(r"\bgzip\b")
+re_accepts_brotli = _lazy_re_compile(r"\bbr\b")
+
+
+def compress_gzip(content: bytes) -> bytes:
+    # A fixed mtime keeps the output deterministic for the same content
+    return gzip.compress(content, compresslevel=6, mtime=0)
+
+
+def compress_brotli(content: bytes) -> bytes:
+    # A medium quality gives most of the size reduction at a fraction of the time of the maximum quality
+    return brotli.compress(content, quality=5)
+
+
+class CompressionMiddleware():
+    """
+    Compresses responses with brotli or gzip if the client accepts it and the response is big enough to be worth it.
+
+    Brotli is used if the client accepts it and the 'brotli' package is installed, otherwise gzip is used.
+    Only responses of at least `CRUNCH_COMPRESSION_MIN_SIZE` bytes (default 1024) with one of the content types of the API
+    (see `COMPRESSIBLE_TYPES`) are compressed. HTML pages are never compressed so that their CSRF tokens are not exposed to BREACH attacks.
+    Streaming responses are compressed with gzip as they are sent.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = getattr(settings, "CRUNCH_COMPRESSION_MIN_SIZE", DEFAULT_MIN_SIZE)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    def process_response(self, request, response):
+        if response.has_header("Content-Encoding"):
+            return response
+
+        content_type = response.get("Content-Type", "")
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return response
+
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+
+        # The response depends on Accept-Encoding even if it is not compressed for this request
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        accept_encoding = request.META.get("HTTP_ACCEPT_ENCODING", "")
+        if response.streaming:
+            if not re_accepts_gzip.search(accept_encoding):
+                return response
+            response.streaming_content = compress_sequence(response.streaming_content)
+            del response["Content-Length"]
+            encoding = "gzip"
+        else:
+            if brotli and re_accepts_brotli.search(accept_encoding):
+                compressed, encoding = compress_brotli(response.content), "br"
+            elif re_accepts_gzip.search(accept_encoding):
+                compressed, encoding = compress_gzip(response.content), "gzip"
+            else:
+                return response
+
+            # Return the original content if compressing does not make it smaller
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response["Content-Length"] = str(len(response.content))
+
+        # A strong ETag would claim that the compressed content is byte-for-byte identical to the original
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+
+        response["Content-Encoding"] = encoding
+        return response
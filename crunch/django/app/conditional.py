@@ -0,0 +1,75 @@
+import hashlib
+from datetime import datetime
+from typing import List, Optional, Tuple
+from django.db.models import Count, Max, QuerySet
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+class ConditionalRetrieveMixin():
+    """
+    Adds ETag and Last-Modified headers to the detail responses of a viewset
+    and responds with '304 Not Modified' when a client already has the current version.
+
+    The validators are calculated from the latest `modified` timestamp and the number of rows in each of the querysets
+    given by `get_validator_querysets` so the object does not need to be serialized to check whether it has changed.
+    """
+    def get_validator_querysets(self, lookup_value: str) -> List[QuerySet]:
+        """
+        Returns the querysets for all the rows which are included in the detail response for an object.
+
+        The first queryset must be for the object itself.
+        By default this is only the object from the queryset of the viewset.
+        Viewsets whose detail responses include related rows (e.g. nested attributes) should add querysets for them
+        so that the validators change when those rows change.
+
+        Args:
+            lookup_value (str): The value of the lookup field for the object from the URL.
+
+        Returns:
+            List[QuerySet]: The querysets with a `modified` field.
+        """
+        return [self.get_queryset().filter(**{self.lookup_field: lookup_value})]
+
+    def get_validators(self, request) -> Optional[Tuple[str, datetime]]:
+        """
+        Calculates the ETag and the last modified time for the object requested.
+
+        Args:
+            request: The request for the object.
+
+        Returns:
+            Optional[Tuple[str, datetime]]: The ETag (unquoted) and the last modified time or None if the object cannot be found.
+        """
+        lookup_value = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+
+        # The representation also depends on the query string (e.g. '?format=json') and the accepted media types
+        parts = [request.get_full_path(), request.META.get("HTTP_ACCEPT", "")]
+        last_modified = None
+        for index, queryset in enumerate(self.get_validator_querysets(lookup_value)):
+            aggregate = queryset.order_by().aggregate(latest=Max("modified"), count=Count("pk"))
+            if index == 0 and not aggregate["count"]:
+                return None
+            if aggregate["latest"] and (last_modified is None or aggregate["latest"] > last_modified):
+                last_modified = aggregate["latest"]
+            parts.append(f"{aggregate['count']}:{aggregate['latest'].isoformat() if aggregate['latest'] else ''}")
+
+        etag = hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+        return etag, last_modified
+
+    def retrieve(self, request, *args, **kwargs):
+        validators = self.get_validators(request)
+        if validators is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        etag, last_modified = validators
+        etag = quote_etag(etag)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+
+        response["ETag"] = etag
+        if timestamp is not None:
+            response["Last-Modified"] = http_date(timestamp)
+        return response
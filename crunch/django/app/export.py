@@ -0,0 +1,118 @@
+import json
+from itertools import islice
+from typing import Dict, Iterator, List, Type
+from django.contrib.contenttypes.models import ContentType
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Item, Attribute
+
+
+ITEM_FIELDS = ("id", "name", "slug", "parent__slug", "description", "details", "polymorphic_ctype_id", "dataset__base_file_path")
+
+
+def attribute_models() -> List[Type[Attribute]]:
+    """ Returns all the concrete subclasses of Attribute. """
+    subclasses = []
+    stack = list(Attribute.__subclasses__())
+    while stack:
+        subclass = stack.pop(0)
+        stack.extend(subclass.__subclasses__())
+        if not subclass._meta.abstract and not subclass._meta.proxy:
+            subclasses.append(subclass)
+    return subclasses
+
+
+def attribute_value_fields(model: Type[Attribute]) -> List[str]:
+    """ Returns the names of the fields which hold the value of an attribute model (e.g. 'value' or 'latitude' and 'longitude'). """
+    return [
+        field.name
+        for field in model._meta.get_fields(include_parents=False)
+        if field.concrete and not field.auto_created and not field.remote_field and field.editable
+    ]
+
+
+def chunk_attributes(tree_id: int, lft_min: int, lft_max: int) -> Dict[int, List[Dict]]:
+    """
+    Fetches the attributes for all the items in a contiguous section of a tree.
+
+    There is one query for each attribute type which only retrieves the values needed for the export
+    rather than instantiating polymorphic attribute objects.
+
+    Args:
+        tree_id (int): The tree of the items.
+        lft_min (int): The smallest `lft` value of the items in the section of the tree.
+        lft_max (int): The largest `lft` value of the items in the section of the tree.
+
+    Returns:
+        Dict[int, List[Dict]]: The attributes for each item keyed by the item's primary key.
+    """
+    attributes = {}
+    for model in attribute_models():
+        value_fields = attribute_value_fields(model)
+        attribute_type = model._meta.model_name
+        rows = model.objects.non_polymorphic().filter(
+            item__tree_id=tree_id, item__lft__gte=lft_min, item__lft__lte=lft_max,
+        ).order_by("pk").values_list("item_id", "key", *value_fields)
+        for item_id, key, *values in rows:
+            attribute = dict(type=attribute_type, key=key)
+            attribute.update(zip(value_fields, values))
+            attributes.setdefault(item_id, []).append(attribute)
+    return attributes
+
+
+def export_project(project: Item, chunk_size: int = 1000) -> Iterator[Dict]:
+    """
+    Iterates over the project, its datasets and their items in tree order with all of their attributes.
+
+    The items are read with a server-side cursor where the database supports it
+    and the attributes are fetched for each chunk of items so the memory used does not depend on the size of the project.
+
+    Args:
+        project (Item): The project to export.
+        chunk_size (int, optional): The number of items to process at a time. Defaults to 1000.
+
+    Yields:
+        Iterator[Dict]: A dictionary for each item in the project.
+    """
+    rows = (
+        Item.objects.non_polymorphic()
+        .filter(tree_id=project.tree_id, lft__gte=project.lft, rght__lte=project.rght)
+        .order_by("lft")
+        .values_list("lft", *ITEM_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        attributes = chunk_attributes(project.tree_id, chunk[0][0], chunk[-1][0])
+        for _, pk, name, slug, parent, description, details, ctype_id, base_file_path in chunk:
+            data = dict(
+                type=ContentType.objects.get_for_id(ctype_id).model,
+                id=pk,
+                name=name,
+                slug=slug,
+                parent=parent,
+                description=description,
+                details=details,
+                attributes=attributes.get(pk, []),
+            )
+            if base_file_path is not None:
+                data["base_file_path"] = base_file_path
+            yield data
+
+
+def export_project_ndjson(project: Item, chunk_size: int = 1000) -> Iterator[str]:
+    """
+    Iterates over the lines of newline-delimited JSON for a project.
+
+    Args:
+        project (Item): The project to export.
+        chunk_size (int, optional): The number of items to process at a time. Defaults to 1000.
+
+    Yields:
+        Iterator[str]: A line of JSON (ending with a newline) for each item in the project.
+    """
+    for data in export_project(project, chunk_size=chunk_size):
+        yield json.dumps(data, cls=JSONEncoder, separators=(",", ":")) + "\n"
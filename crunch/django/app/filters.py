@@ -0,0 +1,119 @@
+from typing import Dict, List, Tuple, Type
+from django.core.exceptions import ValidationError
+from django.db.models import Exists, OuterRef, QuerySet
+
+from .models import Attribute
+from .export import attribute_models, attribute_value_fields
+from .analytics import attribute_type_name
+
+
+LOOKUPS = (
+    "exact",
+    "iexact",
+    "contains",
+    "icontains",
+    "startswith",
+    "istartswith",
+    "endswith",
+    "iendswith",
+    "gt",
+    "gte",
+    "lt",
+    "lte",
+    "in",
+)
+
+
+class AttributeFilterException(Exception):
+    """ Raised when an attribute filter cannot be understood. """
+    pass
+
+
+def attribute_filter_models() -> Dict[str, Type[Attribute]]:
+    """ Returns the attribute models which can be filtered on keyed by their short type name, e.g. 'float' for FloatAttribute. """
+    return {attribute_type_name(model): model for model in attribute_models()}
+
+
+def parse_attribute_filter(name: str, value: str) -> Tuple[Type[Attribute], str, str, str, object]:
+    """
+    Parses a filter on a typed attribute given as a query parameter.
+
+    The name of the parameter is in the form '<type>:<key>[__<field>][__<lookup>]'
+    so that '?float:quality__gt=0.9' matches items with a FloatAttribute with the key 'quality' and a value greater than 0.9.
+    The field is only needed for types of attributes with more than one value field (e.g. 'latlong:site__latitude__lt=0').
+
+    Args:
+        name (str): The name of the query parameter.
+        value (str): The value of the query parameter. For the 'in' lookup this is a comma-separated list of values.
+
+    Raises:
+        AttributeFilterException: If the type, field, lookup or value is not valid.
+
+    Returns:
+        Tuple[Type[Attribute], str, str, str, object]: The attribute model, the key, the value field, the lookup and the value converted to the type of the field.
+    """
+    type_name, _, path = name.partition(":")
+    models = attribute_filter_models()
+    if type_name not in models:
+        raise AttributeFilterException(
+            f"Unknown attribute type '{type_name}'. The types available are: {', '.join(sorted(models))}."
+        )
+    model = models[type_name]
+
+    parts = path.split("__")
+    lookup = "exact"
+    if len(parts) > 1 and parts[-1] in LOOKUPS:
+        lookup = parts.pop()
+
+    value_fields = attribute_value_fields(model)
+    if value_fields == ["value"]:
+        field_name = "value"
+    elif len(parts) > 1 and parts[-1] in value_fields:
+        field_name = parts.pop()
+    else:
+        raise AttributeFilterException(
+            f"Filters on '{type_name}' attributes need one of the fields: {', '.join(value_fields)} (e.g. '{type_name}:key__{value_fields[0]}')."
+        )
+
+    key = "__".join(parts)
+    if not key:
+        raise AttributeFilterException(f"No attribute key given in '{name}'.")
+
+    form_field = model._meta.get_field(field_name).formfield()
+    try:
+        if lookup == "in":
+            converted = [form_field.to_python(element) for element in value.split(",")]
+        else:
+            converted = form_field.to_python(value)
+    except ValidationError as err:
+        raise AttributeFilterException(f"Invalid value '{value}' for '{name}': {' '.join(err.messages)}")
+
+    return model, key, field_name, lookup, converted
+
+
+def filter_by_attributes(queryset: QuerySet, filters: List[Tuple[str, str]]) -> QuerySet:
+    """
+    Filters a queryset of items to the ones which have attributes which match all of the filters.
+
+    Each filter becomes an EXISTS subquery on the table for that type of attribute
+    which can use the index on the key and item of the attribute and the index on the value of the typed attribute.
+
+    Args:
+        queryset (QuerySet): The queryset of items.
+        filters (List[Tuple[str, str]]): The names and values of the filters as described in `parse_attribute_filter`.
+
+    Raises:
+        AttributeFilterException: If any of the filters is not valid.
+
+    Returns:
+        QuerySet: The filtered queryset.
+    """
+    for name, value in filters:
+        model, key, field_name, lookup, converted = parse_attribute_filter(name, value)
+        matches = model.objects.non_polymorphic().filter(
+            item=OuterRef("pk"),
+            key=key,
+            **{f"{field_name}__{lookup}": converted},
+        )
+        queryset = queryset.filter(Exists(matches))
+    return queryset
@@ -0,0 +1,47 @@
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_PRECISION = 12
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = MAX_PRECISION) -> str:
+    """
+    Encodes a location as a geohash.
+
+    Locations which are close together share a common prefix so the geohashes can be used as a grid index
+    where the cells at each precision are the prefixes of that length.
+
+    Args:
+        latitude (float): The latitude in decimal degrees.
+        longitude (float): The longitude in decimal degrees.
+        precision (int, optional): The number of characters in the geohash. Defaults to 12 (a cell of a few centimetres).
+
+    Returns:
+        str: The geohash.
+    """
+    latitude_range = [-90.0, 90.0]
+    longitude_range = [-180.0, 180.0]
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        # The bits alternate between longitude and latitude, starting with longitude
+        interval, value = (longitude_range, longitude) if even else (latitude_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
@@ -0,0 +1,194 @@
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import ExitStack
+from typing import Dict, List, Tuple
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_current_metrics = contextvars.ContextVar("crunch_request_metrics", default=None)
+
+
+class RequestMetrics():
+    """
+    Records the SQL queries, database time and serializer time for a single request.
+    """
+    __slots__ = ("queries", "db_time", "serializer_time", "serializer_depth")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """ Used as a database execute wrapper to count and time each query. """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+    def server_timing(self, total: float) -> str:
+        """
+        Returns the value for a Server-Timing header for these metrics.
+
+        Args:
+            total (float): The total time for the request in seconds.
+
+        Returns:
+            str: The header value with durations in milliseconds.
+        """
+        return (
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries", '
+            f"serializer;dur={self.serializer_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+
+def current_metrics() -> RequestMetrics:
+    """ Returns the metrics for the request currently being processed or None if it is not being instrumented. """
+    return _current_metrics.get()
+
+
+class Histogram():
+    """
+    A cumulative histogram with fixed buckets in the style of Prometheus.
+    """
+    def __init__(self, buckets: Tuple[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """ Returns a list of the upper bound of each bucket (as a string) with the cumulative count. """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((f"{bound:g}", total))
+        result.append(("+Inf", total + self.counts[-1]))
+        return result
+
+
+class MetricsRegistry():
+    """
+    An in-process registry of histograms of request metrics for each view.
+    """
+    metrics = {
+        "crunch_request_duration_seconds": ("The total time taken to respond to a request.", LATENCY_BUCKETS),
+        "crunch_db_duration_seconds": ("The time spent in the database for a request.", LATENCY_BUCKETS),
+        "crunch_serializer_duration_seconds": ("The time spent serializing data for a request.", LATENCY_BUCKETS),
+        "crunch_db_queries": ("The number of SQL queries for a request.", QUERY_BUCKETS),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+
+    def histogram(self, metric: str, view: str) -> Histogram:
+        key = (metric, view)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(self.metrics[metric][1])
+        return self.histograms[key]
+
+    def observe(self, view: str, metrics: RequestMetrics, total: float):
+        with self.lock:
+            self.histogram("crunch_request_duration_seconds", view).observe(total)
+            self.histogram("crunch_db_duration_seconds", view).observe(metrics.db_time)
+            self.histogram("crunch_serializer_duration_seconds", view).observe(metrics.serializer_time)
+            self.histogram("crunch_db_queries", view).observe(metrics.queries)
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+
+    def render(self) -> str:
+        """ Renders all the histograms in the Prometheus text exposition format. """
+        lines = []
+        with self.lock:
+            for metric, (help_text, _) in self.metrics.items():
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (name, view), histogram in sorted(self.histograms.items()):
+                    if name != metric:
+                        continue
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f'{metric}_bucket{{view="{view}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_sum{{view="{view}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{view="{view}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class InstrumentationMiddleware():
+    """
+    Records the number of SQL queries, the database time, the serializer time and the total latency of each request.
+
+    The results are added to the response in a Server-Timing header and are collected in histograms for each view
+    which are available in the Prometheus format at /api/metrics/.
+
+    Wrapping every database query has a small cost so this middleware is only used if the ``CRUNCH_INSTRUMENTATION`` setting is True.
+
+    The timings of streaming responses (e.g. from ``DatasetFilesView``) only cover the work done before the response is returned.
+    The content is generated (and the queries for it are run) as it is sent, after the middleware has finished, so it is not included.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, "CRUNCH_INSTRUMENTATION", False):
+            raise MiddlewareNotUsed("Set CRUNCH_INSTRUMENTATION to True to record metrics for each request.")
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        total = time.perf_counter() - start
+
+        resolver_match = getattr(request, "resolver_match", None)
+        view = resolver_match.view_name if resolver_match else "unresolved"
+        registry.observe(view, metrics, total)
+
+        response["Server-Timing"] = metrics.server_timing(total)
+        return response
+
+
+class InstrumentedSerializerMixin():
+    """
+    A mixin for DRF serializers which records the time taken to serialize objects for the current request.
+
+    Only the outermost serializer is timed so that nested serializers are not counted twice.
+    """
+    def to_representation(self, instance):
+        metrics = current_metrics()
+        if metrics is None or metrics.serializer_depth:
+            return super().to_representation(instance)
+
+        metrics.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializer_time += time.perf_counter() - start
+            metrics.serializer_depth -= 1
@@ -1,28 +1,292 @@
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
 import pydeck
 import pandas as pd
+from django.apps import apps
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Avg, Count, Q, QuerySet
+from django.db.models.functions import Substr
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.urls import reverse
 
+from .geohash import encode_geohash
+from .models import Item, Project, Dataset, LatLongAttribute
 
-def item_map(item):
-    geo_attributes = item.descendant_latlongattributes()
-
-    plot_data = [
-        dict(
-            latitude=float(attribute.latitude),
-            longitude=float(attribute.longitude),
-            item=str(attribute.item),
-            url=str(attribute.item.get_absolute_url()),
-        )
-        for attribute in geo_attributes
+
+# ICON_URL = "https://upload.wikimedia.org/wikipedia/commons/9/92/Ic_location_on_48px.svg"
+# ICON_WIDTH = 48
+# ICON_HEIGHT = 48
+
+ICON_URL = "https://upload.wikimedia.org/wikipedia/commons/6/65/OOjs_UI_icon_mapPin-progressive.svg"
+ICON_WIDTH = 20
+ICON_HEIGHT = 20
+
+MAP_CACHE_TIMEOUT = 60 * 60 * 24
+
+# The length of the geohash prefix used to cluster locations at each zoom level (the index is the zoom level)
+ZOOM_PRECISIONS = (1, 1, 2, 2, 2, 3, 3, 4, 4, 4, 5, 5, 6, 6, 6, 7, 7, 8, 8, 9)
+# The zoom level at which locations are never clustered
+RAW_ZOOM = 16
+# The number of locations in a viewport which are shown individually rather than clustered
+MAX_POINTS = 1000
+# The number of locations above which the embedded map shows clusters rather than each location
+MAP_POINT_LIMIT = 10000
+MAP_CLUSTER_PRECISION = 4
+# The zoom level of the initial view of a map with a single location (or locations very close together)
+MAX_INITIAL_ZOOM = 12
+SLUG_PLACEHOLDER = "__slug__"
+PARENT_PLACEHOLDER = "__parent__"
+
+
+def map_cache_key(item_id: int) -> str:
+    return f"crunch:item-map:{item_id}"
+
+
+def item_url_templates() -> Dict[int, str]:
+    """
+    Returns the URL for each type of item (keyed by content type ID) with placeholders for the slugs of the item and its parent.
+    """
+    return {
+        ContentType.objects.get_for_model(Project).id: reverse("crunch:project-detail", kwargs={"slug": SLUG_PLACEHOLDER}),
+        ContentType.objects.get_for_model(Dataset).id: (
+            reverse("crunch:project-detail", kwargs={"slug": PARENT_PLACEHOLDER}) + f"datasets/{SLUG_PLACEHOLDER}"
+        ),
+    }
+
+
+class MapException(Exception):
+    """ Raised when the parameters for a map are not valid. """
+    pass
+
+
+def subtree_locations(item: Item) -> QuerySet:
+    """ Returns a queryset of the LatLongAttributes of an item and all its descendants. """
+    return LatLongAttribute.objects.non_polymorphic().filter(
+        item__tree_id=item.tree_id, item__lft__gte=item.lft, item__rght__lte=item.rght
+    )
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    """
+    Parses a bounding box given as 'west,south,east,north' in decimal degrees.
+
+    The west edge can be greater than the east edge for a bounding box which crosses the antimeridian.
+
+    Raises:
+        MapException: If the bounding box is not valid.
+    """
+    try:
+        west, south, east, north = [float(part) for part in value.split(",")]
+    except ValueError:
+        raise MapException(f"The bounding box '{value}' should be four numbers: west,south,east,north.")
+
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180) or not (-180 <= east <= 180):
+        raise MapException(f"The bounding box '{value}' is outside the range of latitudes and longitudes.")
+
+    return west, south, east, north
+
+
+def bounded_locations(queryset: QuerySet, bbox: Optional[Tuple[float, float, float, float]]) -> QuerySet:
+    """ Filters a queryset of LatLongAttributes to the ones inside a bounding box (if given). """
+    if bbox is None:
+        return queryset
+
+    west, south, east, north = bbox
+    queryset = queryset.filter(latitude__gte=south, latitude__lte=north)
+    if west <= east:
+        return queryset.filter(longitude__gte=west, longitude__lte=east)
+    return queryset.filter(Q(longitude__gte=west) | Q(longitude__lte=east))
+
+
+def zoom_precision(zoom: int) -> int:
+    """ Returns the length of the geohash prefix used to cluster locations at a zoom level of the map. """
+    return ZOOM_PRECISIONS[min(max(int(zoom), 0), len(ZOOM_PRECISIONS) - 1)]
+
+
+def location_clusters(queryset: QuerySet, precision: int) -> List[Dict]:
+    """
+    Groups LatLongAttributes into the cells of a geohash grid with a single aggregate query.
+
+    Args:
+        queryset (QuerySet): The LatLongAttributes.
+        precision (int): The length of the geohash prefix for the cells.
+
+    Returns:
+        List[Dict]: The 'geohash' of each cell with the 'count' of locations in it and their mean 'latitude' and 'longitude'.
+    """
+    rows = (
+        queryset.order_by()
+        .annotate(cell=Substr("geohash", 1, precision))
+        .values("cell")
+        .annotate(count=Count("pk"), mean_latitude=Avg("latitude"), mean_longitude=Avg("longitude"))
+        .order_by("cell")
+    )
+    return [
+        dict(geohash=row["cell"], count=row["count"], latitude=float(row["mean_latitude"]), longitude=float(row["mean_longitude"]))
+        for row in rows
     ]
-    df = pd.DataFrame(plot_data)
 
-    # ICON_URL = "https://upload.wikimedia.org/wikipedia/commons/9/92/Ic_location_on_48px.svg"
-    # ICON_WIDTH = 48
-    # ICON_HEIGHT = 48
 
-    ICON_URL = "https://upload.wikimedia.org/wikipedia/commons/6/65/OOjs_UI_icon_mapPin-progressive.svg"
-    ICON_WIDTH = 20
-    ICON_HEIGHT = 20
+def locations_frame(queryset: QuerySet) -> pd.DataFrame:
+    """
+    Retrieves the locations for a queryset of LatLongAttributes with a single query.
+
+    Args:
+        queryset (QuerySet): The LatLongAttributes.
+
+    Returns:
+        pd.DataFrame: A dataframe with the 'latitude' and 'longitude' of each location
+            and the name ('item') and URL ('url') of the item with the location.
+    """
+    rows = queryset.order_by("item__lft", "pk").values_list(
+        "latitude", "longitude", "item__name", "item__slug", "item__parent__slug", "item__polymorphic_ctype_id"
+    )
+    df = pd.DataFrame.from_records(
+        list(rows), columns=["latitude", "longitude", "item", "slug", "parent_slug", "polymorphic_ctype_id"]
+    )
+    df["latitude"] = df["latitude"].astype(float)
+    df["longitude"] = df["longitude"].astype(float)
+
+    # The URLs are filled in from a template for each type of item rather than calling get_absolute_url on each item
+    default_template = reverse("crunch:item-detail", kwargs={"slug": SLUG_PLACEHOLDER})
+    templates = df["polymorphic_ctype_id"].map(item_url_templates()).fillna(default_template)
+    df["url"] = pd.Series(
+        [
+            template.replace(PARENT_PLACEHOLDER, parent_slug or "").replace(SLUG_PLACEHOLDER, slug)
+            for template, slug, parent_slug in zip(templates, df["slug"], df["parent_slug"])
+        ],
+        index=df.index,
+        dtype="object",
+    )
+    return df[["latitude", "longitude", "item", "url"]]
+
+
+def item_locations(item: Item) -> pd.DataFrame:
+    """
+    Retrieves the locations of all the LatLongAttributes of an item and its descendants with a single query.
+
+    Args:
+        item (Item): The item with the locations.
+
+    Returns:
+        pd.DataFrame: A dataframe with the 'latitude' and 'longitude' of each location
+            and the name ('item') and URL ('url') of the item with the location.
+    """
+    return locations_frame(subtree_locations(item))
+
+
+def points_geojson(df: pd.DataFrame) -> dict:
+    """ Creates a GeoJSON FeatureCollection with a point for each location in a dataframe from `locations_frame`. """
+    return dict(
+        type="FeatureCollection",
+        features=[
+            dict(
+                type="Feature",
+                geometry=dict(type="Point", coordinates=[longitude, latitude]),
+                properties=dict(item=name, url=url),
+            )
+            for latitude, longitude, name, url in df.itertuples(index=False, name=None)
+        ],
+    )
+
+
+def viewport_geojson(item: Item, bbox: Optional[Tuple[float, float, float, float]] = None, zoom: int = 0, max_points: int = MAX_POINTS) -> dict:
+    """
+    Creates a GeoJSON FeatureCollection of the locations of an item and its descendants which are visible in a map viewport.
+
+    If there are more than `max_points` locations in the viewport and the map is not zoomed in to at least `RAW_ZOOM`
+    then the locations are clustered into the cells of a geohash grid which gets finer as the map zooms in.
+    Each cluster is a point at the mean location in its cell with the properties 'cluster' (true), 'count' and 'geohash'.
+
+    Args:
+        item (Item): The item with the locations.
+        bbox (Optional[Tuple[float, float, float, float]], optional): The west, south, east and north edges of the viewport. Defaults to the whole world.
+        zoom (int, optional): The zoom level of the map. Defaults to 0.
+        max_points (int, optional): The number of locations which are shown without clustering. Defaults to MAX_POINTS.
+
+    Returns:
+        dict: The GeoJSON FeatureCollection.
+    """
+    queryset = bounded_locations(subtree_locations(item), bbox)
+    if zoom >= RAW_ZOOM or queryset.order_by()[:max_points + 1].count() <= max_points:
+        return points_geojson(locations_frame(queryset))
+
+    return dict(
+        type="FeatureCollection",
+        features=[
+            dict(
+                type="Feature",
+                geometry=dict(type="Point", coordinates=[cluster["longitude"], cluster["latitude"]]),
+                properties=dict(cluster=True, count=cluster["count"], geohash=cluster["geohash"]),
+            )
+            for cluster in location_clusters(queryset, zoom_precision(zoom))
+        ],
+    )
+
+
+def item_geojson(item: Item) -> dict:
+    """
+    Creates a GeoJSON FeatureCollection with a point for each location of an item and its descendants.
+
+    Args:
+        item (Item): The item with the locations.
+
+    Returns:
+        dict: The GeoJSON FeatureCollection.
+    """
+    return points_geojson(item_locations(item))
+
+
+def extent_zoom(df: pd.DataFrame) -> int:
+    """
+    Finds the zoom level at which all the locations in a dataframe with latitude and longitude columns fit on the initial view of a map.
+
+    At zoom level zero the whole world (360 degrees of longitude) is shown and each zoom level halves the extent.
+    """
+    longitude_span = float(df["longitude"].max() - df["longitude"].min())
+    latitude_span = float(df["latitude"].max() - df["latitude"].min())
+    zoom = MAX_INITIAL_ZOOM
+    if longitude_span > 0:
+        zoom = min(zoom, math.log2(360 / longitude_span))
+    if latitude_span > 0:
+        zoom = min(zoom, math.log2(180 / latitude_span))
+    return max(1, math.floor(zoom))
+
+
+def cluster_layer(item: Item) -> Tuple[pydeck.Layer, pd.DataFrame]:
+    """ Creates a layer with a circle for each cell of a coarse geohash grid sized by the number of locations in it. """
+    df = pd.DataFrame(location_clusters(subtree_locations(item), MAP_CLUSTER_PRECISION))
+    df["radius"] = df["count"].map(math.sqrt)
+    layer = pydeck.Layer(
+        "ScatterplotLayer",
+        df,
+        pickable=True,
+        get_position=["longitude", "latitude"],
+        get_radius="radius",
+        radius_units="pixels",
+        radius_min_pixels=3,
+        radius_max_pixels=40,
+        get_fill_color=[51, 102, 204, 160],
+    )
+    return layer, df
+
+
+def item_map(item):
+    # Very large numbers of locations are clustered so that the page stays small enough for the browser
+    if subtree_locations(item).count() > MAP_POINT_LIMIT:
+        layer, df = cluster_layer(item)
+        return pydeck.Deck(
+            layers=[layer],
+            initial_view_state=pydeck.ViewState(latitude=df["latitude"].mean(), longitude=df["longitude"].mean(), zoom=extent_zoom(df), min_zoom=1, max_zoom=16),
+            map_style="road",
+            tooltip={"text": "{count} locations"},
+        )
+
+    df = item_locations(item)
+    if df.empty:
+        return None
 
     icon_data = {
         "url": ICON_URL,
@@ -30,10 +294,7 @@ def item_map(item):
         "height": ICON_HEIGHT,
         "anchorY": ICON_HEIGHT,
     }
-
-    df["icon_data"] = None
-    for i in df.index:
-        df.at[i, "icon_data"] = icon_data
+    df["icon_data"] = [icon_data] * len(df)
 
     layer = pydeck.Layer(
         "IconLayer",
@@ -47,7 +308,7 @@ def item_map(item):
     view_state = pydeck.ViewState(
         latitude=df["latitude"].mean(),
         longitude=df["longitude"].mean(),
-        zoom=2,
+        zoom=extent_zoom(df),
         min_zoom=1,
         max_zoom=16,
         pitch=0,
@@ -57,3 +318,133 @@ def item_map(item):
     map = pydeck.Deck(layers=[layer], initial_view_state=view_state, map_style="road")
 
     return map
+
+
+def item_map_html(item: Item) -> str:
+    """
+    Renders the map of the locations of an item and its descendants as HTML.
+
+    The HTML is cached for each item until a location or item in its subtree changes.
+    Changes which do not send ``post_save`` signals must remove the cached maps themselves (see `invalidate_subtree_maps`).
+
+    Args:
+        item (Item): The item with the locations.
+
+    Returns:
+        str: The HTML for the map.
+    """
+    key = map_cache_key(item.pk)
+    html = cache.get(key)
+    if html is None:
+        map = item_map(item)
+        html = map.to_html(as_string=True) if map else "<p>No map available</p>"
+        cache.set(key, html, MAP_CACHE_TIMEOUT)
+    return html
+
+
+def rebuild_geohashes(batch_size: int = 1000) -> int:
+    """
+    Recalculates the geohashes of all the locations which are missing or out of date.
+
+    The geohash of a location is set when it is saved but ``QuerySet.update`` does not call ``save``
+    (and Django does not allow ``bulk_create`` for locations because they use multi-table inheritance)
+    so locations moved with an update or written outside of the ORM need their geohashes rebuilt
+    (e.g. with the ``rebuild-geohashes`` management command).
+    The cached maps of the items with changed locations are removed.
+
+    Args:
+        batch_size (int, optional): The number of locations to update in each query. Defaults to 1000.
+
+    Returns:
+        int: The number of locations with a changed geohash.
+    """
+    changed = []
+    item_ids = set()
+    locations = (
+        LatLongAttribute.objects.non_polymorphic()
+        .order_by("pk")
+        .values_list("pk", "item_id", "latitude", "longitude", "geohash")
+        .iterator(chunk_size=batch_size)
+    )
+    for pk, item_id, latitude, longitude, geohash in locations:
+        new_geohash = encode_geohash(latitude, longitude)
+        if new_geohash != geohash:
+            changed.append(LatLongAttribute(pk=pk, geohash=new_geohash))
+            item_ids.add(item_id)
+
+    LatLongAttribute.objects.bulk_update(changed, ["geohash"], batch_size=batch_size)
+    invalidate_item_maps(item_ids)
+    return len(changed)
+
+
+def invalidate_item_maps(item_ids: Iterable[int]):
+    """
+    Removes the cached maps of items and all of their ancestors.
+
+    Args:
+        item_ids (Iterable[int]): The primary keys of the items.
+    """
+    item_ids = [item_id for item_id in item_ids if item_id is not None]
+    if not item_ids:
+        return
+
+    ancestor_ids = set()
+    for tree_id, lft, rght in Item.objects.non_polymorphic().filter(pk__in=item_ids).values_list("tree_id", "lft", "rght"):
+        ancestor_ids.update(
+            Item.objects.non_polymorphic()
+            .filter(tree_id=tree_id, lft__lte=lft, rght__gte=rght)
+            .values_list("pk", flat=True)
+        )
+    cache.delete_many([map_cache_key(item_id) for item_id in ancestor_ids | set(item_ids)])
+
+
+@receiver(pre_save, sender=LatLongAttribute)
+def latlong_attribute_pre_save(sender, instance, raw=False, **kwargs):
+    instance._map_previous_item_id = None
+    if raw or instance.pk is None:
+        return
+    instance._map_previous_item_id = (
+        LatLongAttribute.objects.non_polymorphic().filter(pk=instance.pk).values_list("item_id", flat=True).first()
+    )
+
+
+@receiver(post_save, sender=LatLongAttribute)
+def latlong_attribute_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_item_maps({instance.item_id, getattr(instance, "_map_previous_item_id", None)})
+
+
+@receiver(post_delete, sender=LatLongAttribute)
+def latlong_attribute_post_delete(sender, instance, **kwargs):
+    invalidate_item_maps([instance.item_id])
+
+
+def invalidate_subtree_maps(item: Item):
+    """
+    Removes the cached maps of an item, all of its ancestors and all of its descendants.
+
+    This is needed after bulk changes to a subtree which do not send ``post_save`` signals
+    (e.g. ``bulk_update`` or ``QuerySet.update``) such as in `Item.reslugify_descendants`.
+    """
+    item_ids = (
+        Item.objects.non_polymorphic()
+        .filter(tree_id=item.tree_id)
+        .filter(Q(lft__lte=item.lft, rght__gte=item.rght) | Q(lft__gte=item.lft, rght__lte=item.rght))
+        .values_list("pk", flat=True)
+    )
+    cache.delete_many([map_cache_key(item_id) for item_id in item_ids])
+
+
+def item_post_save(sender, instance, raw=False, **kwargs):
+    # The names and URLs of items are shown on the maps of their ancestors (including the ancestors before a move)
+    if raw:
+        return
+    invalidate_item_maps([instance.pk, *(getattr(instance, "_previous_ancestor_ids", None) or [])])
+
+
+# Signals are sent with the concrete class of the instance so the receiver is connected to each type of item
+# rather than to the saves of every model
+for model in apps.get_models():
+    if issubclass(model, Item):
+        post_save.connect(item_post_save, sender=model, dispatch_uid=f"crunch-item-map-{model._meta.label_lower}")
@@ -1,14 +1,21 @@
-from operator import mod
-from typing import List
+from operator import mod, or_
+from functools import reduce
+from collections import namedtuple
+from typing import Dict, Iterable, List
 import re
+from pathlib import Path
 from typing import Type
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django_extensions.db.fields import AutoSlugField
 from django.utils.text import slugify
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.contrib.auth import get_user_model
 from django.utils.html import format_html
-from django.db.models import OuterRef, Subquery
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.functions import Cast, Concat
 from mptt.models import MPTTModel, TreeForeignKey
 import humanize
 from polymorphic.models import PolymorphicModel
@@ -18,6 +25,7 @@ from polymorphic_tree.models import PolymorphicMPTTModel, PolymorphicTreeForeign
 
 
 from . import enums, storages
+from .geohash import encode_geohash, MAX_PRECISION as MAX_GEOHASH_PRECISION
 
 User = get_user_model()
 
@@ -28,6 +36,9 @@ def OptionalCharField(max_length=255, default="", blank=True, **kwargs):
     )
 
 
+Neighbours = namedtuple("Neighbours", ["prev", "next"])
+
+
 class NextPrevMixin(models.Model):
     class Meta:
         abstract = True
@@ -38,6 +49,56 @@ class NextPrevMixin(models.Model):
     def prev_in_order(self, **kwargs):
         return prev_in_order(self, **kwargs)
 
+    def neighbour_queryset(self, prev: bool = False) -> models.QuerySet:
+        """
+        Returns a queryset of the objects after (or before) this one in the default ordering of the manager, nearest first.
+
+        This uses the same ordering as `next_in_order` and `prev_in_order` (e.g. the order in the tree for items).
+
+        Args:
+            prev (bool, optional): Whether to return the objects before this one instead of after. Defaults to False.
+
+        Returns:
+            models.QuerySet: The objects after or before this one.
+        """
+        queryset = type(self).objects.all()
+        ordering = list(queryset.query.extra_order_by or queryset.query.order_by or self._meta.ordering or [])
+        if "pk" not in ordering and "-pk" not in ordering:
+            ordering.append("pk")
+
+        conditions = []
+        previous_fields = []
+        for field in ordering:
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") != prev else "gt"
+            equal = {previous_field: getattr(self, previous_field) for previous_field in previous_fields}
+            conditions.append(Q(**equal, **{f"{name}__{lookup}": getattr(self, name)}))
+            previous_fields.append(name)
+
+        if prev:
+            ordering = [field[1:] if field.startswith("-") else f"-{field}" for field in ordering]
+
+        return queryset.filter(reduce(or_, conditions)).order_by(*ordering)
+
+    @cached_property
+    def neighbours(self) -> Neighbours:
+        """
+        The objects before and after this one in the same order as `prev_in_order` and `next_in_order`.
+
+        Both are found with a single query which uses a subquery for each that can seek on the index of the ordering
+        and the result is cached on this instance so that templates can use it as often as they need.
+
+        Returns:
+            Neighbours: A named tuple with 'prev' and 'next' which are None if there is no object before or after this one.
+        """
+        neighbour_ids = type(self).objects.filter(pk=self.pk).annotate(
+            prev_id=Subquery(self.neighbour_queryset(prev=True).values("pk")[:1]),
+            next_id=Subquery(self.neighbour_queryset().values("pk")[:1]),
+        ).values_list("prev_id", "next_id").first() or (None, None)
+
+        neighbours = type(self).objects.in_bulk([pk for pk in neighbour_ids if pk is not None])
+        return Neighbours(*[neighbours.get(pk) for pk in neighbour_ids])
+
     def get_admin_url(self):
         return reverse(
             f"admin:{self._meta.app_label}_{self._meta.model_name}_change",
@@ -75,18 +136,69 @@ class Item(NextPrevMixin, TimeStampedModel, PolymorphicMPTTModel):
     # TODO Add tags
 
     def slugify_function(self, content):
+        return self.join_slug(self.parent.slug if self.parent else None, content)
+
+    @staticmethod
+    def join_slug(parent_slug: str, content: str) -> str:
+        """
+        Creates the slug for an item from the slug of its parent and the content to be slugified (i.e. its name).
+        """
         slug = slugify(content)
-        if self.parent:
-            return f"{self.parent.slug}:{slug}"
+        if parent_slug:
+            return f"{parent_slug}:{slug}"
         return slug
 
     class Meta(PolymorphicMPTTModel.Meta):
         unique_together = ("parent", "slug")
         ordering = ('created', 'pk')
+        indexes = [models.Index(fields=["created", "id"])]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # Remember the ancestors this item had before saving so that rollups and maps can be updated if it moves.
+        # mptt updates the tree in the database before the item is saved so the old ancestors are found first
+        if not getattr(self, "_moving", False):
+            previous_parent_id = getattr(self, "_mptt_cached_fields", {}).get(self._mptt_meta.parent_attr)
+            parent_changed = self.pk is not None and previous_parent_id != self.parent_id
+            self._previous_ancestor_ids = Item.stored_ancestor_ids(self.pk, include_self=False) if parent_changed else []
+        return super().save(*args, **kwargs)
+
+    def move_to(self, target, position="first-child"):
+        # mptt moves the item in the database before it saves it so the old ancestors are found first
+        self._previous_ancestor_ids = Item.stored_ancestor_ids(self.pk, include_self=False)
+        self._moving = True
+        try:
+            return super().move_to(target, position)
+        finally:
+            self._moving = False
+
+    @staticmethod
+    def stored_ancestor_ids(item_id: int, include_self: bool = True) -> List[int]:
+        """
+        Returns the primary keys of the ancestors of an item as they are currently stored in the database.
+
+        Args:
+            item_id (int): The primary key of the item.
+            include_self (bool, optional): Whether or not to include the item itself. Defaults to True.
+
+        Returns:
+            List[int]: The primary keys of the ancestors.
+        """
+        if item_id is None:
+            return []
+
+        item = Item.objects.non_polymorphic().filter(pk=item_id)
+        ancestors = Item.objects.non_polymorphic().filter(
+            tree_id=Subquery(item.values("tree_id")[:1]),
+            lft__lte=Subquery(item.values("lft")[:1]),
+            rght__gte=Subquery(item.values("rght")[:1]),
+        )
+        if not include_self:
+            ancestors = ancestors.exclude(pk=item_id)
+        return list(ancestors.values_list("pk", flat=True))
+
     def get_absolute_url(self):
         return reverse("crunch:item-detail", kwargs={"slug": self.slug})
 
@@ -114,19 +226,18 @@ class Item(NextPrevMixin, TimeStampedModel, PolymorphicMPTTModel):
         """
         Sums all the filesize attributes for this item and its descendants.
 
+        This is read from the cached rollup for this item (see :class:`FilesizeRollup`).
+
         Returns:
             int: The total sum of the filesize attributes of this item and all its descendants. 
                 If there are no filesize attributes then it returns None.
         """
         
-        filesize_attributes = self.descendant_attributes(
-            attribute_type=FilesizeAttribute, include_self=True
-        )
-
-        if not filesize_attributes:
+        rollup = FilesizeRollup.objects.filter(item=self).values_list("total", "count").first()
+        if not rollup or not rollup[1]:
             return None
 
-        return filesize_attributes.aggregate(models.Sum("value"))["value__sum"]
+        return rollup[0]
 
     def descendant_total_filesize_readable(self) -> str:
         """
@@ -154,12 +265,111 @@ class Item(NextPrevMixin, TimeStampedModel, PolymorphicMPTTModel):
         )
 
     def has_descendant_latlongattributes(self):
-        return self.descendant_latlongattributes().count() > 0
+        return self.descendant_latlongattributes().exists()
+
+    def reslugify_descendants(self, batch_size: int = 1000) -> int:
+        """
+        Recalculates the slugs for this item and all of its descendants.
+
+        The new slugs are calculated in memory in the order of the tree so that each item uses the new slug of its parent.
+        They are written in batches with ``bulk_update`` inside a transaction rather than saving each item
+        and the cached maps of the subtree and its ancestors are removed.
+        Datasets with a ``base_file_path`` derived from their old slugs are given the path derived from their new slugs.
+
+        Args:
+            batch_size (int, optional): The number of items to update in each query. Defaults to 1000.
+
+        Returns:
+            int: The number of items with a changed slug.
+        """
+        items = list(
+            self.get_descendants(include_self=True)
+            .non_polymorphic()
+            .order_by("tree_id", "lft")
+            .only("pk", "name", "slug", "parent_id", "modified")
+        )
+        parent_slug = None
+        if self.parent_id:
+            parent_slug = Item.objects.filter(pk=self.parent_id).values_list("slug", flat=True).first()
+        subtree = models.Q(tree_id=self.tree_id, lft__gte=self.lft, rght__lte=self.rght)
+
+        # Every new slug in the subtree (including those with suffixes) starts with the slug of this item without a suffix
+        # so the slugs used outside this subtree with that prefix are all that is needed to keep the new slugs unique
+        prefix = Item.join_slug(parent_slug, self.name)
+        taken = set(
+            Item.objects.exclude(subtree).filter(slug__startswith=prefix).values_list("slug", flat=True)
+        )
+
+        old_slugs = {}
+        new_slugs = {}
+        changed = []
+        now = timezone.now()
+        for item in items:
+            slug = Item.join_slug(new_slugs.get(item.parent_id, parent_slug), item.name)
+            unique_slug = slug
+            index = 2
+            while unique_slug in taken:
+                unique_slug = f"{slug}-{index}"
+                index += 1
+            taken.add(unique_slug)
+
+            old_slugs[item.pk] = item.slug
+            new_slugs[item.pk] = unique_slug
+            if item.slug != unique_slug:
+                item.slug = unique_slug
+                item.modified = now
+                changed.append(item)
+
+        datasets = []
+        for pk, base_file_path, parent_id in Dataset.objects.filter(subtree).values_list(
+            "pk", "base_file_path", "parent_id"
+        ):
+            old_parent_slug = old_slugs.get(parent_id, parent_slug)
+            new_parent_slug = new_slugs.get(parent_id, parent_slug)
+            for old_slug, new_slug in [(old_slugs[pk], new_slugs[pk]), ("", "")]:
+                if base_file_path == str(storages.default_dataset_path(old_parent_slug, old_slug)):
+                    new_path = str(storages.default_dataset_path(new_parent_slug, new_slug))
+                    if new_path != base_file_path:
+                        datasets.append(Dataset(pk=pk, base_file_path=new_path))
+                    break
+
+        with transaction.atomic():
+            # Give the changed items temporary slugs first so that swapping slugs within the subtree does not break uniqueness
+            for start in range(0, len(changed), batch_size):
+                Item.objects.filter(pk__in=[item.pk for item in changed[start : start + batch_size]]).update(
+                    slug=Concat(models.Value("~"), Cast("pk", output_field=models.CharField()))
+                )
+            Item.objects.bulk_update(changed, ["slug", "modified"], batch_size=batch_size)
+            Dataset.objects.bulk_update(datasets, ["base_file_path"], batch_size=batch_size)
+
+        if changed:
+            # The bulk updates do not send post_save signals so the maps with the old URLs are removed here
+            from .mapping import invalidate_subtree_maps
+
+            invalidate_subtree_maps(self)
+
+        return len(changed)
+
+
+class FilesizeRollup(models.Model):
+    """
+    A cache of the total and number of the filesize attributes of an item and all its descendants.
+
+    These are kept up to date when filesize attributes are created, updated or deleted and when items move in the tree.
+    They can be recalculated from scratch with the ``rebuild-filesize-rollups`` management command.
+    """
+    item = models.OneToOneField(
+        Item, on_delete=models.CASCADE, primary_key=True, related_name="filesize_rollup"
+    )
+    total = models.PositiveBigIntegerField(
+        default=0, help_text="The sum of the filesize attributes of this item and its descendants in bytes."
+    )
+    count = models.PositiveIntegerField(
+        default=0, help_text="The number of filesize attributes of this item and its descendants."
+    )
 
-    def reslugify_descendants(self):
-        for item in self.get_descendants(include_self=True):
-            item.slug = item.slugify_function(item.name)
-            item.save()
+    def __str__(self):
+        return f"{self.item}: {humanize.naturalsize(self.total)} in {self.count} files"
 
 
 class Project(Item):
@@ -173,6 +383,16 @@ class Project(Item):
         blank=True,
         help_text="URL to snakemake repository/shell script or its content.",
     )
+    upload_include = models.TextField(
+        default="",
+        blank=True,
+        help_text="Glob patterns (one per line) for the paths of the files to upload after the workflow. If empty then all new or modified files are uploaded.",
+    )
+    upload_exclude = models.TextField(
+        default="",
+        blank=True,
+        help_text="Glob patterns (one per line) for the paths of files or directories not to upload after the workflow.",
+    )
     # More workflow languages need to be supported.
     # TODO assert parent is none
 
@@ -296,16 +516,145 @@ class Dataset(Item):
     def next_unprocessed(cls) -> "Dataset":
         return cls.unprocessed().first()
 
-    def files(self):
-        return storages.storage_walk(self.base_file_path)
+    def files(self, path: str = "", depth: int = None) -> storages.StorageDirectory:
+        """
+        Returns the tree of the files for this dataset from the index of the files in storage.
+
+        The storage itself is not listed. Use `refresh_file_index` to update the index from the storage.
 
-    def files_html(self):
+        Args:
+            path (str, optional): The path of a directory relative to the base file path to get the tree for.
+                Defaults to the base file path of the dataset.
+            depth (int, optional): The number of levels of directories to include the files for.
+                Deeper directories are collapsed. Defaults to including all files.
+        """
+        files = self.indexed_files.all()
+        path = path.strip("/")
+        if path:
+            files = files.filter(path__startswith=f"{path}/")
+        paths = []
+        shards = dict()
+        for indexed_path, shard in files.values_list("path", "shard"):
+            if path:
+                indexed_path = indexed_path[len(path) + 1:]
+            paths.append(indexed_path)
+            if shard:
+                shards[indexed_path] = shard
+        return storages.storage_tree(Path(self.base_file_path, path), paths, depth=depth, shards=shards)
+
+    def files_url(self, path: str = "") -> str:
+        """ The URL for the HTML of the tree of files in a directory of this dataset. """
+        url = reverse("crunch:dataset-files", kwargs=dict(project=self.parent.slug, slug=self.slug))
+        return f"{url}?{urlencode(dict(path=path))}" if path else url
+
+    def files_html(self, path: str = "", depth: int = 1) -> str:
+        """
+        Renders the tree of files for this dataset as HTML with links to the files.
+
+        Directories deeper than `depth` are collapsed and their files are loaded from `files_url` when they are expanded.
+        """
+        if not self.indexed_files.exists():
+            return "<p>No files have been indexed for this dataset.</p>"
         try:
-            directory = storages.storage_walk(self.base_file_path)
-            return directory.render_html()
+            return self.files(path=path, depth=depth).render_html(expand_url=self.expand_files_url)
         except Exception:
             return f"<p>Failed to read files in dataset {self}</p>"
 
+    def expand_files_url(self, directory: storages.StorageDirectory) -> str:
+        """ The URL to load the files of a collapsed directory in the tree from `files`. """
+        return self.files_url(directory.base_path.relative_to(self.base_file_path).as_posix())
+
+    def index_files(self, entries: Iterable[Dict], batch_size: int = 500) -> int:
+        """
+        Adds files to the index of the files in storage for this dataset or updates them if they are already in the index.
+
+        Args:
+            entries (Iterable[Dict]): A dictionary for each file with the 'path' relative to the base file path of the dataset
+                and optionally the 'size', 'md5', 'last_modified' time and the 'shard' that describes how the file is stored.
+            batch_size (int, optional): The number of files to write in each query. Defaults to 500.
+
+        Returns:
+            int: The number of files indexed.
+        """
+        files = {
+            entry["path"]: DatasetFile(
+                dataset=self,
+                path=entry["path"],
+                size=entry.get("size"),
+                md5=entry.get("md5") or "",
+                last_modified=entry.get("last_modified"),
+                shard=entry.get("shard") or "",
+            )
+            for entry in entries
+        }
+        paths = list(files)
+        with transaction.atomic():
+            for start in range(0, len(paths), batch_size):
+                self.indexed_files.filter(path__in=paths[start:start + batch_size]).delete()
+            DatasetFile.objects.bulk_create(files.values(), batch_size=batch_size)
+        return len(files)
+
+    def refresh_file_index(self, storage=None, checksums: bool = False) -> int:
+        """
+        Replaces the index of the files for this dataset with a listing of the storage.
+
+        Args:
+            storage (optional): The storage with the files. Defaults to the default storage.
+            checksums (bool, optional): Whether to read each file to calculate its MD5 checksum. Defaults to False.
+
+        Returns:
+            int: The number of files indexed.
+        """
+        if storage is None:
+            storage = storages.default_storage
+
+        # Files packed into archives, split into chunks or stored as shared blobs are indexed with the index which describes them
+        # rather than indexing the archives, chunks and manifests
+        entries = []
+        for path, entry in storages.iter_latest_files(self.base_file_path, storage=storage):
+            if entry is not None:
+                entries.append(entry)
+                continue
+
+            name = str(Path(self.base_file_path, path))
+            entry = dict(path=path, size=storage.size(name))
+            try:
+                entry["last_modified"] = storage.get_modified_time(name)
+            except NotImplementedError:
+                pass
+            if checksums:
+                entry["md5"] = storages.storage_md5(name, storage=storage)
+            entries.append(entry)
+
+        with transaction.atomic():
+            self.indexed_files.all().delete()
+            return self.index_files(entries)
+
+
+class DatasetFile(TimeStampedModel):
+    """
+    A file in the storage for a dataset.
+
+    The index of files is updated when a run uploads files for the dataset so that pages and the API do not need to list the storage.
+    It can be refreshed from the storage with the ``refresh-file-index`` management command.
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name="indexed_files")
+    path = models.CharField(max_length=4096, help_text="The path of the file relative to the base file path of the dataset.")
+    size = models.PositiveBigIntegerField(null=True, blank=True, help_text="The size of the file in bytes.")
+    md5 = models.CharField(max_length=32, default="", blank=True, help_text="The MD5 checksum of the file.")
+    last_modified = models.DateTimeField(null=True, blank=True, help_text="The time the file was last modified in storage.")
+    shard = models.CharField(
+        max_length=4096, default="", blank=True, 
+        help_text="The path (relative to the base file path of the dataset) of the archive, chunk index or manifest which describes how this file is stored if it is not stored by itself.",
+    )
+
+    class Meta:
+        unique_together = ("dataset", "path")
+        ordering = ("dataset", "path")
+
+    def __str__(self):
+        return self.path
+
 
 class Status(NextPrevMixin, TimeStampedModel):
     dataset = models.ForeignKey(
@@ -376,6 +725,7 @@ class Status(NextPrevMixin, TimeStampedModel):
 
     class Meta:
         verbose_name_plural = "statuses"
+        indexes = [models.Index(fields=["created", "id"])]
 
     def __str__(self):
         return f"{self.dataset}: {self.get_stage_display()} {self.get_state_display()}"
@@ -401,6 +751,12 @@ class Attribute(NextPrevMixin, TimeStampedModel, PolymorphicModel):
     item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name="attributes")
     key = models.CharField(max_length=255)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created", "id"]),
+            models.Index(fields=["key", "item"]),
+        ]
+
     def value_dict(self):
         return dict(key=self.key)
 
@@ -434,6 +790,8 @@ class ValueAttribute(Attribute):
 
     class Meta:
         abstract = True
+        # The key is in the table for Attribute so filters on typed attributes use that index and this one on the value
+        indexes = [models.Index(fields=["value"])]
 
     def value_dict(self):
         d = super().value_dict()
@@ -501,6 +859,23 @@ class LatLongAttribute(Attribute):
         decimal_places=9,
         help_text="The longitude of this location in decimal degrees.",
     )
+    geohash = models.CharField(
+        max_length=MAX_GEOHASH_PRECISION,
+        default="",
+        blank=True,
+        editable=False,
+        db_index=True,
+        help_text="The geohash of this location which is used to group nearby locations on maps.",
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["latitude", "longitude"])]
+
+    def save(self, *args, **kwargs):
+        # QuerySet.update does not call this so locations moved that way need their geohashes rebuilt afterwards
+        # (see `crunch.django.app.mapping.rebuild_geohashes` and the ``rebuild-geohashes`` management command)
+        self.geohash = encode_geohash(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
 
     def value_dict(self):
         d = super().value_dict()
@@ -0,0 +1,224 @@
+import json
+import shutil
+import tarfile
+import tempfile
+import datetime
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, List, Optional
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from . import storages
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Files smaller than this are packed into archives and larger files are stored by themselves
+DEFAULT_SMALL_FILE_SIZE = 1024 * 1024
+# The size of the files to put in each archive before starting a new one
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+COMPRESSIONS = ("none", "gzip", "zstd")
+EXTENSIONS = {"none": ".tar", "gzip": ".tar.gz", "zstd": ".tar.zst"}
+
+
+class PackingException(Exception):
+    """ Raised when files cannot be packed or unpacked. """
+    pass
+
+
+def check_compression(compression: str):
+    if compression not in COMPRESSIONS:
+        raise PackingException(f"Please use a compression from {COMPRESSIONS}.")
+    if compression == "zstd" and zstandard is None:
+        raise PackingException("Please install the 'zstandard' package to compress archives with zstd.")
+
+
+class ShardWriter():
+    """
+    Streams files into a tar archive in a temporary file and saves it to storage when it is closed.
+    """
+    def __init__(self, name: str, compression: str = "none"):
+        self.name = name
+        self.compression = compression
+        self.files = []
+        self.size = 0
+        self.buffer = tempfile.TemporaryFile()
+        if compression == "zstd":
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.buffer, closefd=False)
+            self.tar = tarfile.open(fileobj=self.stream, mode="w|")
+        else:
+            self.stream = None
+            self.tar = tarfile.open(fileobj=self.buffer, mode="w|gz" if compression == "gzip" else "w|")
+
+    def add(self, local_path: Path, relative_path: str, md5: str = ""):
+        self.tar.add(str(local_path), arcname=relative_path, recursive=False)
+        size = local_path.stat().st_size
+        self.files.append(dict(path=relative_path, size=size, md5=md5))
+        self.size += size
+
+    def save(self, storage, base_path) -> Dict:
+        """ Closes the archive and saves it to storage. Returns the description of the archive for the index. """
+        self.tar.close()
+        if self.stream:
+            self.stream.close()
+        self.buffer.seek(0)
+        remote_path = str(Path(base_path, storages.PACKS_DIRECTORY, self.name))
+        print(f"Saving archive of {len(self.files)} files to storage at '{remote_path}'")
+        storage._save(remote_path, File(self.buffer, name=self.name))
+        self.buffer.close()
+        return dict(name=self.name, files=self.files)
+
+
+def pack_to_storage(
+    paths: Iterable[Path],
+    local_dir: Path,
+    base = "/",
+    storage = None,
+    compression: str = "none",
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    small_file_size: int = DEFAULT_SMALL_FILE_SIZE,
+    checksums: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Copies files to storage with the small files packed into tar archives (shards) so that there are fewer objects to save.
+
+    The archives are saved in ``.crunch/packs`` under the base path with an index which lists the files in each archive.
+    Files which are at least `small_file_size` bytes are copied by themselves with `copy_to_storage`.
+
+    Args:
+        paths (Iterable[Path]): The local paths of the files to copy.
+        local_dir (Path): The local directory which the paths are relative to.
+        base (Union[str,Path], optional): The base path in storage. Defaults to "/".
+        storage (optional): The storage to copy to. Defaults to the default storage.
+        compression (str, optional): The compression for the archives: 'none', 'gzip' or 'zstd'. Defaults to "none".
+        shard_size (int, optional): The number of bytes of files to put in each archive. Defaults to DEFAULT_SHARD_SIZE.
+        small_file_size (int, optional): The size in bytes below which files are packed. Defaults to DEFAULT_SMALL_FILE_SIZE.
+        checksums (Dict[str, str], optional): The MD5 checksums of the files keyed by path relative to the local directory to put in the index.
+
+    Raises:
+        PackingException: If the compression is not available.
+
+    Returns:
+        Dict[str, str]: The path of the archive (relative to the base path) for the path of each packed file.
+    """
+    check_compression(compression)
+    if storage is None:
+        storage = default_storage
+    local_dir = Path(local_dir)
+    checksums = checksums or {}
+
+    large_files = []
+    shards = []
+    writer = None
+    # The names start with the time so that the most recent index is read last
+    pack_id = f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    for local_path in sorted(Path(path) for path in paths):
+        if local_path.is_dir():
+            continue
+        if local_path.stat().st_size >= small_file_size:
+            large_files.append(local_path)
+            continue
+
+        if writer is None:
+            writer = ShardWriter(f"{pack_id}-{len(shards):05d}{EXTENSIONS[compression]}", compression=compression)
+        relative_path = local_path.relative_to(local_dir).as_posix()
+        writer.add(local_path, relative_path, md5=checksums.get(str(local_path.relative_to(local_dir)), ""))
+        if writer.size >= shard_size:
+            shards.append(writer.save(storage, base))
+            writer = None
+
+    if writer is not None:
+        shards.append(writer.save(storage, base))
+
+    storages.copy_to_storage(large_files, local_dir=local_dir, base=base, storage=storage)
+
+    if not shards:
+        return {}
+
+    index = dict(created=datetime.datetime.utcnow().isoformat(), compression=compression, shards=shards)
+    index_path = str(Path(base, storages.PACKS_DIRECTORY, f"{pack_id}.json"))
+    with tempfile.TemporaryFile() as f:
+        f.write(json.dumps(index, indent=4).encode("utf-8"))
+        f.seek(0)
+        storage._save(index_path, File(f, name=f"{pack_id}.json"))
+
+    return {
+        entry["path"]: (storages.PACKS_DIRECTORY/shard["name"]).as_posix()
+        for shard in shards
+        for entry in shard["files"]
+    }
+
+
+def open_shard(source, name: str) -> tarfile.TarFile:
+    """ Opens an archive from a file object for reading as a stream with the compression given by its name. """
+    if name.endswith(EXTENSIONS["zstd"]):
+        check_compression("zstd")
+        return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(source), mode="r|")
+    return tarfile.open(fileobj=source, mode="r|gz" if name.endswith(EXTENSIONS["gzip"]) else "r|")
+
+
+def unpack_from_storage(
+    base = "/",
+    local_dir: Path = ".",
+    storage = None,
+    include: Optional[Iterable[str]] = None,
+    exclude: Optional[Iterable[str]] = None,
+    files: Optional[Dict[str, Dict]] = None,
+) -> List[str]:
+    """
+    Extracts the files from the archives of packed files for a dataset in storage.
+
+    Only the most recently packed version of each file is extracted. Each archive is streamed from storage without saving it locally.
+    Use `files` with the packed files from `crunch.django.app.storages.copy_recursive_from_storage`
+    to only extract the files which have not been uploaded again in another way since they were packed.
+
+    Args:
+        base (Union[str,Path], optional): The base path of the dataset in storage. Defaults to "/".
+        local_dir (Path, optional): The local directory to extract the files into. Defaults to ".".
+        storage (optional): The storage with the archives. Defaults to the default storage.
+        include (Iterable[str], optional): Glob patterns for the paths of the files to extract. If not given then all files are extracted.
+        exclude (Iterable[str], optional): Glob patterns for the paths of files or directories not to extract.
+        files (Dict[str, Dict], optional): The entries from the indexes of the files to extract keyed by path.
+            Defaults to the most recent entry for each file in the indexes of the archives of the dataset.
+
+    Raises:
+        PackingException: If an archive has a file outside the local directory.
+
+    Returns:
+        List[str]: The paths relative to the local directory of the extracted files.
+    """
+    if storage is None:
+        storage = default_storage
+    local_dir = Path(local_dir)
+
+    if files is None:
+        files = storages.packed_files(base, storage=storage)
+
+    shards = dict()
+    for path, entry in files.items():
+        if storages.path_included(path, include, exclude):
+            shards.setdefault(entry["shard"], set()).add(path)
+
+    extracted = []
+    for shard, paths in sorted(shards.items()):
+        print(f"Unpacking {len(paths)} files from '{shard}' in storage to '{local_dir}'")
+        with storage.open(str(Path(base, shard)), "rb") as source:
+            with open_shard(source, shard) as tar:
+                for member in tar:
+                    relative_path = PurePosixPath(member.name)
+                    if relative_path.is_absolute() or ".." in relative_path.parts:
+                        raise PackingException(f"Cannot extract '{member.name}' from '{shard}' outside of '{local_dir}'.")
+                    if not member.isfile() or member.name not in paths:
+                        continue
+
+                    local_path = local_dir/relative_path
+                    local_path.parent.mkdir(exist_ok=True, parents=True)
+                    with tar.extractfile(member) as packed, open(local_path, "wb") as target:
+                        shutil.copyfileobj(packed, target, length=storages.COPY_BUFFER_SIZE)
+                    extracted.append(member.name)
+
+    return extracted
@@ -0,0 +1,30 @@
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class CreatedCursorPagination(CursorPagination):
+    """
+    Paginates large collections using a cursor on the time each object was created.
+
+    Unlike page number pagination, this does not need a COUNT(*) for each page or an OFFSET that grows with each page
+    so every page takes about the same time to fetch no matter how far through the collection it is.
+    Clients can request up to `max_page_size` results per page with the `page_size` query parameter.
+
+    DRF's cursor only holds the position of the first ordering field (the created time).
+    Objects created at exactly the same time as the last object on a page are skipped with an OFFSET
+    so very large batches of objects with identical times are slower to page through.
+    The primary key is only a tie-breaker which keeps the order of those objects stable between pages.
+    """
+    ordering = ("created", "pk")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class SearchPagination(PageNumberPagination):
+    """
+    Paginates ranked search results by page number.
+
+    Search results are ordered by how well they match rather than by a unique, immutable field so they cannot use a cursor.
+    """
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
@@ -0,0 +1,47 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+
+def msgpack_available() -> bool:
+    """ Returns whether or not the 'msgpack' package is installed so that the MessagePack renderer and parser can be used. """
+    return msgpack is not None
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders data as MessagePack, a compact binary alternative to JSON.
+
+    Types which MessagePack cannot represent directly (e.g. dates and decimals) are converted as they would be for JSON.
+    """
+    media_type = MSGPACK_MEDIA_TYPE
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, default=JSONEncoder().default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    """
+    Parses MessagePack request content.
+    """
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except Exception as err:
+            raise ParseError(f"MessagePack parse error - {err}")
@@ -0,0 +1,198 @@
+from typing import Dict, Iterable, Tuple
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from mptt.signals import node_moved
+
+from .models import Item, FilesizeAttribute, FilesizeRollup
+
+
+def apply_filesize_delta(item_id: int, total: int, count: int):
+    """
+    Adds to the cached filesize rollups of an item and all of its ancestors.
+
+    Args:
+        item_id (int): The primary key of the item.
+        total (int): The number of bytes to add to the total (this can be negative).
+        count (int): The number of files to add to the count (this can be negative).
+    """
+    if item_id is None or (not total and not count):
+        return
+
+    add_to_filesize_rollups(Item.stored_ancestor_ids(item_id), total, count)
+
+
+def add_to_filesize_rollups(item_ids: Iterable[int], total: int, count: int):
+    """
+    Adds to the cached filesize rollups of a collection of items.
+
+    Args:
+        item_ids (Iterable[int]): The primary keys of the items.
+        total (int): The number of bytes to add to the total (this can be negative).
+        count (int): The number of files to add to the count (this can be negative).
+    """
+    item_ids = list(item_ids)
+    if not item_ids or (not total and not count):
+        return
+
+    FilesizeRollup.objects.bulk_create(
+        [FilesizeRollup(item_id=item_id) for item_id in item_ids],
+        ignore_conflicts=True,
+    )
+    FilesizeRollup.objects.filter(item_id__in=item_ids).update(
+        total=F("total") + total,
+        count=F("count") + count,
+    )
+
+
+@receiver(pre_save, sender=FilesizeAttribute)
+def filesize_attribute_pre_save(sender, instance, raw=False, **kwargs):
+    instance._rollup_previous = None
+    if raw or instance.pk is None:
+        return
+    instance._rollup_previous = (
+        FilesizeAttribute.objects.non_polymorphic()
+        .filter(pk=instance.pk)
+        .values_list("item_id", "value")
+        .first()
+    )
+
+
+@receiver(post_save, sender=FilesizeAttribute)
+def filesize_attribute_post_save(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, "_rollup_previous", None)
+    if previous is None:
+        apply_filesize_delta(instance.item_id, instance.value, 1)
+        return
+
+    previous_item_id, previous_value = previous
+    if previous_item_id == instance.item_id:
+        apply_filesize_delta(instance.item_id, instance.value - previous_value, 0)
+    else:
+        apply_filesize_delta(previous_item_id, -previous_value, -1)
+        apply_filesize_delta(instance.item_id, instance.value, 1)
+
+
+@receiver(post_delete, sender=FilesizeAttribute)
+def filesize_attribute_post_delete(sender, instance, **kwargs):
+    # The attributes of a deleted item are already removed from the rollups with the rest of its subtree
+    if instance.item_id in _deleting_item_ids:
+        return
+    apply_filesize_delta(instance.item_id, -instance.value, -1)
+
+
+# The primary keys of the items which are in the process of being deleted
+_deleting_item_ids = set()
+
+
+# Items are deleted along with the row of the base class so this is sent for every type of item
+@receiver(pre_delete, sender=Item)
+def filesize_rollup_item_pre_delete(sender, instance, **kwargs):
+    _deleting_item_ids.add(instance.pk)
+
+    rollup = FilesizeRollup.objects.filter(item_id=instance.pk).values_list("total", "count").first()
+    if not rollup or not rollup[1]:
+        return
+
+    # mptt has already closed the gap in the tree so the ancestors are found from the parent
+    total, count = rollup
+    add_to_filesize_rollups(Item.stored_ancestor_ids(instance.parent_id), -total, -count)
+
+
+@receiver(post_delete, sender=Item)
+def filesize_rollup_item_post_delete(sender, instance, **kwargs):
+    _deleting_item_ids.discard(instance.pk)
+
+
+@receiver(node_moved)
+def filesize_rollup_node_moved(sender, instance, **kwargs):
+    if not isinstance(instance, Item):
+        return
+
+    rollup = FilesizeRollup.objects.filter(item_id=instance.pk).values_list("total", "count").first()
+    if not rollup or not rollup[1]:
+        return
+
+    previous_ancestor_ids = set(getattr(instance, "_previous_ancestor_ids", None) or [])
+    ancestor_ids = set(Item.stored_ancestor_ids(instance.parent_id))
+
+    total, count = rollup
+    add_to_filesize_rollups(previous_ancestor_ids - ancestor_ids, -total, -count)
+    add_to_filesize_rollups(ancestor_ids - previous_ancestor_ids, total, count)
+
+
+def calculate_filesize_rollups(
+    items: Iterable[Tuple[int, int, int, int]], sums: Dict[int, Tuple[int, int]]
+) -> Dict[int, Tuple[int, int]]:
+    """
+    Calculates the filesize rollups for every item in a single pass over the tree.
+
+    Args:
+        items (Iterable[Tuple[int, int, int, int]]): Tuples of the primary key, tree_id, lft and rght for each item,
+            ordered by tree_id and lft.
+        sums (Dict[int, Tuple[int, int]]): The total and count of the filesize attributes directly on each item.
+
+    Returns:
+        Dict[int, Tuple[int, int]]: The total and count of the filesize attributes of each item and its descendants.
+            Only items with at least one filesize attribute in their subtree are included.
+    """
+    rollups = {}
+    stack = []  # list of [pk, tree_id, rght, total, count]
+
+    def pop():
+        pk, _, _, total, count = stack.pop()
+        if count:
+            rollups[pk] = (total, count)
+        if stack:
+            stack[-1][3] += total
+            stack[-1][4] += count
+
+    for pk, tree_id, lft, rght in items:
+        while stack and (stack[-1][1] != tree_id or stack[-1][2] < lft):
+            pop()
+        total, count = sums.get(pk, (0, 0))
+        stack.append([pk, tree_id, rght, total, count])
+
+    while stack:
+        pop()
+
+    return rollups
+
+
+def rebuild_filesize_rollups(batch_size: int = 1000) -> int:
+    """
+    Recalculates the cached filesize rollups for all items from scratch.
+
+    Args:
+        batch_size (int, optional): The number of rollups to create in each query. Defaults to 1000.
+
+    Returns:
+        int: The number of rollups created.
+    """
+    sums = {
+        row["item_id"]: (row["total"], row["count"])
+        for row in FilesizeAttribute.objects.non_polymorphic()
+        .order_by()
+        .values("item_id")
+        .annotate(total=models.Sum("value"), count=models.Count("pk"))
+    }
+    items = (
+        Item.objects.non_polymorphic()
+        .order_by("tree_id", "lft")
+        .values_list("pk", "tree_id", "lft", "rght")
+        .iterator()
+    )
+    rollups = calculate_filesize_rollups(items, sums)
+
+    with transaction.atomic():
+        FilesizeRollup.objects.all().delete()
+        FilesizeRollup.objects.bulk_create(
+            [FilesizeRollup(item_id=pk, total=total, count=count) for pk, (total, count) in rollups.items()],
+            batch_size=batch_size,
+        )
+
+    return len(rollups)
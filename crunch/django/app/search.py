@@ -0,0 +1,161 @@
+import re
+from typing import List, Tuple
+from django.db import connections
+from django.db.models import Q
+
+from .models import Item
+
+
+SEARCH_TABLE = "crunch_item_search"
+SEARCH_CONFIG = "english"
+
+# The fields of an item which are searched with the weight of matches in each
+SEARCH_WEIGHTS = (
+    ("name", "A", 10.0),
+    ("description", "B", 4.0),
+    ("details", "C", 1.0),
+)
+
+
+def search_terms(query: str) -> List[str]:
+    """
+    Splits a search query into the words to search for.
+
+    Only letters, digits and underscores are kept so that the terms can be safely given to the full-text query parsers.
+    """
+    return re.findall(r"\w+", query or "")
+
+
+def search_document_sql() -> str:
+    """
+    Returns the SQL for the weighted tsvector of an item in PostgreSQL.
+
+    This needs to be identical to the expression of the GIN index created in the migrations so that PostgreSQL uses the index.
+    """
+    return " || ".join(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}'::regconfig, COALESCE({field}, '')), '{weight}')"
+        for field, weight, _ in SEARCH_WEIGHTS
+    )
+
+
+def postgresql_query(terms: List[str]) -> str:
+    """ Returns a tsquery string which matches all of the terms, with the last as a prefix so that partial words match while typing. """
+    return " & ".join(terms[:-1] + [f"{terms[-1]}:*"])
+
+
+def sqlite_query(terms: List[str]) -> str:
+    """ Returns an FTS5 query which matches all of the terms, with the last as a prefix so that partial words match while typing. """
+    return " ".join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+
+class SearchResults():
+    """
+    The items which match a full-text search ordered from the best match.
+
+    The results are lazy and can be counted and sliced so that they can be paginated by Django and Django REST Framework.
+    Each slice only retrieves the items for that page.
+
+    On PostgreSQL this uses a GIN index on a weighted tsvector of the name, description and details of each item.
+    On SQLite this uses an FTS5 table which is kept current with triggers on the item table.
+    Other databases fall back to a case-insensitive substring search which is not ranked.
+    """
+    def __init__(self, query: str, using: str = "default"):
+        self.terms = search_terms(query)
+        self.using = using
+        self._count = None
+
+    @property
+    def vendor(self) -> str:
+        return connections[self.using].vendor
+
+    def fallback_queryset(self):
+        queryset = Item.objects.using(self.using).non_polymorphic()
+        for term in self.terms:
+            queryset = queryset.filter(
+                Q(name__icontains=term) | Q(description__icontains=term) | Q(details__icontains=term)
+            )
+        return queryset.order_by("name", "pk")
+
+    def execute(self, sql: str, params: list) -> list:
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def count(self) -> int:
+        if self._count is not None:
+            return self._count
+
+        if not self.terms:
+            self._count = 0
+        elif self.vendor == "postgresql":
+            self._count = self.execute(
+                f"SELECT COUNT(*) FROM crunch_item WHERE ({search_document_sql()}) @@ to_tsquery('{SEARCH_CONFIG}'::regconfig, %s)",
+                [postgresql_query(self.terms)],
+            )[0][0]
+        elif self.vendor == "sqlite":
+            self._count = self.execute(
+                f"SELECT COUNT(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s",
+                [sqlite_query(self.terms)],
+            )[0][0]
+        else:
+            self._count = self.fallback_queryset().count()
+
+        return self._count
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def ranked_ids(self, offset: int, limit: int) -> List[Tuple[int, float]]:
+        """
+        Finds the IDs of the items for a page of the results.
+
+        Args:
+            offset (int): The number of results before the page.
+            limit (int): The number of results in the page.
+
+        Returns:
+            List[Tuple[int, float]]: The ID of each item and its rank, where a higher rank is a better match.
+        """
+        if not self.terms or limit <= 0:
+            return []
+
+        if self.vendor == "postgresql":
+            document = search_document_sql()
+            return self.execute(
+                f"SELECT id, ts_rank({document}, query) AS rank "
+                f"FROM crunch_item, to_tsquery('{SEARCH_CONFIG}'::regconfig, %s) query "
+                f"WHERE ({document}) @@ query ORDER BY rank DESC, id LIMIT %s OFFSET %s",
+                [postgresql_query(self.terms), limit, offset],
+            )
+
+        if self.vendor == "sqlite":
+            # bm25 gives better matches a more negative score
+            weights = ", ".join(str(weight) for _, _, weight in SEARCH_WEIGHTS)
+            return self.execute(
+                f"SELECT rowid, -bm25({SEARCH_TABLE}, {weights}) AS rank FROM {SEARCH_TABLE} "
+                f"WHERE {SEARCH_TABLE} MATCH %s ORDER BY rank DESC, rowid LIMIT %s OFFSET %s",
+                [sqlite_query(self.terms), limit, offset],
+            )
+
+        return [(pk, 0.0) for pk in self.fallback_queryset().values_list("pk", flat=True)[offset:offset + limit]]
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            results = self[index:index + 1]
+            if not results:
+                raise IndexError("search result index out of range")
+            return results[0]
+
+        start = index.start or 0
+        stop = index.stop if index.stop is not None else self.count()
+        ranked_ids = self.ranked_ids(start, stop - start)
+
+        items = Item.objects.using(self.using).non_polymorphic().in_bulk([pk for pk, _ in ranked_ids])
+        results = []
+        for pk, rank in ranked_ids:
+            # An item could be deleted between finding the IDs and retrieving the items
+            if pk in items:
+                item = items[pk]
+                item.search_rank = rank
+                results.append(item)
+        return results
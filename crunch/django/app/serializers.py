@@ -1,11 +1,126 @@
+from typing import Dict, Optional, Tuple
+from django.contrib.contenttypes.models import ContentType
 from rest_framework import serializers
 
 from . import models
+from .instrumentation import InstrumentedSerializerMixin
 
-class ProjectSerializer(serializers.HyperlinkedModelSerializer):
+
+def parse_field_paths(value: Optional[str]) -> Optional[Dict]:
+    """
+    Parses a comma separated list of dotted field paths (e.g. 'id,slug,items.slug') into a tree of dictionaries.
+
+    Args:
+        value (Optional[str]): The comma separated paths. If None then there is no restriction.
+
+    Returns:
+        Optional[Dict]: The tree of field names (e.g. {'id': {}, 'slug': {}, 'items': {'slug': {}}}) or None if value is None.
+    """
+    if value is None:
+        return None
+
+    tree = {}
+    for path in value.split(","):
+        node = tree
+        for name in path.strip().split("."):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def sparse_fieldsets(request) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """
+    Returns the trees of the fields and the nested relations to expand requested with the 'fields' and 'expand' query parameters.
+
+    Only safe (i.e. read only) requests can use sparse fieldsets.
+    """
+    if request is None or request.method not in ("GET", "HEAD", "OPTIONS"):
+        return None, None
+    query_params = getattr(request, "query_params", request.GET)
+    return parse_field_paths(query_params.get("fields")), parse_field_paths(query_params.get("expand"))
+
+
+def nested_fieldsets(fields: Optional[Dict], expand: Optional[Dict], name: str, nested: bool) -> Optional[Tuple[Optional[Dict], Optional[Dict]]]:
+    """
+    Determines whether a field is included in a sparse fieldset and, if so, the fieldsets for its nested fields.
+
+    If 'fields' is given then only the fields listed are included.
+    If 'expand' is given then nested relations are only included if they are listed in 'expand' or explicitly in 'fields'.
+
+    Args:
+        fields (Optional[Dict]): The tree of requested fields or None if all fields are requested.
+        expand (Optional[Dict]): The tree of nested relations to expand or None if all relations are expanded.
+        name (str): The name of the field.
+        nested (bool): Whether the field is a nested relation.
+
+    Returns:
+        Optional[Tuple[Optional[Dict], Optional[Dict]]]: None if the field is not included
+            otherwise the fields and expand trees for the nested serializer.
+    """
+    if fields is not None and name not in fields:
+        return None
+    if nested and expand is not None and name not in expand and fields is None:
+        return None
+
+    child_fields = (fields[name] or None) if fields is not None else None
+    child_expand = expand.get(name, {}) if expand is not None else None
+    return child_fields, child_expand
+
+
+def includes_field(request, path: str) -> bool:
+    """
+    Returns whether the response to a request includes a (possibly nested) field given as a dotted path (e.g. 'items.attributes').
+    
+    This is used by views to skip prefetching relations which are not requested.
+    """
+    fields, expand = sparse_fieldsets(request)
+    for name in path.split("."):
+        fieldsets = nested_fieldsets(fields, expand, name, nested=True)
+        if fieldsets is None:
+            return False
+        fields, expand = fieldsets
+    return True
+
+
+class SparseFieldsetMixin():
+    """
+    A mixin for DRF serializers so that clients can request only some of the fields with the 'fields' and 'expand' query parameters.
+
+    For example, '?fields=id,slug,items.slug' gives just the 'id' and 'slug' of the object and the 'slug' of each of its items.
+    '?expand=' with no relations gives the object without any nested relations and '?expand=items' includes only the items.
+    """
+    sparse_fields = None
+    sparse_expand = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Only top level serializers have the request in the context, nested serializers are given their fieldsets by their parent
+        request = self._context.get("request")
+        if request is not None:
+            self.sparse_fields, self.sparse_expand = sparse_fieldsets(request)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.sparse_fields is None and self.sparse_expand is None:
+            return fields
+
+        for name, field in list(fields.items()):
+            nested = isinstance(field, serializers.BaseSerializer)
+            fieldsets = nested_fieldsets(self.sparse_fields, self.sparse_expand, name, nested)
+            if fieldsets is None:
+                del fields[name]
+                continue
+
+            child = getattr(field, "child", field)
+            if nested and isinstance(child, SparseFieldsetMixin):
+                child.sparse_fields, child.sparse_expand = fieldsets
+
+        return fields
+
+class ProjectSerializer(SparseFieldsetMixin, InstrumentedSerializerMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Project
-        fields = ['id', 'name', 'slug', 'description', 'details', 'workflow']
+        fields = ['id', 'name', 'slug', 'description', 'details', 'workflow', 'upload_include', 'upload_exclude']
 
 
 class AttributeSerializer(serializers.ModelSerializer):
@@ -17,7 +132,7 @@ class AttributeSerializer(serializers.ModelSerializer):
         return instance.value_dict()
 
 
-class AbstractAttributeSerializer(serializers.ModelSerializer):
+class AbstractAttributeSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     item = serializers.SlugRelatedField(slug_field='slug', queryset=models.Item.objects.all())
     class Meta:
         fields = [
@@ -78,7 +193,7 @@ class LatLongAttributeSerializer(AbstractAttributeSerializer):
         ]
 
 
-class ItemSerializer(serializers.HyperlinkedModelSerializer):
+class ItemSerializer(SparseFieldsetMixin, InstrumentedSerializerMixin, serializers.HyperlinkedModelSerializer):
     parent = serializers.SlugRelatedField(slug_field='slug', queryset=models.Item.objects.all())
     attributes = AttributeSerializer(many=True, required=False)
 
@@ -87,22 +202,40 @@ class ItemSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['id', 'name', 'slug','parent', 'description', 'details', 'attributes']
 
 
-class DatasetSerializer(serializers.HyperlinkedModelSerializer):
+class DatasetSerializer(SparseFieldsetMixin, InstrumentedSerializerMixin, serializers.HyperlinkedModelSerializer):
     parent = serializers.SlugRelatedField(slug_field='slug', queryset=models.Project.objects.all())
     attributes = AttributeSerializer(many=True, required=False)
-    items = ItemSerializer(many=True, required=False)
+    items = ItemSerializer(many=True, required=False, source="children")
 
     class Meta:
         model = models.Dataset
         fields = ['id', 'name', 'slug','parent', 'description', 'details', 'attributes', 'items', 'base_file_path']
 
 
+class SearchResultSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    slug = serializers.CharField()
+    description = serializers.CharField()
+    type = serializers.SerializerMethodField()
+    rank = serializers.FloatField(source="search_rank")
+
+    def get_type(self, item) -> str:
+        return ContentType.objects.get_for_id(item.polymorphic_ctype_id).model
+
+
+class DatasetFileSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.DatasetFile
+        fields = ["path", "size", "md5", "last_modified", "shard"]
+
+
 class DatasetReferenceSerializer(serializers.Serializer):
     project = serializers.CharField(max_length=255)
     dataset = serializers.CharField(max_length=255)
 
     
-class StatusSerializer(serializers.ModelSerializer):
+class StatusSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     dataset = serializers.PrimaryKeyRelatedField(queryset=models.Dataset.objects.all())
 
     class Meta:
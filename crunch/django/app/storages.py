@@ -1,17 +1,39 @@
 import logging
-from typing import Dict, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import toml
 import json
 from operator import mod
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from django.core.files import File
 from django.conf import settings
 from anytree import NodeMixin, RenderTree, PreOrderIter
 from django.core.files.storage import default_storage, DefaultStorage
+from django.core.cache import cache
+from django.utils.html import escape
 import os
 import time
 import shutil
 import datetime
+import hashlib
+import posixpath
+from fnmatch import fnmatchcase
+
+
+# The number of directories listed at the same time when walking storages which are not object stores
+STORAGE_WALK_WORKERS = 8
+# The number of bytes read at a time when copying files from storage
+COPY_BUFFER_SIZE = 1024 * 1024
+# The number of seconds that the URLs of files in storage are cached
+URL_CACHE_TIMEOUT = 60 * 5
+# The directory relative to the base path of a dataset with the archives of packed files and their indexes
+PACKS_DIRECTORY = PurePosixPath(".crunch", "packs")
+# The directory relative to the base path of a dataset with the chunks of large files and their indexes
+CHUNKS_DIRECTORY = PurePosixPath(".crunch", "chunks")
+# The directory relative to the base path of a dataset with the manifests of the files which are stored as shared blobs
+MANIFESTS_DIRECTORY = PurePosixPath(".crunch", "manifests")
+# The path in storage of the blobs shared by all datasets. This can be changed with the CRUNCH_BLOBS_PATH setting.
+DEFAULT_BLOBS_PATH = "crunch/.blobs"
 
 
 class Directory:
@@ -57,13 +79,15 @@ def get_storage_with_settings(storage_settings:Union[Dict,Path]) -> DefaultStora
 
 class StorageDirectory(NodeMixin):
     def __init__(
-        self, *args, base_path: Union[str,Path], storage=None, parent=None, children=None, **kwargs
+        self, *args, base_path: Union[str,Path], storage=None, parent=None, children=None, collapsed:bool=False, **kwargs
     ):
         super().__init__(*args, **kwargs)
 
         self.base_path = Path(base_path)
         self.storage = storage
         self.parent = parent
+        # Whether the contents of this directory have been left out of the tree
+        self.collapsed = collapsed
         if children:
             self.children = children
 
@@ -82,32 +106,60 @@ class StorageDirectory(NodeMixin):
             return str(self.base_path.relative_to(self.parent.base_path))
         return ""
 
-    def render(self):
-        result = f"{self.base_path}\n"
+    def iter_render(self) -> Iterator[str]:
+        """ Yields the lines of a text rendering of the tree. """
+        yield f"{self.base_path}\n"
         for pre, _, node in RenderTree(self):
             if node == self:
                 continue
             treestr = f"{pre}{node.short_str()}"
-            result += treestr.ljust(8) + "\n"
-        return result
+            yield treestr.ljust(8) + "\n"
 
-    def render_html(self):
+    def render(self) -> str:
+        return "".join(self.iter_render())
+
+    def iter_render_html(self, expand_url:Optional[Callable[["StorageDirectory"], str]]=None) -> Iterator[str]:
+        """
+        Yields the HTML for the tree in chunks so that it can be joined once or streamed in a response.
+
+        The URLs for all the files are generated together with `storage_urls` before rendering.
+
+        Args:
+            expand_url (Callable, optional): A function which returns the URL for the HTML of a collapsed directory.
+                Collapsed directories are rendered as elements which load their contents from this URL when they are expanded.
+                If not given then collapsed directories are rendered with just their names.
+
+        Yields:
+            str: The chunks of HTML.
+        """
+        names = [str(file.path()) for file in self.file_descendents() if not file.shard]
+        urls = storage_urls(names, storage=self.storage)
+
+        yield "<div>"
+        yield f"{escape(self.base_path)}<br>\n"
+        for pre, _, node in RenderTree(self):
+            if node == self:
+                continue
+
+            if isinstance(node, StorageFile) and node.shard:
+                stored = STORED_IN.get(PurePosixPath(node.shard).parent, "Packed in")
+                yield f"{pre}<span title='{stored} {escape(node.shard)}'>{escape(node.short_str())}</span><br>\n"
+            elif isinstance(node, StorageFile):
+                yield f"{pre}<a href='{escape(urls[str(node.path())])}'>{escape(node.short_str())}</a><br>\n"
+            elif node.collapsed and expand_url:
+                yield (
+                    f"<details class='crunch-files' data-url='{escape(expand_url(node))}'>"
+                    f"<summary>{pre}{escape(node.short_str())}</summary><div>Loading…</div></details>\n"
+                )
+            else:
+                yield f"{pre}{escape(node.short_str())}<br>\n"
+        yield "</div>"
+
+    def render_html(self, expand_url:Optional[Callable[["StorageDirectory"], str]]=None) -> str:
         try:
-            result = "<div>"
-            result += f"{self.base_path}<br>\n"
-            for pre, _, node in RenderTree(self):
-                if node == self:
-                    continue
-
-                if isinstance(node, StorageFile):
-                    result += f"{pre}<a href='{node.url()}'>{node.short_str()}</a><br>\n"
-                else:
-                    result += f"{pre}{node.short_str()}<br>\n"
-            result += "</div>"
+            return "".join(self.iter_render_html(expand_url=expand_url))
         except Exception as err:
-            result = f"<div>Failed to read storage at {self.base_path}</div>"
-            
-        return result
+            return f"<div>Failed to read storage at {escape(self.base_path)}</div>"
 
     def directory_descendents(self, stop=None, maxlevel: int = None):
         """Does a pre order iteration of subdirectories."""
@@ -129,10 +181,13 @@ class StorageDirectory(NodeMixin):
 
 
 class StorageFile(NodeMixin):
-    def __init__(self, *args, filename, parent, **kwargs):
+    def __init__(self, *args, filename, parent, shard:Optional[str]=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.filename = filename
         self.parent = parent
+        # The path (relative to the base path of the dataset) of the archive which this file is packed in,
+        # the index of its chunks or the manifest with its blob if it is not stored by itself
+        self.shard = shard
 
     def __str__(self):
         return self.filename
@@ -147,41 +202,678 @@ class StorageFile(NodeMixin):
         return Path(self.parent.base_path, self.filename)
 
     def url(self):
-        storage = self.parent.storage or default_storage
-        return storage.url(str(self.path()))
+        name = str(self.path())
+        return storage_urls([name], storage=self.parent.storage)[name]
+
+
+def storage_url_cache_key(storage, name:str) -> str:
+    """
+    The key in the cache for the URL of a file in storage.
+
+    The key includes the class of the storage with its base URL, bucket and location (when it has them)
+    so that storages of the same class in different buckets or directories do not share URLs.
+    """
+    storage_class = type(storage)
+    identifier = ":".join([
+        f"{storage_class.__module__}.{storage_class.__qualname__}",
+        *(str(getattr(storage, attribute, None) or "") for attribute in ("base_url", "bucket_name", "location")),
+        name,
+    ])
+    return f"crunch:storage-url:{hashlib.md5(identifier.encode()).hexdigest()}"
+
+
+def storage_urls(names:Iterable[str], storage=None) -> Dict[str, str]:
+    """
+    Gets the URLs for files in storage using the cache for the URLs which have already been generated.
+
+    Generating a URL can be expensive (e.g. signing a URL for S3) so the URLs are cached
+    and the cache is read and written once for all the files.
+    Signed URLs are cached for at most half the time until they expire.
+
+    Args:
+        names (Iterable[str]): The names of the files in storage.
+        storage (optional): The storage with the files. Defaults to the default storage.
+
+    Returns:
+        Dict[str, str]: The URL for each name.
+    """
+    storage = storage or default_storage
+    keys = {name: storage_url_cache_key(storage, name) for name in names}
+    if not keys:
+        return {}
+
+    cached = cache.get_many(keys.values())
+    urls = {name: cached[key] for name, key in keys.items() if key in cached}
+    missing = {keys[name]: storage.url(name) for name in keys if name not in urls}
+    if missing:
+        timeout = URL_CACHE_TIMEOUT
+        expire = getattr(storage, "querystring_expire", None)
+        if expire and getattr(storage, "querystring_auth", True):
+            timeout = min(timeout, expire // 2)
+        cache.set_many(missing, timeout=timeout)
+        urls.update({name: missing[keys[name]] for name in keys if name not in urls})
+    return urls
+
+
+def object_store_names(storage, base_path) -> Optional[Iterator[str]]:
+    """
+    Lists all the files under a path in an object store (e.g. S3 or Google Cloud Storage) with a flat prefix listing.
+
+    Object stores only emulate directories so listing each directory separately costs a request for every prefix.
+    A flat listing gets every key under the prefix in pages of up to a thousand keys instead.
+
+    Args:
+        storage: The storage to list.
+        base_path (Union[str,Path]): The path of the directory to list.
+
+    Returns:
+        Optional[Iterator[str]]: The paths of the files relative to the base path
+            or None if the storage is not a supported object store.
+    """
+    bucket = getattr(storage, "bucket", None)
+    normalize_name = getattr(storage, "_normalize_name", None)
+    if bucket is None or normalize_name is None:
+        return None
+
+    base_path = str(base_path).strip("/")
+    prefix = normalize_name(base_path) if base_path not in ("", ".") else normalize_name("")
+    prefix = prefix.rstrip("/") + "/" if prefix.strip("/") else ""
+
+    if hasattr(bucket, "objects"):
+        # boto3 requests the following pages as the collection is iterated
+        keys = (obj.key for obj in bucket.objects.filter(Prefix=prefix))
+    elif hasattr(bucket, "list_blobs"):
+        keys = (blob.name for blob in bucket.list_blobs(prefix=prefix))
+    else:
+        return None
+
+    # Keys which end with a slash are placeholders for empty directories
+    return (key[len(prefix):] for key in keys if not key.endswith("/"))
+
+
+def path_matches(path:str, patterns:Iterable[str]) -> bool:
+    """
+    Checks whether a relative path or any of the directories it is in matches one of a list of glob patterns.
+
+    The patterns are matched with `fnmatch` against the whole path so '*' also matches across directories
+    (e.g. '*.bam' matches 'sample/reads.bam') and a pattern for a directory (e.g. 'raw') matches all the files in it.
+
+    Args:
+        path (str): The path relative to the base directory.
+        patterns (Iterable[str]): The glob patterns.
+
+    Returns:
+        bool: Whether the path matches any of the patterns.
+    """
+    path = PurePosixPath(path)
+    candidates = [path.as_posix()] + [parent.as_posix() for parent in path.parents if parent.parts]
+    return any(fnmatchcase(candidate, pattern) for pattern in patterns for candidate in candidates)
+
+
+def path_included(path:str, include:Optional[Iterable[str]]=None, exclude:Optional[Iterable[str]]=None) -> bool:
+    """
+    Checks whether a relative path is selected by lists of glob patterns to include and exclude.
+
+    Args:
+        path (str): The path relative to the base directory.
+        include (Iterable[str], optional): If given then only paths which match one of these patterns are included.
+        exclude (Iterable[str], optional): Paths which match any of these patterns are excluded, even if they match an include pattern.
+
+    Returns:
+        bool: Whether the path is included.
+    """
+    if exclude and path_matches(path, exclude):
+        return False
+    return not include or path_matches(path, include)
+
+
+def storage_listdirs(
+    base_path, storage=None, max_workers:int=STORAGE_WALK_WORKERS, prune:Optional[Callable[[Path], bool]]=None,
+) -> Iterator[Tuple[Path, List[str], List[str]]]:
+    """
+    Lists a directory and all its subdirectories in storage one level at a time.
+
+    The directories at each level are listed in parallel and each is yielded as soon as it and the ones before it are listed.
+
+    Args:
+        base_path (Union[str,Path]): The path of the directory to list.
+        storage (optional): The storage to list. Defaults to the default storage.
+        max_workers (int, optional): The number of directories to list at the same time. Defaults to STORAGE_WALK_WORKERS.
+        prune (Callable, optional): A function which is given the path of each subdirectory
+            and returns True if that subdirectory should not be listed.
+
+    Yields:
+        Tuple[Path, List[str], List[str]]: The path of each directory with the names of its subdirectories and files.
+    """
+    if storage is None:
+        storage = default_storage
+
+    level = [Path(base_path)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            next_level = []
+            for path, (folders, filenames) in zip(level, executor.map(lambda path: storage.listdir(str(path)), level)):
+                # On S3, we don't have subfolders, so exclude "."
+                folders = [folder for folder in folders if folder != "."]
+                if prune:
+                    folders = [folder for folder in folders if not prune(Path(path, folder))]
+                yield path, folders, filenames
+                next_level.extend(Path(path, folder) for folder in folders)
+            level = next_level
+
+
+class StorageEntry():
+    """
+    A file in storage found by `iter_storage_files`.
+
+    This only keeps the directory and the name of the file (using slots) so that millions of them can be processed
+    without the memory needed for a tree of StorageDirectory and StorageFile objects.
+    """
+    __slots__ = ("directory", "filename")
+
+    def __init__(self, directory:str, filename:str):
+        self.directory = directory
+        self.filename = filename
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"StorageEntry({self.path!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, StorageEntry) and (self.directory, self.filename) == (other.directory, other.filename)
+
+    def __hash__(self):
+        return hash((self.directory, self.filename))
+
+    @property
+    def path(self) -> str:
+        """ The path of the file in storage. """
+        return str(PurePosixPath(self.directory, self.filename))
+
+
+def iter_storage_files(
+    base_path="/",
+    storage=None,
+    max_workers:int=STORAGE_WALK_WORKERS,
+    include:Optional[Iterable[str]]=None,
+    exclude:Optional[Iterable[str]]=None,
+) -> Iterator[StorageEntry]:
+    """
+    Yields the files in a directory and all its subdirectories in storage while they are being listed.
+
+    Unlike `storage_walk`, no tree is built so files can be processed (e.g. downloaded) as soon as they are found
+    and memory does not grow with the number of files.
+
+    Args:
+        base_path (Union[str,Path], optional): The path of the directory. Defaults to "/".
+        storage (optional): The storage to list. Defaults to the default storage.
+        max_workers (int, optional): The number of directories to list at the same time
+            for storages which are not object stores. Defaults to STORAGE_WALK_WORKERS.
+        include (Iterable[str], optional): Glob patterns for the paths relative to the base path of the files to yield.
+            If not given then all files are yielded.
+        exclude (Iterable[str], optional): Glob patterns for the paths relative to the base path of files or directories to leave out.
+            Excluded directories are not listed.
+
+    Yields:
+        StorageEntry: Each file in the directory and its subdirectories.
+    """
+    if storage is None:
+        storage = default_storage
+
+    names = object_store_names(storage, base_path)
+    if names is not None:
+        for name in names:
+            if not path_included(name, include, exclude):
+                continue
+            directory, filename = posixpath.split(name)
+            yield StorageEntry(str(PurePosixPath(base_path, directory)), filename)
+        return
+
+    base_path = Path(base_path)
+    prune = (lambda path: path_matches(path.relative_to(base_path).as_posix(), exclude)) if exclude else None
+    for path, _, filenames in storage_listdirs(base_path, storage=storage, max_workers=max_workers, prune=prune):
+        for filename in filenames:
+            if path_included(Path(path, filename).relative_to(base_path).as_posix(), include, exclude):
+                yield StorageEntry(str(path), filename)
 
 
 def storage_walk(
-    base_path="/", storage=None, parent=None
+    base_path="/", storage=None, parent=None, max_workers:int=STORAGE_WALK_WORKERS,
 ) -> StorageDirectory:
     """
-    Recursively walks a folder, using Django's File Storage.
+    Walks a folder using Django's File Storage and returns the tree of its subdirectories and files.
+
+    Object stores are listed with a single flat prefix listing (see `object_store_names`).
+    Other storages are listed one level of directories at a time with the directories at each level listed in parallel.
+
+    Args:
+        base_path (Union[str,Path], optional): The path of the directory to walk. Defaults to "/".
+        storage (optional): The storage to walk. Defaults to the default storage.
+        parent (StorageDirectory, optional): The directory in which to put the tree. Defaults to None.
+        max_workers (int, optional): The number of directories to list at the same time. Defaults to STORAGE_WALK_WORKERS.
 
-    Adapted from https://gist.github.com/dvf/c103e697dab77c304d39d60cf279c500
+    Returns:
+        StorageDirectory: The directory at the base path.
     """
     if storage is None:
         storage = default_storage
 
-    folders, filenames = storage.listdir(str(base_path))
+    names = object_store_names(storage, base_path)
+    if names is not None:
+        directory = storage_tree(base_path, names, storage=storage)
+        directory.parent = parent
+        return unpack_tree(directory)
 
     directory = StorageDirectory(base_path=base_path, parent=parent, storage=storage)
+    directories = {Path(base_path): directory}
+    for path, folders, filenames in storage_listdirs(base_path, storage=storage, max_workers=max_workers):
+        node = directories[path]
+        for subfolder in folders:
+            directories[Path(path, subfolder)] = StorageDirectory(
+                base_path=Path(path, subfolder), parent=node, storage=storage
+            )
+
+        for filename in filenames:
+            StorageFile(filename=filename, parent=node)
+
+    return unpack_tree(directory)
+
+
+def read_indexes(
+    base_path, directory:PurePosixPath, storage=None, filenames:Optional[Iterable[str]]=None,
+) -> Iterator[Tuple[str, Dict]]:
+    """
+    Reads the JSON indexes in a directory under the base path of a dataset in the order that they were written.
+
+    Args:
+        base_path (Union[str,Path]): The base path of the dataset in storage.
+        directory (PurePosixPath): The directory with the indexes relative to the base path.
+        storage (optional): The storage with the files. Defaults to the default storage.
+        filenames (Iterable[str], optional): The names of the files in the directory if they are already known
+            (e.g. from a listing of the whole dataset) so that the directory is not listed again.
+            Otherwise object stores are listed with a flat prefix listing and other storages with ``listdir``.
+
+    Yields:
+        Tuple[str, Dict]: The path of each index relative to the base path and its contents.
+    """
+    if storage is None:
+        storage = default_storage
 
-    for subfolder in folders:
-        # On S3, we don't have subfolders, so exclude "."
-        if subfolder == ".":
+    indexes_path = Path(base_path, directory)
+    if filenames is None:
+        names = object_store_names(storage, indexes_path)
+        if names is not None:
+            filenames = [name for name in names if "/" not in name]
+        else:
+            try:
+                _, filenames = storage.listdir(str(indexes_path))
+            except FileNotFoundError:
+                return
+
+    # The names of the indexes start with the time they were written
+    for filename in sorted(filenames):
+        if not filename.endswith(".json"):
             continue
+        with storage.open(str(indexes_path/filename), "rb") as f:
+            yield (directory/filename).as_posix(), json.load(f)
+
+
+def packed_files(base_path, storage=None, filenames:Optional[Iterable[str]]=None) -> Dict[str, Dict]:
+    """
+    Reads the indexes of the archives of packed files for a dataset (see `crunch.django.app.packing`).
+
+    If a file has been packed more than once then the entry from the most recent index is used.
+
+    Args:
+        base_path (Union[str,Path]): The base path of the dataset in storage.
+        storage (optional): The storage with the files. Defaults to the default storage.
+        filenames (Iterable[str], optional): The names of the indexes if they are already known (see `read_indexes`).
+
+    Returns:
+        Dict[str, Dict]: The 'size', 'md5', 'shard' (the path of the archive relative to the base path)
+            and 'index' (the path of the index relative to the base path) for the path of each packed file relative to the base path.
+    """
+    files = dict()
+    for index_path, index in read_indexes(base_path, PACKS_DIRECTORY, storage=storage, filenames=filenames):
+        for shard in index["shards"]:
+            for entry in shard["files"]:
+                files[entry["path"]] = dict(entry, shard=(PACKS_DIRECTORY/shard["name"]).as_posix(), index=index_path)
+    return files
+
+
+def chunked_files(base_path, storage=None, filenames:Optional[Iterable[str]]=None) -> Dict[str, Dict]:
+    """
+    Reads the indexes of the files which were copied to storage as chunks for a dataset (see `crunch.django.app.chunking`).
 
-        new_base = Path(base_path, subfolder)
-        storage_walk(
-            base_path=new_base,
-            storage=storage,
-            parent=directory,
+    If a file has been chunked more than once then the entry from the most recent index is used.
+
+    Args:
+        base_path (Union[str,Path]): The base path of the dataset in storage.
+        storage (optional): The storage with the files. Defaults to the default storage.
+        filenames (Iterable[str], optional): The names of the indexes if they are already known (see `read_indexes`).
+
+    Returns:
+        Dict[str, Dict]: The 'size', 'md5', 'chunks' and 'shard' and 'index' (both the path of the index relative to the base path)
+            for the path of each chunked file relative to the base path.
+    """
+    files = dict()
+    for index_path, index in read_indexes(base_path, CHUNKS_DIRECTORY, storage=storage, filenames=filenames):
+        for entry in index["files"]:
+            files[entry["path"]] = dict(entry, shard=index_path, index=index_path)
+    return files
+
+
+def blobs_path() -> str:
+    """ The path in storage of the blobs shared by all datasets. """
+    return getattr(settings, "CRUNCH_BLOBS_PATH", DEFAULT_BLOBS_PATH)
+
+
+def blob_name(digest:str) -> str:
+    """ The name in storage of the blob with a SHA256 hash. The blobs are in directories named by the first two characters of their hashes. """
+    return posixpath.join(blobs_path(), digest[:2], digest)
+
+
+def manifest_files(base_path, storage=None, filenames:Optional[Iterable[str]]=None) -> Dict[str, Dict]:
+    """
+    Reads the manifests of the files of a dataset which are stored as blobs shared by all datasets (see `crunch.django.app.blobs`).
+
+    If a file is in more than one manifest then the entry from the most recent manifest is used.
+
+    Args:
+        base_path (Union[str,Path]): The base path of the dataset in storage.
+        storage (optional): The storage with the files. Defaults to the default storage.
+        filenames (Iterable[str], optional): The names of the manifests if they are already known (see `read_indexes`).
+
+    Returns:
+        Dict[str, Dict]: The 'size', 'md5', 'blob' (the SHA256 hash of the file) and 'shard' and 'index' (both the path of the manifest relative to the base path)
+            for the path of each file relative to the base path.
+    """
+    files = dict()
+    for manifest_path, manifest in read_indexes(base_path, MANIFESTS_DIRECTORY, storage=storage, filenames=filenames):
+        for entry in manifest["files"]:
+            files[entry["path"]] = dict(entry, shard=manifest_path, index=manifest_path)
+    return files
+
+
+# The directories which describe how files are stored rather than having the files themselves, with the functions that read them
+INDEX_DIRECTORIES = {
+    PACKS_DIRECTORY: packed_files,
+    CHUNKS_DIRECTORY: chunked_files,
+    MANIFESTS_DIRECTORY: manifest_files,
+}
+STORED_IN = {
+    PACKS_DIRECTORY: "Packed in",
+    CHUNKS_DIRECTORY: "Chunked in",
+    MANIFESTS_DIRECTORY: "Deduplicated in",
+}
+
+
+def index_layout(entry:Dict) -> PurePosixPath:
+    """ The directory of the index which an entry for a file came from (one of `INDEX_DIRECTORIES`). """
+    return PurePosixPath(entry["index"]).parent
+
+
+def indexed_files(
+    base_path, storage=None, index_filenames:Optional[Dict[PurePosixPath, Iterable[str]]]=None,
+) -> Dict[str, Dict]:
+    """
+    Reads the indexes of all the ways of storing files which are not stored by themselves for a dataset.
+
+    The names of the indexes start with the time they were written whichever directory they are in
+    so if a file is in more than one index (e.g. it was packed and later chunked) then the entry from the most recent index is used.
+
+    Args:
+        base_path (Union[str,Path]): The base path of the dataset in storage.
+        storage (optional): The storage with the files. Defaults to the default storage.
+        index_filenames (Dict[PurePosixPath, Iterable[str]], optional): The names of the files in each of the `INDEX_DIRECTORIES`
+            from a listing of the dataset which has already been made (see `index_filenames`).
+            If not given then the directories are listed.
+
+    Returns:
+        Dict[str, Dict]: The entry from the most recent index for the path of each file relative to the base path.
+    """
+    entries = [
+        entry
+        for directory, read_files in INDEX_DIRECTORIES.items()
+        for entry in read_files(
+            base_path, storage=storage, filenames=None if index_filenames is None else index_filenames.get(directory, []),
+        ).values()
+    ]
+    return {entry["path"]: entry for entry in sorted(entries, key=lambda entry: PurePosixPath(entry["index"]).name)}
+
+
+def index_filenames(paths:Iterable[str]) -> Dict[PurePosixPath, List[str]]:
+    """
+    Picks out the names of the files in each of the `INDEX_DIRECTORIES` from the paths of the files of a dataset.
+
+    Args:
+        paths (Iterable[str]): The paths of the files relative to the base path of the dataset.
+
+    Returns:
+        Dict[PurePosixPath, List[str]]: The names of the files in each index directory.
+    """
+    filenames = {directory: [] for directory in INDEX_DIRECTORIES}
+    for path in paths:
+        path = PurePosixPath(path)
+        if path.parent in filenames:
+            filenames[path.parent].append(path.name)
+    return filenames
+
+
+def storage_modified_time(name:str, storage=None) -> Optional[datetime.datetime]:
+    """ The time that a file in storage was last modified or None if the storage cannot give it. """
+    storage = storage or default_storage
+    try:
+        return storage.get_modified_time(name)
+    except NotImplementedError:
+        return None
+
+
+def index_is_newer(base_path, name:str, entry:Dict, storage=None, index_times:Optional[Dict]=None) -> bool:
+    """
+    Checks whether the index with an entry for a file was written after a copy of the file which is stored by itself.
+
+    This happens when a file is uploaded in one way (e.g. by itself) and later in another (e.g. packed into an archive).
+    Both times come from the storage so they are comparable. If the storage cannot give the times then the index is used.
+
+    Args:
+        base_path (Union[str,Path]): The base path of the dataset in storage.
+        name (str): The name in storage of the copy of the file which is stored by itself.
+        entry (Dict): The entry for the file from its index.
+        storage (optional): The storage with the files. Defaults to the default storage.
+        index_times (Dict, optional): A cache of the modification times of the indexes so that each index is only checked once.
+
+    Returns:
+        bool: True if the entry from the index is more recent than the file stored by itself.
+    """
+    index_times = {} if index_times is None else index_times
+    index_name = str(Path(base_path, entry["index"]))
+    if index_name not in index_times:
+        index_times[index_name] = storage_modified_time(index_name, storage=storage)
+
+    file_time = storage_modified_time(name, storage=storage)
+    if file_time is None or index_times[index_name] is None:
+        return True
+    return index_times[index_name] >= file_time
+
+
+def iter_latest_files(
+    base_path="/",
+    storage=None,
+    include:Optional[Iterable[str]]=None,
+    exclude:Optional[Iterable[str]]=None,
+) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """
+    Yields where the most recent copy of each file of a dataset is in storage.
+
+    A file can be stored by itself, packed into an archive, split into chunks or stored as a shared blob
+    and it can be stored in more than one of these ways if the way it was uploaded changed between runs.
+    The files stored by themselves are yielded as they are listed, unless an index written after them has the file,
+    and then the entries for the files from the indexes which have not been replaced by a more recent copy are yielded.
+
+    Args:
+        base_path (Union[str,Path], optional): The base path of the dataset in storage. Defaults to "/".
+        storage (optional): The storage with the files. Defaults to the default storage.
+        include (Iterable[str], optional): Glob patterns for the paths of the files to yield. If not given then all files are yielded.
+        exclude (Iterable[str], optional): Glob patterns for the paths of files or directories to leave out.
+
+    Yields:
+        Tuple[str, Optional[Dict]]: The path of each file relative to the base path
+            and its entry from an index or None if the file is stored by itself.
+    """
+    if storage is None:
+        storage = default_storage
+
+    # Object stores are listed once with a flat listing which also has the names of the indexes
+    filenames = None
+    names = object_store_names(storage, base_path)
+    if names is not None:
+        names = list(names)
+        filenames = index_filenames(names)
+        index_directories = [str(directory) for directory in INDEX_DIRECTORIES]
+        files = [
+            (name, str(Path(base_path, name)))
+            for name in names
+            if not path_matches(name, index_directories) and path_included(name, include, exclude)
+        ]
+    else:
+        files = (
+            (Path(file.path).relative_to(Path(base_path)).as_posix(), file.path)
+            for file in iter_storage_files(
+                base_path, storage=storage, include=include, exclude=list(exclude or []) + [str(directory) for directory in INDEX_DIRECTORIES]
+            )
         )
 
-    for filename in filenames:
-        StorageFile(filename=filename, parent=directory)
+    indexed = {
+        path: entry
+        for path, entry in indexed_files(base_path, storage=storage, index_filenames=filenames).items()
+        if path_included(path, include, exclude)
+    }
+    index_times = dict()
+    for path, name in files:
+        entry = indexed.get(path)
+        if entry is not None:
+            if index_is_newer(base_path, name, entry, storage=storage, index_times=index_times):
+                continue
+            del indexed[path]
+        yield path, None
+
+    for path, entry in sorted(indexed.items()):
+        yield path, entry
 
-    return directory
+
+def unpack_tree(root:StorageDirectory) -> StorageDirectory:
+    """
+    Replaces the directories of archives of packed files, of chunks and of manifests in a tree from storage with the files stored in them.
+
+    This lets the tree show the files which were uploaded instead of how they are stored.
+    If a file is also stored by itself then the most recent copy is shown (see `index_is_newer`).
+
+    Args:
+        root (StorageDirectory): The directory at the base path of a dataset.
+
+    Returns:
+        StorageDirectory: The same directory.
+    """
+    def child_directory(directory:StorageDirectory, name:str, create:bool=False) -> Optional[StorageDirectory]:
+        for child in directory.children:
+            if isinstance(child, StorageDirectory) and child.base_path.name == name:
+                return child
+        if create:
+            return StorageDirectory(base_path=Path(directory.base_path, name), storage=root.storage, parent=directory)
+        return None
+
+    # The names of the indexes come from the tree so that the storage is not listed again
+    filenames = {}
+    for storage_directory in INDEX_DIRECTORIES:
+        filenames[storage_directory] = []
+        directory = root
+        for part in storage_directory.parts:
+            directory = child_directory(directory, part)
+            if directory is None:
+                break
+        if directory is None:
+            continue
+
+        filenames[storage_directory] = [child.filename for child in directory.children if isinstance(child, StorageFile)]
+        crunch_directory = directory.parent
+        directory.parent = None
+        if not crunch_directory.children:
+            crunch_directory.parent = None
+
+    index_times = dict()
+    indexed = indexed_files(root.base_path, storage=root.storage, index_filenames=filenames)
+    for path, entry in sorted(indexed.items()):
+        directory = root
+        path = PurePosixPath(path)
+        for part in path.parent.parts:
+            directory = child_directory(directory, part, create=True)
+
+        existing = next(
+            (child for child in directory.children if isinstance(child, StorageFile) and child.filename == path.name), None
+        )
+        if existing is None:
+            StorageFile(filename=path.name, parent=directory, shard=entry["shard"])
+        elif index_is_newer(root.base_path, str(existing.path()), entry, storage=root.storage, index_times=index_times):
+            existing.shard = entry["shard"]
+
+    return root
+
+
+def storage_tree(
+    base_path, paths, storage=None, depth:Optional[int]=None, shards:Optional[Dict[str, str]]=None,
+) -> StorageDirectory:
+    """
+    Builds the tree of directories and files for a list of file paths without listing the storage.
+
+    Args:
+        base_path (Union[str,Path]): The path in the storage of the root directory.
+        paths (Iterable[str]): The paths of the files relative to the base path.
+        storage (optional): The storage with the files. Defaults to the default storage when URLs are needed.
+        depth (int, optional): The number of levels of directories to include the files for.
+            Directories below this have no files or subdirectories in the tree and are marked as collapsed.
+            If None then all files are included. Defaults to None.
+        shards (Dict[str, str], optional): The archive which each packed file is in, keyed by the path of the file.
+
+    Returns:
+        StorageDirectory: The root directory.
+    """
+    shards = shards or {}
+    root = StorageDirectory(base_path=base_path, storage=storage)
+    directories = {Path("."): root}
+
+    def directory(relative_path: Path) -> StorageDirectory:
+        if relative_path not in directories:
+            directories[relative_path] = StorageDirectory(
+                base_path=Path(base_path, relative_path), storage=storage, parent=directory(relative_path.parent)
+            )
+        return directories[relative_path]
+
+    paths = sorted(Path(path) for path in paths)
+    collapsed = set()
+    if depth is not None:
+        collapsed = {Path(*path.parts[:depth + 1]) for path in paths if len(path.parts) > depth + 1}
+        paths = [path for path in paths if len(path.parts) <= depth + 1]
+
+    # Add the directories before the files so that subdirectories are listed first as in storage_walk
+    for path in sorted(collapsed | {path.parent for path in paths}):
+        directory(path).collapsed = path in collapsed
+    for path in paths:
+        StorageFile(filename=path.name, parent=directories[path.parent], shard=shards.get(path.as_posix()))
+
+    return root
+
+
+def storage_md5(name: str, storage=None) -> str:
+    """ Calculates the MD5 checksum of a file in storage. """
+    storage = storage or default_storage
+    md5 = hashlib.md5()
+    with storage.open(name, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 def default_dataset_path(project_slug, dataset_slug):
@@ -211,26 +903,106 @@ def copy_to_storage(paths, local_dir, base="/", storage=None):
             storage._save(remote_path, File(f, name=str(local_path)))  
 
 
-def copy_recursive_from_storage(base="/", local_dir=".", storage=None):
-    base = Path(base)
+def copy_from_storage(name:str, local_path:Path, storage=None):
+    """ Copies a single file from storage to a local path, creating the local directory if needed. """
+    if storage is None:
+        storage = default_storage
+
+    local_path = Path(local_path)
+    local_path.parent.mkdir(exist_ok=True, parents=True)
+    with storage.open(name, "rb") as source:
+        with open(local_path, "wb") as target:
+            shutil.copyfileobj(source, target, length=COPY_BUFFER_SIZE)
+
+
+def copy_manifest_files_from_storage(
+    base="/",
+    local_dir=".",
+    storage=None,
+    include:Optional[Iterable[str]]=None,
+    exclude:Optional[Iterable[str]]=None,
+    files:Optional[Dict[str, Dict]]=None,
+) -> List[str]:
+    """
+    Copies the files of a dataset which are stored as shared blobs from storage to a local directory.
+
+    Args:
+        base (Union[str,Path], optional): The base path of the dataset in storage. Defaults to "/".
+        local_dir (Path, optional): The local directory to copy the files to. Defaults to ".".
+        storage (optional): The storage with the files. Defaults to the default storage.
+        include (Iterable[str], optional): Glob patterns for the paths of the files to copy. If not given then all files are copied.
+        exclude (Iterable[str], optional): Glob patterns for the paths of files or directories not to copy.
+        files (Dict[str, Dict], optional): The entries from the manifests of the files to copy keyed by path.
+            Defaults to the most recent entry for each file in the manifests of the dataset.
+
+    Raises:
+        ValueError: If a file in a manifest is outside the local directory.
+
+    Returns:
+        List[str]: The paths relative to the local directory of the copied files.
+    """
     local_dir = Path(local_dir)
     if storage is None:
         storage = default_storage
+    if files is None:
+        files = manifest_files(base, storage=storage)
 
-    dir_object = storage_walk(base_path=base, storage=storage)
-    subdirs = dir_object.directory_descendents()
+    copied = []
+    for path, entry in sorted(files.items()):
+        if not path_included(path, include, exclude):
+            continue
 
-    for subdir in subdirs:
-        listing_path = Path(subdir.base_path)
-        relative_path = listing_path.relative_to(base)
-        local_path = local_dir / relative_path
-        local_path.mkdir(exist_ok=True, parents=True)
+        relative_path = PurePosixPath(path)
+        if relative_path.is_absolute() or ".." in relative_path.parts:
+            raise ValueError(f"Cannot copy '{path}' from '{entry['shard']}' outside of '{local_dir}'.")
 
-        for file in subdir.files():
-            filename = file.filename
-            print(
-                f"Copying '{filename}' in '{listing_path}' from storage to '{local_path}'"
-            )
-            with storage.open(str(listing_path / filename), "rb") as source:
-                with open(local_path / filename, "wb") as target:
-                    shutil.copyfileobj(source, target, length=1024)
+        print(f"Copying '{path}' from blob '{entry['blob']}' in storage to '{local_dir}'")
+        copy_from_storage(blob_name(entry["blob"]), local_dir/relative_path, storage=storage)
+        copied.append(path)
+
+    return copied
+
+
+def copy_recursive_from_storage(
+    base="/",
+    local_dir=".",
+    storage=None,
+    include:Optional[Iterable[str]]=None,
+    exclude:Optional[Iterable[str]]=None,
+) -> Dict[str, Dict]:
+    """
+    Copies the most recent copy of each file of a dataset from storage to a local directory (see `iter_latest_files`).
+
+    Files stored by themselves are copied as they are listed and files stored as shared blobs are copied after them.
+    Files which are packed into archives or split into chunks are returned so that they can be extracted
+    with `crunch.django.app.packing.unpack_from_storage` and `crunch.django.app.chunking.reassemble_from_storage`.
+
+    Args:
+        base (Union[str,Path], optional): The base path of the dataset in storage. Defaults to "/".
+        local_dir (Path, optional): The local directory to copy the files to. Defaults to ".".
+        storage (optional): The storage with the files. Defaults to the default storage.
+        include (Iterable[str], optional): Glob patterns for the paths of the files to copy. If not given then all files are copied.
+        exclude (Iterable[str], optional): Glob patterns for the paths of files or directories not to copy.
+
+    Returns:
+        Dict[str, Dict]: The entries from the indexes of the files which are packed or chunked and were not copied, keyed by path.
+    """
+    base = Path(base)
+    local_dir = Path(local_dir)
+    if storage is None:
+        storage = default_storage
+
+    manifest_entries = dict()
+    remaining = dict()
+    for path, entry in iter_latest_files(base, storage=storage, include=include, exclude=exclude):
+        if entry is None:
+            local_path = local_dir/path
+            print(f"Copying '{path}' in '{base}' from storage to '{local_path}'")
+            copy_from_storage(str(base/path), local_path, storage=storage)
+        elif index_layout(entry) == MANIFESTS_DIRECTORY:
+            manifest_entries[path] = entry
+        else:
+            remaining[path] = entry
+
+    copy_manifest_files_from_storage(base, local_dir, storage=storage, files=manifest_entries)
+    return remaining
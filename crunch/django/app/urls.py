@@ -25,20 +25,29 @@ urlpatterns = [
     path('api/', include( (router.urls, 'api') )),
     path('api/statuses/', views.StatusListCreateAPIView.as_view(), name='status-list'),
     path('api/next/', views.NextDatasetReference.as_view(), name='next'),
+    path('api/metrics/', views.MetricsAPIView.as_view(), name='metrics'),
+    path('api/search/', views.ItemSearchAPIView.as_view(), name='search-api'),
+    path('search/', views.ItemSearchView.as_view(), name='search'),
 
     path('projects/', RedirectView.as_view(url="..", permanent=False)),
     path("projects/create/", views.ProjectCreateView.as_view(), name="project-create"),
     path('projects/<str:slug>/', views.ProjectDetailView.as_view(), name='project-detail'),
     path("projects/<str:slug>/update/", views.ProjectUpdateView.as_view(), name="project-update"),
     path("api/projects/<str:slug>/next/", views.ProjectNextDatasetReference.as_view(), name="project-api-next"),
+    path("api/projects/<str:slug>/export/", views.ProjectExportAPIView.as_view(), name="project-api-export"),
+    path("api/projects/<str:slug>/attributes/", views.ProjectAttributeTableAPIView.as_view(), name="project-api-attributes"),
     
+    path("api/datasets/<str:slug>/files/", views.DatasetFileListCreateAPIView.as_view(), name="dataset-api-files"),
     path("datasets/create/", views.DatasetCreateView.as_view(), name="dataset-create"),
     path('projects/<str:project>/datasets/', RedirectView.as_view(url="..", permanent=False)),
     path('projects/<str:project>/datasets/<str:slug>', views.DatasetDetailView.as_view(), name='dataset-detail'),
+    path("projects/<str:project>/datasets/<str:slug>/files/", views.DatasetFilesView.as_view(), name="dataset-files"),
     path("projects/<str:project>/datasets/<str:slug>/update/", views.DatasetUpdateView.as_view(), name="dataset-update"),
 
     path("items/create/", views.ItemCreateView.as_view(), name="item-create"),
     path('items/<str:slug>/', views.ItemDetailView.as_view(), name='item-detail'),
     path('items/<str:slug>/map/', views.ItemMapView.as_view(), name='item-map'),
+    path('api/items/<str:slug>/geojson/', views.ItemGeoJSONAPIView.as_view(), name='item-api-geojson'),
+    path('api/items/<str:slug>/locations/', views.ItemLocationsAPIView.as_view(), name='item-api-locations'),
     path('items/<str:slug>/update/', views.ItemUpdateView.as_view(), name='item-update'),
 ]
\ No newline at end of file
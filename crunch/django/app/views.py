@@ -1,4 +1,5 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.views.generic import ListView, DetailView, CreateView, UpdateView
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from rest_framework import viewsets
@@ -6,7 +7,11 @@ from rest_framework import permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import generics
-from . import models, serializers
+from rest_framework import status as drf_status
+from rest_framework.exceptions import ValidationError
+from django.db.models import Prefetch, Q
+from . import models, serializers, instrumentation, pagination, export, filters, search, mapping
+from .conditional import ConditionalRetrieveMixin
 
 
 ######################################################
@@ -40,7 +45,7 @@ class ProjectUpdateView(PermissionRequiredMixin, UpdateView):
     )
 
 
-class ProjectAPI(viewsets.ModelViewSet):
+class ProjectAPI(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows projects to be viewed or edited.
     """
@@ -49,6 +54,59 @@ class ProjectAPI(viewsets.ModelViewSet):
     permission_classes = [permissions.DjangoModelPermissions]
     lookup_field = 'slug'
 
+    def get_validator_querysets(self, lookup_value):
+        return [models.Project.objects.non_polymorphic().filter(slug=lookup_value)]
+
+
+class ProjectExportAPIView(APIView):
+    """
+    Streams the project, its datasets and their items with their attributes as newline-delimited JSON.
+    """
+    permission_classes = [permissions.IsAuthenticated] # should be 'view_project'
+
+    def get(self, request, format=None, slug=None):
+        project = get_object_or_404(models.Project, slug=slug)
+        response = StreamingHttpResponse(
+            export.export_project_ndjson(project),
+            content_type="application/x-ndjson",
+        )
+        response["Content-Disposition"] = f'attachment; filename="{project.slug}.ndjson"'
+        return response
+
+
+class ProjectAttributeTableAPIView(APIView):
+    """
+    Returns all the attributes of a project as a Parquet or Arrow table.
+
+    Use the 'layout' query parameter for 'long' (a row for each attribute) or 'wide' (a row for each item)
+    and the 'table_format' query parameter for 'parquet' or 'arrow'.
+    """
+    permission_classes = [permissions.IsAuthenticated] # should be 'view_project'
+
+    def get(self, request, format=None, slug=None):
+        from io import BytesIO
+        from . import analytics
+
+        project = get_object_or_404(models.Project, slug=slug)
+        layout = request.query_params.get("layout", "long")
+        table_format = request.query_params.get("table_format", "parquet")
+        buffer = BytesIO()
+        try:
+            if layout not in analytics.LAYOUTS or table_format not in analytics.FORMATS:
+                raise analytics.AttributeTableException(
+                    f"Please use a layout from {analytics.LAYOUTS} and a table format from {analytics.FORMATS}."
+                )
+            table = analytics.attribute_table(project, layout=layout)
+            analytics.write_attribute_table(table, buffer, format=table_format)
+        except analytics.AttributeTableException as err:
+            return Response(dict(detail=str(err)), status=400)
+
+        extension = "parquet" if table_format == "parquet" else "arrow"
+        content_type = "application/vnd.apache.parquet" if table_format == "parquet" else "application/vnd.apache.arrow.file"
+        response = HttpResponse(buffer.getvalue(), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{project.slug}-attributes-{layout}.{extension}"'
+        return response
+
 
 ######################################################
 ##  Dataset Views
@@ -61,15 +119,102 @@ class DatasetDetailView(PermissionRequiredMixin, DetailView):
     lookup_field = 'slug'
 
 
-class DatasetAPI(viewsets.ModelViewSet):
+class DatasetFilesView(DatasetDetailView):
+    """
+    Streams the HTML for the tree of files in a directory of a dataset.
+
+    This loads the contents of collapsed directories in the tree on the dataset page when they are expanded.
+    """
+    def get(self, request, project, slug) -> StreamingHttpResponse:
+        dataset = self.get_object()
+        tree = dataset.files(path=request.GET.get("path", ""), depth=1)
+        return StreamingHttpResponse(
+            tree.iter_render_html(expand_url=dataset.expand_files_url),
+            content_type="text/html; charset=utf-8",
+        )
+
+
+class DatasetAPI(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows datasets to be viewed or edited.
     """
     queryset = models.Dataset.objects.all()
     serializer_class = serializers.DatasetSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
     lookup_field = 'slug'
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if serializers.includes_field(self.request, "attributes"):
+            queryset = queryset.prefetch_related("attributes")
+        if serializers.includes_field(self.request, "items"):
+            children = models.Item.objects.order_by("lft")
+            if serializers.includes_field(self.request, "items.attributes"):
+                children = children.prefetch_related("attributes")
+            queryset = queryset.prefetch_related(Prefetch("children", queryset=children))
+        return queryset
+
+    def filter_queryset(self, queryset):
+        """
+        Filters the list of datasets by project and by their attributes.
+
+        Datasets can be restricted to a project with '?project=<slug>' and to the ones with matching attributes
+        with parameters in the form '?<type>:<key>__<lookup>=<value>' (e.g. '?float:quality__gt=0.9&char:species=Homo sapiens').
+        """
+        queryset = super().filter_queryset(queryset)
+        if self.action != "list":
+            return queryset
+
+        project = self.request.query_params.get("project")
+        if project:
+            queryset = queryset.filter(parent__slug=project)
+
+        attribute_filters = [
+            (name, value)
+            for name in self.request.query_params
+            if ":" in name
+            for value in self.request.query_params.getlist(name)
+        ]
+        try:
+            return filters.filter_by_attributes(queryset, attribute_filters)
+        except filters.AttributeFilterException as err:
+            raise ValidationError({"detail": str(err)})
+
+    def get_validator_querysets(self, lookup_value):
+        # The detail response includes the dataset and, unless they are excluded with sparse fieldsets, its items and the attributes of both
+        querysets = [models.Dataset.objects.non_polymorphic().filter(slug=lookup_value)]
+        if serializers.includes_field(self.request, "items"):
+            querysets.append(models.Item.objects.non_polymorphic().filter(parent__slug=lookup_value))
+        if serializers.includes_field(self.request, "attributes") or serializers.includes_field(self.request, "items.attributes"):
+            querysets.append(
+                models.Attribute.objects.non_polymorphic().filter(Q(item__slug=lookup_value) | Q(item__parent__slug=lookup_value))
+            )
+        return querysets
+
+
+class DatasetFileListCreateAPIView(generics.ListCreateAPIView):
+    """
+    API endpoint for the index of the files in storage for a dataset.
+
+    Files are listed from the index rather than the storage.
+    Posting a list of files adds them to the index or updates them if they are already in it.
+    """
+    queryset = models.DatasetFile.objects.all()
+    serializer_class = serializers.DatasetFileSerializer
+    pagination_class = pagination.CreatedCursorPagination
+
+    def get_queryset(self):
+        return super().get_queryset().filter(dataset__slug=self.kwargs["slug"])
+
+    def create(self, request, *args, **kwargs):
+        dataset = get_object_or_404(models.Dataset.objects.all(), slug=self.kwargs["slug"])
+        many = isinstance(request.data, list)
+        serializer = self.get_serializer(data=request.data, many=many)
+        serializer.is_valid(raise_exception=True)
+        count = dataset.index_files(serializer.validated_data if many else [serializer.validated_data])
+        return Response({"indexed": count}, status=drf_status.HTTP_201_CREATED)
+
 
 class DatasetCreateView(PermissionRequiredMixin, CreateView):
     model = models.Dataset
@@ -119,6 +264,7 @@ class NextDatasetReference(APIView):
 class StatusListCreateAPIView(generics.ListCreateAPIView):
     queryset = models.Status.objects.all()
     serializer_class = serializers.StatusSerializer
+    pagination_class = pagination.CreatedCursorPagination
 
     def perform_create(self, serializer):
         serializer.save(
@@ -126,6 +272,20 @@ class StatusListCreateAPIView(generics.ListCreateAPIView):
         )
 
 
+class MetricsAPIView(APIView):
+    """
+    Returns histograms of the request latency, database time, serializer time and query counts for each view
+    in the Prometheus text format.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        return HttpResponse(
+            instrumentation.registry.render(), 
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
 ######################################################
 ##  Item Views
 ######################################################
@@ -154,9 +314,71 @@ class ItemUpdateView(PermissionRequiredMixin, UpdateView):
 class ItemMapView(ItemDetailView):
     def get(self, request, slug) -> HttpResponse:
         item = self.get_object()
-        map = item.map()
-        html = map.to_html(as_string=True) if map else "<p>No map available</p>"
-        return HttpResponse(html)
+        return HttpResponse(mapping.item_map_html(item))
+
+
+class ItemGeoJSONAPIView(APIView):
+    """
+    API endpoint with the locations of an item and all its descendants as a GeoJSON FeatureCollection.
+    """
+    permission_classes = [permissions.IsAuthenticated] # should be 'view_item'
+
+    def get(self, request, slug):
+        item = get_object_or_404(models.Item.objects.non_polymorphic(), slug=slug)
+        return Response(mapping.item_geojson(item), content_type="application/geo+json")
+
+
+class ItemSearchView(PermissionRequiredMixin, ListView):
+    """
+    Shows the items which match a full-text search given with the 'q' query parameter, ordered from the best match.
+    """
+    template_name = "crunch/item_search.html"
+    paginate_by = 50
+    permission_required = "crunch.view_item"
+
+    def get_queryset(self):
+        return search.SearchResults(self.request.GET.get("q", ""))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.request.GET.get("q", "")
+        return context
+
+
+class ItemSearchAPIView(generics.ListAPIView):
+    """
+    API endpoint that searches the names, descriptions and details of items given with the 'q' query parameter.
+
+    The results are ordered from the best match and paginated by page number.
+    """
+    serializer_class = serializers.SearchResultSerializer
+    pagination_class = pagination.SearchPagination
+    permission_classes = [permissions.IsAuthenticated] # should be 'view_item'
+
+    def get_queryset(self):
+        return search.SearchResults(self.request.query_params.get("q", ""))
+
+
+class ItemLocationsAPIView(APIView):
+    """
+    API endpoint with the locations of an item and its descendants inside a map viewport as a GeoJSON FeatureCollection.
+
+    The viewport is given by the 'bbox' query parameter as 'west,south,east,north' and the 'zoom' level of the map.
+    Locations are clustered on a geohash grid when there are too many in the viewport to show individually.
+    """
+    permission_classes = [permissions.IsAuthenticated] # should be 'view_item'
+
+    def get(self, request, slug):
+        item = get_object_or_404(models.Item.objects.non_polymorphic(), slug=slug)
+        try:
+            bbox = mapping.parse_bbox(request.query_params["bbox"]) if request.query_params.get("bbox") else None
+            zoom = int(request.query_params.get("zoom", 0))
+        except mapping.MapException as err:
+            raise ValidationError({"detail": str(err)})
+        except ValueError:
+            raise ValidationError({"detail": "The zoom level should be an integer."})
+
+        return Response(mapping.viewport_geojson(item, bbox=bbox, zoom=zoom), content_type="application/geo+json")
 
 
 class ItemAPI(viewsets.ModelViewSet):
@@ -165,9 +387,16 @@ class ItemAPI(viewsets.ModelViewSet):
     """
     queryset = models.Item.objects.all()
     serializer_class = serializers.ItemSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
     lookup_field = 'slug'
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if serializers.includes_field(self.request, "attributes"):
+            queryset = queryset.prefetch_related("attributes")
+        return queryset
+
 
 ######################################################
 ##  Attribute Views
@@ -176,58 +405,68 @@ class ItemAPI(viewsets.ModelViewSet):
 class CharAttributeAPI(viewsets.ModelViewSet):
     queryset = models.CharAttribute.objects.all()
     serializer_class = serializers.CharAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class FloatAttributeAPI(viewsets.ModelViewSet):
     queryset = models.FloatAttribute.objects.all()
     serializer_class = serializers.FloatAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class IntegerAttributeAPI(viewsets.ModelViewSet):
     queryset = models.IntegerAttribute.objects.all()
     serializer_class = serializers.IntegerAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class FilesizeAttributeAPI(viewsets.ModelViewSet):
     queryset = models.FilesizeAttribute.objects.all()
     serializer_class = serializers.FilesizeAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class BooleanAttributeAPI(viewsets.ModelViewSet):
     queryset = models.BooleanAttribute.objects.all()
     serializer_class = serializers.BooleanAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class FloatAttributeAPI(viewsets.ModelViewSet):
     queryset = models.FloatAttribute.objects.all()
     serializer_class = serializers.FloatAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class URLAttributeAPI(viewsets.ModelViewSet):
     queryset = models.URLAttribute.objects.all()
     serializer_class = serializers.URLAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class LatLongAttributeAPI(viewsets.ModelViewSet):
     queryset = models.LatLongAttribute.objects.all()
     serializer_class = serializers.LatLongAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class DateTimeAttributeAPI(viewsets.ModelViewSet):
     queryset = models.DateTimeAttribute.objects.all()
     serializer_class = serializers.DateTimeAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
 
 
 class DateAttributeAPI(viewsets.ModelViewSet):
     queryset = models.DateAttribute.objects.all()
     serializer_class = serializers.DateAttributeSerializer
+    pagination_class = pagination.CreatedCursorPagination
     permission_classes = [permissions.DjangoModelPermissions]
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 import os
 from pathlib import Path
+from importlib.util import find_spec
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path.cwd()
@@ -89,6 +90,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'crunch.django.app.instrumentation.InstrumentationMiddleware',
+    'crunch.django.app.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -195,8 +198,28 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.DjangoModelPermissions",),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
+# MessagePack is an optional compact binary alternative to JSON for the API
+if find_spec("msgpack"):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].append('crunch.django.app.renderers.MessagePackRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].append('crunch.django.app.renderers.MessagePackParser')
+
+# Responses smaller than this number of bytes are not compressed
+CRUNCH_COMPRESSION_MIN_SIZE = 1024
+
+# Whether to record the queries and timings of each request in a Server-Timing header and at /api/metrics/
+CRUNCH_INSTRUMENTATION = False
+
 SITE_ID = 1
 X_FRAME_OPTIONS = 'SAMEORIGIN'
 
@@ -0,0 +1,56 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from crunch.django.app import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a synthetic tree of projects, datasets, items, attributes and statuses "
+        "and measures the time and number of SQL queries for the hot queries and API endpoints. "
+        "Use the --settings option to run against another database (e.g. PostgreSQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projects', type=int, default=2, help="The number of projects to generate.")
+        parser.add_argument('--datasets', type=int, default=10, help="The number of datasets in each project.")
+        parser.add_argument('--items', type=int, default=5, help="The number of items in each dataset.")
+        parser.add_argument('--attributes', type=int, default=5, help="The number of attributes on each item.")
+        parser.add_argument('--statuses', type=int, default=3, help="The number of statuses for each processed dataset.")
+        parser.add_argument('--repeat', type=int, default=3, help="The number of times to time each measurement.")
+        parser.add_argument('--no-endpoints', action='store_true', help="Only measure the querysets and not the API endpoints.")
+        parser.add_argument('--keep', action='store_true', help="Keep the synthetic data in the database afterwards.")
+        parser.add_argument('--output', type=str, default="", help="A path to write the results as JSON.")
+        parser.add_argument('--baseline', type=str, default="", help="A path to the JSON results of a previous benchmark to compare with.")
+        parser.add_argument('--tolerance', type=float, default=0.5, help="The fractional increase in mean time allowed compared to the baseline.")
+
+    def handle(self, *args, **options):
+        result = benchmark.run_benchmark(
+            projects=options['projects'],
+            datasets=options['datasets'],
+            items=options['items'],
+            attributes=options['attributes'],
+            statuses=options['statuses'],
+            repeat=options['repeat'],
+            endpoints=not options['no_endpoints'],
+            keep=options['keep'],
+        )
+
+        for measurement in result["results"]:
+            self.stdout.write(
+                f"{measurement['name']:<45} {measurement['queries']:>6} queries {measurement['mean']*1000:>10.2f} ms"
+            )
+
+        for payload in result.get("payloads", []):
+            self.stdout.write(
+                f"{'Dataset payload ' + payload['name']:<45} {payload['size']:>6} bytes   {payload['mean']*1000:>10.2f} ms"
+            )
+
+        if options['output']:
+            benchmark.write_results(result, options['output'])
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = benchmark.compare_results(baseline, result, tolerance=options['tolerance'])
+            if regressions:
+                raise CommandError("Regressions found:\n" + "\n".join(regressions))
@@ -0,0 +1,28 @@
+import datetime
+from django.core.management.base import BaseCommand
+from crunch.django.app import blobs
+from crunch.django.app.models import Dataset
+
+class Command(BaseCommand):
+    help = 'Deletes the shared blobs in storage which are not listed in the manifest of any dataset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age', type=float, default=blobs.DEFAULT_GARBAGE_MIN_AGE.total_seconds() / 3600,
+            help="Only delete blobs which were last modified more than this number of hours ago so that blobs from runs which are still uploading are kept.",
+        )
+        parser.add_argument('--dry-run', action='store_true', help="List the unreferenced blobs without deleting them.")
+
+    def handle(self, *args, **options):
+        base_paths = Dataset.objects.values_list("base_file_path", flat=True).iterator()
+        referenced = blobs.referenced_blobs(base_paths)
+        unreferenced = blobs.collect_garbage(
+            referenced,
+            min_age=datetime.timedelta(hours=options['min_age']),
+            dry_run=options['dry_run'],
+        )
+        for name in unreferenced:
+            self.stdout.write(name)
+
+        action = "Found" if options['dry_run'] else "Deleted"
+        self.stdout.write(f"{action} {len(unreferenced)} unreferenced blobs. {len(referenced)} blobs are referenced.")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from crunch.django.app import models
+from crunch.django.app.analytics import attribute_table, write_attribute_table, AttributeTableException, LAYOUTS, FORMATS
+
+class Command(BaseCommand):
+    help = 'Writes all the attributes of a project to a Parquet or Arrow table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('project', type=str, help="The slug of the project.")
+        parser.add_argument('output', type=str, help="The path to write the table to.")
+        parser.add_argument('--layout', type=str, default="long", choices=LAYOUTS, help="Whether to have a row for each attribute (long) or for each item (wide).")
+        parser.add_argument('--format', type=str, default="parquet", choices=FORMATS, help="The file format of the table.")
+
+    def handle(self, *args, **options):
+        project = models.Project.objects.filter(slug=options['project']).first()
+        if not project:
+            raise CommandError(f"Project '{options['project']}' not found.")
+
+        try:
+            table = attribute_table(project, layout=options['layout'])
+            write_attribute_table(table, options['output'], format=options['format'])
+        except AttributeTableException as err:
+            raise CommandError(str(err))
+
+        self.stdout.write(f"Wrote {len(table)} rows to {options['output']}")
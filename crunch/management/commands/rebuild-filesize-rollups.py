@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from crunch.django.app.rollups import rebuild_filesize_rollups
+
+class Command(BaseCommand):
+    help = 'Recalculates the cached totals of the filesize attributes for every item and its descendants.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="The number of rollups to create in each query.")
+
+    def handle(self, *args, **options):
+        count = rebuild_filesize_rollups(batch_size=options['batch_size'])
+        self.stdout.write(f"Rebuilt filesize rollups for {count} items.")
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from crunch.django.app.mapping import rebuild_geohashes
+
+class Command(BaseCommand):
+    help = 'Recalculates the geohashes of locations which were created or changed without being saved individually (e.g. with a queryset update).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="The number of locations to update in each query.")
+
+    def handle(self, *args, **options):
+        count = rebuild_geohashes(batch_size=options['batch_size'])
+        self.stdout.write(f"Rebuilt geohashes for {count} locations.")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from crunch.django.app.models import Dataset
+
+class Command(BaseCommand):
+    help = 'Replaces the index of the files of datasets with a listing of the storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', type=str, nargs='*', help="The slugs of the datasets to refresh. If none are given then all datasets are refreshed.")
+        parser.add_argument('--project', type=str, default="", help="Only refresh the datasets in the project with this slug.")
+        parser.add_argument('--checksums', action='store_true', help="Read each file to calculate its MD5 checksum.")
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.all()
+        if options['datasets']:
+            datasets = datasets.filter(slug__in=options['datasets'])
+        if options['project']:
+            datasets = datasets.filter(parent__slug=options['project'])
+
+        for dataset in datasets.iterator():
+            count = dataset.refresh_file_index(checksums=options['checksums'])
+            self.stdout.write(f"Indexed {count} files for {dataset.slug}.")
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-19 11:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_filesize_rollups(apps, schema_editor):
+    from crunch.django.app.rollups import calculate_filesize_rollups
+
+    Item = apps.get_model('crunch', 'Item')
+    FilesizeAttribute = apps.get_model('crunch', 'FilesizeAttribute')
+    FilesizeRollup = apps.get_model('crunch', 'FilesizeRollup')
+
+    sums = {
+        row['item_id']: (row['total'], row['count'])
+        for row in FilesizeAttribute.objects.order_by().values('item_id').annotate(
+            total=models.Sum('value'), count=models.Count('pk')
+        )
+    }
+    items = Item.objects.order_by('tree_id', 'lft').values_list('pk', 'tree_id', 'lft', 'rght')
+    rollups = calculate_filesize_rollups(items.iterator(), sums)
+    FilesizeRollup.objects.bulk_create(
+        [FilesizeRollup(item_id=pk, total=total, count=count) for pk, (total, count) in rollups.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0011_dataset_locked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilesizeRollup',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='filesize_rollup', serialize=False, to='crunch.item')),
+                ('total', models.PositiveBigIntegerField(default=0, help_text='The sum of the filesize attributes of this item and its descendants in bytes.')),
+                ('count', models.PositiveIntegerField(default=0, help_text='The number of filesize attributes of this item and its descendants.')),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='item',
+            options={'base_manager_name': 'objects', 'ordering': ('created', 'pk')},
+        ),
+        migrations.AlterField(
+            model_name='project',
+            name='workflow',
+            field=models.TextField(blank=True, default='', help_text='URL to snakemake repository/shell script or its content.'),
+        ),
+        migrations.RunPython(populate_filesize_rollups, migrations.RunPython.noop),
+    ]
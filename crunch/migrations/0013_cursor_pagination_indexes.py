@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0012_filesizerollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attribute',
+            index=models.Index(fields=['created', 'id'], name='crunch_attr_created_7a93b2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['created', 'id'], name='crunch_item_created_c78367_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='status',
+            index=models.Index(fields=['created', 'id'], name='crunch_stat_created_e4214a_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0013_cursor_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attribute',
+            index=models.Index(fields=['key', 'item'], name='crunch_attr_key_53b942_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booleanattribute',
+            index=models.Index(fields=['value'], name='crunch_bool_value_ee7865_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='charattribute',
+            index=models.Index(fields=['value'], name='crunch_char_value_11368b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dateattribute',
+            index=models.Index(fields=['value'], name='crunch_date_value_e3d7c9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='datetimeattribute',
+            index=models.Index(fields=['value'], name='crunch_date_value_42c228_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='filesizeattribute',
+            index=models.Index(fields=['value'], name='crunch_file_value_262ca6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='floatattribute',
+            index=models.Index(fields=['value'], name='crunch_floa_value_a48142_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='integerattribute',
+            index=models.Index(fields=['value'], name='crunch_inte_value_210693_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='urlattribute',
+            index=models.Index(fields=['value'], name='crunch_urla_value_e24faa_idx'),
+        ),
+    ]
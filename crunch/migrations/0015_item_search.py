@@ -0,0 +1,62 @@
+from django.db import migrations
+
+
+POSTGRESQL_DOCUMENT = (
+    "setweight(to_tsvector('english'::regconfig, COALESCE(name, '')), 'A') || "
+    "setweight(to_tsvector('english'::regconfig, COALESCE(description, '')), 'B') || "
+    "setweight(to_tsvector('english'::regconfig, COALESCE(details, '')), 'C')"
+)
+
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE crunch_item_search USING fts5("
+    "name, description, details, content='crunch_item', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER crunch_item_search_insert AFTER INSERT ON crunch_item BEGIN "
+    "INSERT INTO crunch_item_search(rowid, name, description, details) VALUES (new.id, new.name, new.description, new.details); "
+    "END",
+    "CREATE TRIGGER crunch_item_search_delete AFTER DELETE ON crunch_item BEGIN "
+    "INSERT INTO crunch_item_search(crunch_item_search, rowid, name, description, details) "
+    "VALUES ('delete', old.id, old.name, old.description, old.details); "
+    "END",
+    "CREATE TRIGGER crunch_item_search_update AFTER UPDATE OF name, description, details ON crunch_item BEGIN "
+    "INSERT INTO crunch_item_search(crunch_item_search, rowid, name, description, details) "
+    "VALUES ('delete', old.id, old.name, old.description, old.details); "
+    "INSERT INTO crunch_item_search(rowid, name, description, details) VALUES (new.id, new.name, new.description, new.details); "
+    "END",
+    "INSERT INTO crunch_item_search(crunch_item_search) VALUES ('rebuild')",
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS crunch_item_search_update",
+    "DROP TRIGGER IF EXISTS crunch_item_search_delete",
+    "DROP TRIGGER IF EXISTS crunch_item_search_insert",
+    "DROP TABLE IF EXISTS crunch_item_search",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(f"CREATE INDEX crunch_item_search_idx ON crunch_item USING GIN (({POSTGRESQL_DOCUMENT}))")
+    elif vendor == "sqlite":
+        for sql in SQLITE_CREATE:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS crunch_item_search_idx")
+    elif vendor == "sqlite":
+        for sql in SQLITE_DROP:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0014_attribute_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+def populate_geohashes(apps, schema_editor):
+    from crunch.django.app.geohash import encode_geohash
+
+    LatLongAttribute = apps.get_model('crunch', 'LatLongAttribute')
+    batch = []
+    for attribute in LatLongAttribute.objects.only('pk', 'latitude', 'longitude').iterator(chunk_size=2000):
+        attribute.geohash = encode_geohash(attribute.latitude, attribute.longitude)
+        batch.append(attribute)
+        if len(batch) >= 2000:
+            LatLongAttribute.objects.bulk_update(batch, ['geohash'])
+            batch = []
+    LatLongAttribute.objects.bulk_update(batch, ['geohash'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0015_item_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='latlongattribute',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='The geohash of this location which is used to group nearby locations on maps.', max_length=12),
+        ),
+        migrations.AddIndex(
+            model_name='latlongattribute',
+            index=models.Index(fields=['latitude', 'longitude'], name='crunch_latl_latitud_e9912c_idx'),
+        ),
+        migrations.RunPython(populate_geohashes, migrations.RunPython.noop),
+    ]
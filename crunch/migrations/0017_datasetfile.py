@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0016_latlong_geohash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('path', models.CharField(help_text='The path of the file relative to the base file path of the dataset.', max_length=4096)),
+                ('size', models.PositiveBigIntegerField(blank=True, help_text='The size of the file in bytes.', null=True)),
+                ('md5', models.CharField(blank=True, default='', help_text='The MD5 checksum of the file.', max_length=32)),
+                ('last_modified', models.DateTimeField(blank=True, help_text='The time the file was last modified in storage.', null=True)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='indexed_files', to='crunch.dataset')),
+            ],
+            options={
+                'ordering': ('dataset', 'path'),
+                'unique_together': {('dataset', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0017_datasetfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='upload_exclude',
+            field=models.TextField(blank=True, default='', help_text='Glob patterns (one per line) for the paths of files or directories not to upload after the workflow.'),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='upload_include',
+            field=models.TextField(blank=True, default='', help_text='Glob patterns (one per line) for the paths of the files to upload after the workflow. If empty then all new or modified files are uploaded.'),
+        ),
+    ]
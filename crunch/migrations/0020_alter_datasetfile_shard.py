@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0019_datasetfile_shard'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='datasetfile',
+            name='shard',
+            field=models.CharField(blank=True, default='', help_text='The path (relative to the base file path of the dataset) of the archive with this file if it was packed with other small files or of the index of its chunks.', max_length=4096),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crunch', '0020_alter_datasetfile_shard'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='datasetfile',
+            name='shard',
+            field=models.CharField(blank=True, default='', help_text='The path (relative to the base file path of the dataset) of the archive, chunk index or manifest which describes how this file is stored if it is not stored by itself.', max_length=4096),
+        ),
+    ]
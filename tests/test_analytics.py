@@ -0,0 +1,95 @@
+import datetime
+import tempfile
+from io import BytesIO
+from pathlib import Path
+import pytest
+import pandas as pd
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status as drf_status
+from rest_framework.test import APITestCase
+
+from crunch.django.app import models, analytics
+
+from .test_models import CrunchTestCase
+
+
+class AnalyticsTests(CrunchTestCase, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.project = models.Project.objects.create(name="Test Project")
+        self.dataset = models.Dataset.objects.create(name="Test Dataset", parent=self.project)
+        self.item = models.Item.objects.create(name="Test Item", parent=self.dataset)
+        models.FloatAttribute.objects.create(item=self.dataset, key="quality", value=0.5)
+        models.FloatAttribute.objects.create(item=self.item, key="quality", value=0.9)
+        models.IntegerAttribute.objects.create(item=self.item, key="count", value=3)
+        models.BooleanAttribute.objects.create(item=self.dataset, key="valid", value=True)
+        models.DateTimeAttribute.objects.create(item=self.item, key="time", value=datetime.datetime(2022, 1, 1, 12, tzinfo=timezone.utc))
+        models.DateAttribute.objects.create(item=self.item, key="day", value=datetime.date(2022, 1, 2))
+        models.LatLongAttribute.objects.create(item=self.dataset, key="location", latitude=50, longitude=20)
+        other_project = models.Project.objects.create(name="Other Project")
+        models.FloatAttribute.objects.create(item=other_project, key="quality", value=0.1)
+
+    def test_long_table(self):
+        table = analytics.attribute_table(self.project, layout="long")
+        assert len(table) == 7
+        assert list(table.columns[:4]) == ["item_id", "item", "key", "type"]
+        assert table["float"].dtype == "float64"
+        assert table["integer"].dtype == "Int64"
+        assert table["boolean"].dtype == "boolean"
+        assert str(table["datetime"].dtype) == "datetime64[ns, UTC]"
+        assert table["latitude"].dtype == "float64"
+        # attributes are in tree order
+        assert list(table["item"]) == ["test-project:test-dataset"] * 3 + ["test-project:test-dataset:test-item"] * 4
+        row = table[table["key"] == "count"].iloc[0]
+        assert row["type"] == "integer"
+        assert row["integer"] == 3
+        assert pd.isna(row["float"])
+
+    def test_wide_table(self):
+        table = analytics.attribute_table(self.project, layout="wide")
+        assert list(table["item"]) == ["test-project", "test-project:test-dataset", "test-project:test-dataset:test-item"]
+        assert table["quality"].dtype == "float64"
+        assert table["count"].dtype == "Int64"
+        assert list(table["quality"].fillna(-1)) == [-1, 0.5, 0.9]
+        assert table["location_latitude"][1] == 50.0
+        assert table["location_longitude"][1] == 20.0
+        assert table["day"][2] == datetime.date(2022, 1, 2)
+
+    def test_layout_error(self):
+        with pytest.raises(analytics.AttributeTableException):
+            analytics.attribute_table(self.project, layout="tall")
+
+    def test_write_parquet(self):
+        pytest.importorskip("pyarrow")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for layout in analytics.LAYOUTS:
+                path = Path(tmpdir)/f"{layout}.parquet"
+                call_command("export-attributes", self.project.slug, str(path), f"--layout={layout}")
+                table = pd.read_parquet(path)
+                assert len(table) == (7 if layout == "long" else 3)
+
+            path = Path(tmpdir)/"long.arrow"
+            call_command("export-attributes", self.project.slug, str(path), "--format=arrow")
+            assert pd.read_feather(path)["integer"].dtype == "Int64"
+
+    def test_command_missing_project(self):
+        with pytest.raises(CommandError, match="not found"):
+            call_command("export-attributes", "missing", "output.parquet")
+
+    def test_api(self):
+        pytest.importorskip("pyarrow")
+        User = get_user_model()
+        User.objects.create_superuser(username="username", password="password-for-unit-testing")
+        self.client.login(username="username", password="password-for-unit-testing")
+        url = reverse('crunch:project-api-attributes', kwargs={'slug': self.project.slug})
+        response = self.client.get(url, {'layout': 'wide'})
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        table = pd.read_parquet(BytesIO(response.content))
+        assert list(table["quality"].fillna(-1)) == [-1, 0.5, 0.9]
+
+        response = self.client.get(url, {'layout': 'tall'})
+        self.assertEqual(response.status_code, drf_status.HTTP_400_BAD_REQUEST)
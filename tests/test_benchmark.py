@@ -0,0 +1,66 @@
+import json
+import tempfile
+from pathlib import Path
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from crunch.django.app import models, benchmark
+
+from .test_models import CrunchTestCase
+
+
+class BenchmarkTests(CrunchTestCase):
+    def test_generate_synthetic_tree(self):
+        projects = benchmark.generate_synthetic_tree(projects=2, datasets=4, items=2, attributes=3, statuses=2)
+        assert len(projects) == 2
+        assert models.Project.objects.count() == 2
+        assert models.Dataset.objects.count() == 8
+        assert models.Item.objects.count() == 2 + 8 + 16
+        assert models.Attribute.objects.count() == 3 * (2 + 8 + 16)
+
+        project = projects[0]
+        assert project.unprocessed_datasets().count() == 1
+        assert project.running_datasets().count() == 1
+        assert project.failed_datasets().count() == 1
+        assert project.completed_datasets().count() == 1
+
+    def test_run_benchmark(self):
+        result = benchmark.run_benchmark(projects=1, datasets=4, items=1, attributes=4, statuses=2, repeat=1)
+        assert result["database"]["vendor"] == "sqlite"
+        names = [measurement["name"] for measurement in result["results"]]
+        assert "Dataset.failed" in names
+        assert "DatasetSerializer" in names
+        assert "GET /api/datasets/<slug>/" in names
+        for measurement in result["results"]:
+            assert measurement["queries"] >= 0
+            assert measurement["min"] <= measurement["mean"] <= measurement["max"]
+
+        payloads = {payload["name"]: payload for payload in result["payloads"]}
+        assert payloads["decode json+gzip"]["size"] < payloads["decode json"]["size"]
+
+        # synthetic data is rolled back
+        assert models.Item.objects.count() == 0
+
+    def test_compare_results(self):
+        baseline = dict(results=[dict(name="a", queries=2, mean=1.0), dict(name="b", queries=2, mean=1.0)])
+        current = dict(results=[dict(name="a", queries=3, mean=1.0), dict(name="b", queries=2, mean=2.0)])
+        regressions = benchmark.compare_results(baseline, current, tolerance=0.5)
+        assert len(regressions) == 2
+        assert regressions[0].startswith("a: queries increased")
+        assert regressions[1].startswith("b: mean time increased")
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = Path(tmpdir)/"results.json"
+            call_command("benchmark", "--projects=1", "--datasets=2", "--items=1", "--attributes=1", "--repeat=1", "--no-endpoints", f"--output={output}")
+            result = json.loads(output.read_text())
+            assert result["parameters"]["datasets"] == 2
+            assert len(result["results"]) > 0
+
+            # make baseline impossibly fast so there are regressions
+            for measurement in result["results"]:
+                measurement["queries"] = 0
+            output.write_text(json.dumps(result))
+            with pytest.raises(CommandError, match="Regressions found"):
+                call_command("benchmark", "--projects=1", "--datasets=2", "--items=1", "--attributes=1", "--repeat=1", "--no-endpoints", f"--baseline={output}")
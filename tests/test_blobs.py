@@ -0,0 +1,164 @@
+import datetime
+import io
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+import pytest
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+
+from crunch.django.app import blobs, models, storages
+from .test_models import CrunchTestCase
+from .test_packing import set_modified_time
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return FileSystemStorage(location=tmp_path/"remote", base_url="http://www.example.com/")
+
+
+@pytest.fixture
+def local_dir(tmp_path):
+    local_dir = tmp_path/"local"
+    (local_dir/"results").mkdir(parents=True)
+    (local_dir/"reference.fa").write_text("ACGT")
+    (local_dir/"results/output.txt").write_text("output")
+    return local_dir
+
+
+def test_blob_name():
+    digest = "ab" + "0" * 62
+    assert storages.blob_name(digest) == f"crunch/.blobs/ab/{digest}"
+    with override_settings(CRUNCH_BLOBS_PATH="shared"):
+        assert storages.blob_name(digest) == f"shared/ab/{digest}"
+
+
+def test_deduplicate_to_storage(local_dir, storage):
+    paths = [local_dir/"reference.fa", local_dir/"results/output.txt"]
+    manifests = blobs.deduplicate_to_storage(paths, local_dir, base="crunch/project/first", storage=storage, checksums={"reference.fa": "abc"})
+    assert set(manifests) == {"reference.fa", "results/output.txt"}
+    assert manifests["reference.fa"].startswith(".crunch/manifests/")
+
+    digest = blobs.file_sha256(local_dir/"reference.fa")
+    assert storage.exists(storages.blob_name(digest))
+    assert not storage.exists("crunch/project/first/reference.fa")
+    assert storages.manifest_files("crunch/project/first", storage=storage)["reference.fa"] == dict(
+        path="reference.fa", size=4, md5="abc", blob=digest, shard=manifests["reference.fa"], index=manifests["reference.fa"],
+    )
+
+    # identical files from another dataset are not uploaded again
+    with patch.object(storage, "_save", wraps=storage._save) as save:
+        blobs.deduplicate_to_storage(paths, local_dir, base="crunch/project/second", storage=storage)
+    assert save.call_count == 1
+    assert save.call_args.args[0].startswith("crunch/project/second/.crunch/manifests/")
+
+
+def test_copy_recursive_from_storage_manifests(local_dir, storage, tmp_path):
+    blobs.deduplicate_to_storage([local_dir/"reference.fa", local_dir/"results/output.txt"], local_dir, base="dataset", storage=storage)
+    storage.save("dataset/notes.txt", io.BytesIO(b"notes"))
+
+    target = tmp_path/"target"
+    storages.copy_recursive_from_storage("dataset", target, storage=storage, exclude=["results"])
+    assert sorted(str(path.relative_to(target)) for path in target.rglob("*") if path.is_file()) == ["notes.txt", "reference.fa"]
+    assert (target/"reference.fa").read_text() == "ACGT"
+
+
+@pytest.mark.parametrize("deduplicated_last", [False, True])
+def test_file_moved_between_layouts(local_dir, storage, tmp_path, deduplicated_last):
+    blobs.deduplicate_to_storage([local_dir/"reference.fa"], local_dir, base="dataset", storage=storage)
+    (local_dir/"reference.fa").write_text("new version")
+    storages.copy_to_storage([local_dir/"reference.fa"], local_dir=local_dir, base="dataset", storage=storage)
+
+    # the manifest is written either before or after the file was uploaded by itself
+    manifest_name = storages.manifest_files("dataset", storage=storage)["reference.fa"]["index"]
+    set_modified_time(storage, f"dataset/{manifest_name}", 2000 if deduplicated_last else 1000)
+    set_modified_time(storage, "dataset/reference.fa", 1500)
+
+    target = tmp_path/"target"
+    storages.copy_recursive_from_storage("dataset", target, storage=storage)
+    assert (target/"reference.fa").read_text() == ("ACGT" if deduplicated_last else "new version")
+
+    root = storages.storage_walk("dataset", storage=storage)
+    shards = {file.filename: file.shard for file in root.file_descendents()}
+    assert bool(shards["reference.fa"]) == deduplicated_last
+
+
+def test_copy_manifest_files_outside_directory(storage, tmp_path):
+    manifest = dict(files=[dict(path="../evil.txt", size=0, md5="", blob="0" * 64)])
+    storage.save("dataset/.crunch/manifests/manifest.json", io.BytesIO(json.dumps(manifest).encode()))
+
+    with pytest.raises(ValueError, match="outside"):
+        storages.copy_manifest_files_from_storage("dataset", tmp_path/"target", storage=storage)
+
+
+def test_storage_walk_manifests(local_dir, storage):
+    manifests = blobs.deduplicate_to_storage([local_dir/"reference.fa"], local_dir, base="dataset", storage=storage)
+
+    root = storages.storage_walk("dataset", storage=storage)
+    assert {str(file.path()): file.shard for file in root.file_descendents()} == {"dataset/reference.fa": manifests["reference.fa"]}
+    assert f"<span title='Deduplicated in {manifests['reference.fa']}'>reference.fa</span>" in root.render_html()
+
+
+def test_collect_garbage(local_dir, storage):
+    blobs.deduplicate_to_storage([local_dir/"reference.fa"], local_dir, base="first", storage=storage)
+    blobs.deduplicate_to_storage([local_dir/"results/output.txt"], local_dir, base="second", storage=storage)
+    referenced = blobs.referenced_blobs(["first"], storage=storage)
+    assert referenced == {blobs.file_sha256(local_dir/"reference.fa")}
+    unreferenced_name = storages.blob_name(blobs.file_sha256(local_dir/"results/output.txt"))
+
+    # recent blobs are kept in case their manifests have not been written yet
+    assert blobs.collect_garbage(referenced, storage=storage) == []
+
+    no_age = datetime.timedelta(0)
+    assert blobs.collect_garbage(referenced, storage=storage, min_age=no_age, dry_run=True) == [unreferenced_name]
+    assert storage.exists(unreferenced_name)
+    assert blobs.collect_garbage(referenced, storage=storage, min_age=no_age) == [unreferenced_name]
+    assert not storage.exists(unreferenced_name)
+    assert storage.exists(storages.blob_name(blobs.file_sha256(local_dir/"reference.fa")))
+
+
+def test_reused_blobs_are_touched(local_dir, storage):
+    blobs.deduplicate_to_storage([local_dir/"reference.fa"], local_dir, base="first", storage=storage)
+    name = storages.blob_name(blobs.file_sha256(local_dir/"reference.fa"))
+    set_modified_time(storage, name, 1000)
+
+    # another run reuses the old blob before the garbage collector reaches it
+    blobs.deduplicate_to_storage([local_dir/"reference.fa"], local_dir, base="second", storage=storage)
+    assert blobs.collect_garbage(set(), storage=storage) == []
+    assert storage.exists(name)
+
+
+def test_collect_garbage_rechecks_before_delete(local_dir, storage):
+    blobs.deduplicate_to_storage([local_dir/"reference.fa"], local_dir, base="first", storage=storage)
+    name = storages.blob_name(blobs.file_sha256(local_dir/"reference.fa"))
+    set_modified_time(storage, name, 1000)
+
+    # the blob is touched by a run after it was listed as old
+    modified_times = iter([datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc), timezone.now()])
+    with patch.object(storage, "get_modified_time", side_effect=lambda name: next(modified_times)):
+        assert blobs.collect_garbage(set(), storage=storage) == []
+    assert storage.exists(name)
+
+
+class CollectGarbageCommandTests(CrunchTestCase):
+    def test_collect_garbage_command(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            storage = FileSystemStorage(location=tmpdir/"remote", base_url="http://www.example.com/")
+            (tmpdir/"kept.txt").write_text("kept")
+            (tmpdir/"deleted.txt").write_text("deleted")
+            project = models.Project.objects.create(name="project")
+            dataset = models.Dataset.objects.create(name="dataset", parent=project, base_file_path="dataset")
+            blobs.deduplicate_to_storage([tmpdir/"kept.txt"], tmpdir, base=dataset.base_file_path, storage=storage)
+            blobs.deduplicate_to_storage([tmpdir/"deleted.txt"], tmpdir, base="removed-dataset", storage=storage)
+
+            out = io.StringIO()
+            with patch.object(blobs, "default_storage", storage), patch.object(storages, "default_storage", storage):
+                call_command("collect-garbage", "--min-age=0", stdout=out)
+
+            assert "Deleted 1 unreferenced blobs. 1 blobs are referenced." in out.getvalue()
+            assert not storage.exists(storages.blob_name(blobs.file_sha256(tmpdir/"deleted.txt")))
+            assert storage.exists(storages.blob_name(blobs.file_sha256(tmpdir/"kept.txt")))
@@ -0,0 +1,140 @@
+import io
+import json
+from pathlib import Path
+from unittest.mock import patch
+import numpy as np
+import pytest
+from django.core.files.storage import FileSystemStorage
+
+from crunch.django.app import chunking, storages
+
+
+SIZES = dict(min_size=256, average_size=1024, max_size=4096)
+
+
+def random_bytes(size: int, seed: int = 0) -> bytes:
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return FileSystemStorage(location=tmp_path/"remote", base_url="http://www.example.com/")
+
+
+def test_gear_hashes():
+    data = random_bytes(500)
+    expected = []
+    h = 0
+    for value in data:
+        h = ((h << 1) + int(chunking.GEAR[value])) & 0xFFFFFFFF
+        expected.append(h)
+
+    assert chunking.gear_hashes(np.frombuffer(data, dtype=np.uint8)).tolist() == expected
+
+
+def test_chunk_boundaries():
+    data = random_bytes(100_000)
+    boundaries = list(chunking.chunk_boundaries(io.BytesIO(data), **SIZES))
+    sizes = np.diff([0] + boundaries)
+
+    assert boundaries[-1] == len(data)
+    assert sizes[:-1].min() >= 256
+    assert sizes.max() <= 4096
+    assert 500 < sizes.mean() < 2000
+
+    # the boundaries do not depend on how the file is read
+    with patch.object(chunking, "BOUNDARY_BLOCK_SIZE", 1000):
+        assert list(chunking.chunk_boundaries(io.BytesIO(data), **SIZES)) == boundaries
+
+
+def test_chunk_boundaries_max_size():
+    assert list(chunking.chunk_boundaries(io.BytesIO(b"\0" * 10_000), **SIZES)) == [4096, 8192, 10_000]
+    assert list(chunking.chunk_boundaries(io.BytesIO(b""), **SIZES)) == []
+
+
+def test_chunk_boundaries_average_size():
+    with pytest.raises(chunking.ChunkingException, match="power of two"):
+        list(chunking.chunk_boundaries(io.BytesIO(b"data"), average_size=1000))
+
+
+def test_chunks_after_insert():
+    data = random_bytes(100_000)
+    edited = data[:50_000] + b"inserted" + data[50_000:]
+
+    boundaries = list(chunking.chunk_boundaries(io.BytesIO(data), **SIZES))
+    edited_boundaries = list(chunking.chunk_boundaries(io.BytesIO(edited), **SIZES))
+    chunks = {data[start:end] for start, end in zip([0] + boundaries, boundaries)}
+    edited_chunks = [edited[start:end] for start, end in zip([0] + edited_boundaries, edited_boundaries)]
+
+    # only the chunks around the edit are different
+    new_chunks = [chunk for chunk in edited_chunks if chunk not in chunks]
+    assert 1 <= len(new_chunks) <= 2
+
+
+def test_chunk_to_storage(tmp_path, storage):
+    local_dir = tmp_path/"local"
+    (local_dir/"results").mkdir(parents=True)
+    path = local_dir/"results/large.bin"
+    data = random_bytes(50_000)
+    path.write_bytes(data)
+
+    indexes = chunking.chunk_to_storage([path], local_dir, base="dataset", storage=storage, checksums={"results/large.bin": "abc"}, **SIZES)
+    assert list(indexes) == ["results/large.bin"]
+    assert indexes["results/large.bin"].startswith(".crunch/chunks/")
+    _, objects = storage.listdir("dataset/.crunch/chunks/objects")
+    assert len(objects) > 10
+    assert not storage.exists("dataset/results/large.bin")
+
+    entry = storages.chunked_files("dataset", storage=storage)["results/large.bin"]
+    assert entry["size"] == 50_000
+    assert entry["md5"] == "abc"
+    assert entry["shard"] == indexes["results/large.bin"]
+
+    # only the chunks with the change are uploaded again
+    path.write_bytes(data[:100] + b"header" + data[100:])
+    with patch.object(storage, "_save", wraps=storage._save) as save:
+        chunking.chunk_to_storage([path], local_dir, base="dataset", storage=storage, **SIZES)
+    assert 2 <= save.call_count <= 3
+
+    target = tmp_path/"target"
+    assert chunking.reassemble_from_storage("dataset", target, storage=storage) == ["results/large.bin"]
+    assert (target/"results/large.bin").read_bytes() == path.read_bytes()
+    assert chunking.reassemble_from_storage("dataset", tmp_path/"excluded", storage=storage, exclude=["results"]) == []
+
+
+def test_reassemble_corrupt_chunk(tmp_path, storage):
+    local_dir = tmp_path/"local"
+    local_dir.mkdir()
+    (local_dir/"large.bin").write_bytes(random_bytes(10_000))
+    chunking.chunk_to_storage([local_dir/"large.bin"], local_dir, base="dataset", storage=storage, **SIZES)
+
+    # a chunk with the same size but different contents
+    _, objects = storage.listdir("dataset/.crunch/chunks/objects")
+    path = Path(storage.path(f"dataset/.crunch/chunks/objects/{objects[0]}"))
+    path.write_bytes(bytes(len(path.read_bytes())))
+
+    with pytest.raises(chunking.ChunkingException, match="does not match"):
+        chunking.reassemble_from_storage("dataset", tmp_path/"target", storage=storage)
+
+
+def test_reassemble_outside_directory(storage, tmp_path):
+    index = dict(files=[dict(path="../evil.txt", size=0, md5="", chunks=[])])
+    storage.save("dataset/.crunch/chunks/index.json", io.BytesIO(json.dumps(index).encode()))
+
+    with pytest.raises(chunking.ChunkingException, match="outside"):
+        chunking.reassemble_from_storage("dataset", tmp_path/"target", storage=storage)
+    assert not (tmp_path/"evil.txt").exists()
+
+
+def test_storage_walk_chunked(tmp_path, storage):
+    local_dir = tmp_path/"local"
+    local_dir.mkdir()
+    (local_dir/"large.bin").write_bytes(random_bytes(10_000))
+    (local_dir/"small.txt").write_text("small")
+    indexes = chunking.chunk_to_storage([local_dir/"large.bin"], local_dir, base="dataset", storage=storage, **SIZES)
+    storages.copy_to_storage([local_dir/"small.txt"], local_dir=local_dir, base="dataset", storage=storage)
+
+    root = storages.storage_walk("dataset", storage=storage)
+    files = {str(file.path()): file.shard for file in root.file_descendents()}
+    assert files == {"dataset/large.bin": indexes["large.bin"], "dataset/small.txt": None}
+    assert f"<span title='Chunked in {indexes['large.bin']}'>large.bin</span>" in root.render_html()
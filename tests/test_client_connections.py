@@ -1,6 +1,7 @@
 from datetime import datetime
 import os, re
 import pytest
+import requests
 from unittest.mock import patch
 from django.contrib.auth import get_user_model
 from django.utils import timezone
@@ -13,10 +14,11 @@ from crunch.django.app import models
 
 
 class MockResponse():
-    def __init__(self, data=None, status_code=200, reason=""):
+    def __init__(self, data=None, status_code=200, reason="", headers=None):
         self.data = data
         self.status_code = status_code
         self.reason = reason
+        self.headers = headers or {}
 
     def json(self):
         return self.data
@@ -40,11 +42,22 @@ class MockConnection(connections.Connection):
             relative_url = f"/{relative_url}"
         return self.client.post(relative_url, kwargs)        
 
+    def post_json(self, relative_url, data):
+        if not relative_url.startswith("/"):
+            relative_url = f"/{relative_url}"
+        return self.client.post(relative_url, data, format="json")
+
     def get_request(self, relative_url):
         if not relative_url.startswith("/"):
             relative_url = f"/{relative_url}"
         return self.client.get(relative_url)        
 
+    def stream_lines(self, relative_url):
+        if not relative_url.startswith("/"):
+            relative_url = f"/{relative_url}"
+        response = self.client.get(relative_url)
+        yield from b"".join(response.streaming_content).splitlines()
+
 
 @patch('requests.get', lambda *args, **kwargs: MockResponse(data={"detail": "Not found"}))
 def test_get_json_response_error():
@@ -352,4 +365,66 @@ def test_send_status():
 def test_send_status_forbidden():
     connection = connections.Connection(base_url="http://www.example.com", token="token")
     with pytest.raises(connections.CrunchAPIException, match=r"Failed sending status\.\n403: Forbidden"):
-        connection.send_status("dataset_id", Stage.UPLOAD, State.SUCCESS)
\ No newline at end of file
+        connection.send_status("dataset_id", Stage.UPLOAD, State.SUCCESS)
+
+
+def test_relative_url():
+    connection = connections.Connection(base_url="http://www.example.com/crunch/", token="token")
+    assert connection.relative_url("http://www.example.com/crunch/api/items/?cursor=abc") == "/api/items/?cursor=abc"
+    assert connection.relative_url("https://www.example.com/crunch/api/items/") == "/api/items/"
+
+
+@pytest.mark.django_db
+def test_iterate_results():
+    connection = MockConnection(base_url="http://www.example.com/", token="token")
+    project = models.Project.objects.create(name="Test Project")
+    for index in range(5):
+        models.Dataset.objects.create(name=f"Dataset {index}", parent=project)
+
+    results = list(connection.iterate_results("api/datasets/", page_size=2))
+    assert [result["name"] for result in results] == [f"Dataset {index}" for index in range(5)]
+
+
+def test_get_request_cache(tmp_path):
+    connection = connections.Connection(base_url="http://www.example.com", token="token", cache_dir=tmp_path)
+    requests_made = []
+
+    def mock_get(url, headers, **kwargs):
+        requests_made.append(headers)
+        if headers.get("If-None-Match") == '"etag1"':
+            return MockResponse(status_code=304)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"slug": "dataset"}'
+        response.headers["ETag"] = '"etag1"'
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    with patch('requests.get', mock_get):
+        assert connection.get_json_response("api/datasets/dataset/") == {"slug": "dataset"}
+        assert "If-None-Match" not in requests_made[0]
+        assert len(list(tmp_path.iterdir())) == 2
+
+        response = connection.get_request("api/datasets/dataset/")
+        assert requests_made[1]["If-None-Match"] == '"etag1"'
+        assert response.status_code == 200
+        assert response.json() == {"slug": "dataset"}
+
+
+def test_get_request_no_cache(tmp_path):
+    connection = connections.Connection(base_url="http://www.example.com", token="token")
+    assert connection.cache_dir is None
+    with patch('requests.get', lambda *args, **kwargs: MockResponse(data={"slug": "dataset"}, headers={"ETag": '"etag1"'})):
+        assert connection.get_json_response("api/datasets/dataset/") == {"slug": "dataset"}
+
+
+def test_decode_msgpack_response():
+    msgpack = pytest.importorskip("msgpack")
+    connection = connections.Connection(base_url="http://www.example.com", token="token")
+    response = requests.Response()
+    response.status_code = 200
+    response._content = msgpack.packb({"slug": "dataset"})
+    response.headers["Content-Type"] = "application/msgpack"
+    with patch('requests.get', lambda *args, **kwargs: response):
+        assert connection.get_json_response("api/datasets/dataset/") == {"slug": "dataset"}
+
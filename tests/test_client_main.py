@@ -215,6 +215,70 @@ def test_run_command(mock_run):
     mock_run.assert_called_once()
 
 
+@patch('requests.get', lambda *args, **kwargs: dataset_mock_response)
+@patch.object(Run, '__call__', autospec=True, return_value=None)
+def test_run_command_include_exclude(mock_run):
+    result = runner.invoke(app, [
+        "run", 
+        "dataset",
+        "--storage-settings", str(TEST_DIR/"settings.toml"),
+        "--url", EXAMPLE_URL, 
+        "--token", "token",
+        "--include", "dummy-files/*",
+        "--include", "*.toml",
+        "--exclude", "dummy-files/dummy-file2.txt",
+        "--lazy",
+        "--upload-exclude", "scratch",
+        "--outputs-only",
+    ])
+    assert result.exit_code == 0
+    run = mock_run.call_args.args[0]
+    assert run.include == ["dummy-files/*", "*.toml"]
+    assert run.exclude == ["dummy-files/dummy-file2.txt"]
+    assert run.lazy_download
+    assert run.upload_exclude == ["scratch"]
+    assert run.upload_outputs_only
+
+
+@patch('requests.get', lambda *args, **kwargs: dataset_mock_response)
+@patch.object(Run, '__call__', autospec=True, return_value=None)
+def test_run_command_storage_layout(mock_run):
+    result = runner.invoke(app, [
+        "run", 
+        "dataset",
+        "--storage-settings", str(TEST_DIR/"settings.toml"),
+        "--url", EXAMPLE_URL, 
+        "--token", "token",
+        "--pack",
+        "--pack-compression", "gzip",
+        "--shard-size", "10",
+        "--chunk",
+        "--chunk-file-size", "100",
+    ])
+    assert result.exit_code == 0
+    run = mock_run.call_args.args[0]
+    assert run.pack
+    assert run.pack_compression == "gzip"
+    assert run.pack_shard_size == 10 * 1024 * 1024
+    assert run.chunk
+    assert run.chunk_file_size == 100 * 1024 * 1024
+    assert not run.deduplicate
+
+    result = runner.invoke(app, [
+        "run", 
+        "dataset",
+        "--storage-settings", str(TEST_DIR/"settings.toml"),
+        "--url", EXAMPLE_URL, 
+        "--token", "token",
+        "--chunk",
+        "--deduplicate",
+    ])
+    assert result.exit_code == 0
+    run = mock_run.call_args.args[0]
+    assert run.deduplicate
+    assert not run.pack
+
+
 def mock_call_run(run):
     dataset = models.Dataset.objects.get(slug=run.dataset_slug)
     dataset.locked = True
@@ -265,3 +329,18 @@ def test_loop_command():
     dataset2.refresh_from_db()
     assert dataset1.locked
     assert dataset2.locked    
+
+
+@pytest.mark.django_db
+@patch('crunch.client.main.connections.Connection', get_mock_connection )
+def test_export_command(tmp_path):
+    ContentType.objects.clear_cache()
+    project = models.Project.objects.create(name="project")
+    models.Dataset.objects.create(name="dataset", parent=project)
+    output = tmp_path/"project.ndjson"
+    result = runner.invoke(app, ["export", "project", "--output", str(output), "--url", EXAMPLE_URL, "--token", "token"])
+    assert result.exit_code == 0
+    lines = output.read_text().splitlines()
+    assert len(lines) == 2
+    assert '"slug":"project:dataset"' in lines[1]
+
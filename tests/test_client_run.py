@@ -2,14 +2,18 @@ from unittest.mock import patch
 from pathlib import Path
 import tempfile
 import unittest
+import json
+import os
+import base64
+import re
 import pytest
 from crunch.django.app import models
 from crunch.django.app.enums import Stage, State
 
 from django.core.files.storage import FileSystemStorage
 
-from crunch.client import enums
-from crunch.client.run import Run
+from crunch.client import enums, utils
+from crunch.client.run import Run, fetch_from_storage, manifest_wildcard_pattern, LAZY_STORAGE_SETTINGS_VARIABLE
 from crunch.django.app import storages
 
 from .test_client_connections import MockResponse, MockConnection
@@ -19,6 +23,7 @@ from .test_client_utils import raise_called_process_error
 
 def mock_snakemake_main(args):
     assert "--use-conda" in args
+    assert any(arg.startswith("--conda-prefix=") and arg.endswith(".shared/conda") for arg in args)
     raise SystemExit
 
 
@@ -31,7 +36,7 @@ def raise_system_error(*args, **kwargs):
 
 
 def request_get(url, **kwargs):
-    if url == "http://www.example.com/api/datasets/dataset/":
+    if url.startswith("http://www.example.com/api/datasets/dataset/"):
         return MockResponse(data=dict(
             slug="dataset",
             parent="project",
@@ -59,6 +64,43 @@ def test_run_blank_dataset_slug():
         )
 
 
+def test_run_lazy_download_requires_snakemake():
+    with pytest.raises(ValueError, match=r"only be downloaded lazily for Snakemake"):
+        Run(
+            connection=None, 
+            dataset_slug="dataset", 
+            storage_settings={}, 
+            working_directory=None, 
+            workflow_type=enums.WorkflowType.script, 
+            lazy_download=True,
+        )
+
+
+def test_run_upload_outputs_only_requires_snakemake():
+    with pytest.raises(ValueError, match=r"Only the outputs can be uploaded for Snakemake"):
+        Run(
+            connection=None, 
+            dataset_slug="dataset", 
+            storage_settings={}, 
+            working_directory=None, 
+            workflow_type=enums.WorkflowType.script, 
+            upload_outputs_only=True,
+        )
+
+
+def test_run_deduplicate_and_pack():
+    with pytest.raises(ValueError, match=r"cannot be both deduplicated and packed"):
+        Run(
+            connection=None, 
+            dataset_slug="dataset", 
+            storage_settings={}, 
+            working_directory=None, 
+            workflow_type=enums.WorkflowType.script, 
+            deduplicate=True,
+            pack=True,
+        )
+
+
 # @patch('requests.get', request_get)
 class TestRun(unittest.TestCase):
     def setUp(self):
@@ -81,9 +123,12 @@ class TestRun(unittest.TestCase):
                     workflow_type=enums.WorkflowType.script, 
                     workflow_path=None, 
                 )
-                result = run.setup()
+                with patch.object(self.connection, "get_json_response", wraps=self.connection.get_json_response) as get_json_response:
+                    result = run.setup()
 
                 assert result == enums.RunResult.SUCCESS
+                # the dataset is only requested once when the run is created
+                assert [call.args[0] for call in get_json_response.call_args_list] == ["/api/projects/project/"]
                 assert models.Status.objects.count() == 2
                 assert self.dataset.statuses.count() == 2
                 statuses = list(self.dataset.statuses.all())
@@ -97,11 +142,17 @@ class TestRun(unittest.TestCase):
                 tmpdir = Path(tmpdir, "project--dataset")
                 dataset_json_text = (tmpdir/".crunch/dataset.json").read_text()
                 assert str(TEST_DIR) in dataset_json_text
+                # the full details are saved for the workflow and not just the fields needed to start the run
+                dataset_json = json.loads(dataset_json_text)
+                assert dataset_json["name"] == "dataset"
+                assert "attributes" in dataset_json
 
                 project_json_text = (tmpdir/".crunch/project.json").read_text()
                 assert "cat .crunch/dataset.json" in project_json_text
 
-                script_text = (tmpdir/".crunch/script.sh").read_text()
+                assert run.workflow_path.name == "script.sh"
+                assert run.workflow_path.parent.parent == Path(tmpdir).parent/".shared/workflows"
+                script_text = run.workflow_path.read_text()
                 assert "cat .crunch/dataset.json" in script_text
 
                 assert_test_data(tmpdir)
@@ -165,7 +216,8 @@ class TestRun(unittest.TestCase):
                 project_json_text = (tmpdir/".crunch/project.json").read_text()
                 assert "cat .crunch/dataset.json" in project_json_text
 
-                snakefile_text = (tmpdir/".crunch/Snakefile").read_text()
+                assert run.workflow_path.name == "Snakefile"
+                snakefile_text = run.workflow_path.read_text()
                 assert "cat .crunch/dataset.json" in snakefile_text
 
                 assert_test_data(tmpdir)
@@ -297,6 +349,14 @@ class TestRunNoStorage(unittest.TestCase):
 
                     assert_test_data(remote_dir)
 
+                    # the uploaded files are added to the index of files for the dataset
+                    indexed_files = {indexed_file.path: indexed_file for indexed_file in self.dataset.indexed_files.all()}
+                    assert set(indexed_files) == {".crunch/upload_md5_checksums.json", ".crunch/deleted.txt"}
+                    deleted_log = indexed_files[".crunch/deleted.txt"]
+                    assert deleted_log.size == 0
+                    assert deleted_log.md5 == "d41d8cd98f00b204e9800998ecf8427e"
+                    assert deleted_log.last_modified is not None
+
     @pytest.mark.django_db
     def test_run_upload_fail(self):
         with tempfile.TemporaryDirectory() as remote_dir:
@@ -512,3 +572,333 @@ class TestRunNoStorage(unittest.TestCase):
                     assert statuses[3].stage == Stage.WORKFLOW
                     assert statuses[4].stage == Stage.UPLOAD
                     assert statuses[5].stage == Stage.UPLOAD
+
+
+LAZY_TEST_SNAKEFILE = """
+rule all:
+    input:
+        "count.txt"
+
+rule count:
+    input:
+        "dummy-files/dummy-file1.txt"
+    output:
+        "count.txt"
+    shell:
+        "wc -c < {input} > {output}"
+"""
+
+
+LAZY_TEST_STORAGE_SETTINGS = {"AWS_SECRET_ACCESS_KEY": "secret"}
+
+
+def mock_snakemake_main_lazy(args):
+    """ Imitates Snakemake running the lazy Snakefile where the workflow needs one file from the manifest. """
+    snakefile = Path(next(arg for arg in args if arg.startswith("--snakefile=")).split("=", 1)[1])
+    working_directory = Path(next(arg for arg in args if arg.startswith("--directory=")).split("=", 1)[1])
+    snakefile_text = snakefile.read_text()
+    assert snakefile.parent.name == "lazy"
+    assert "rule crunch_fetch:" in snakefile_text
+    # the directories of the files are in the pattern rather than each file
+    assert "files2" in snakefile_text
+    assert "file2" not in snakefile_text
+    # the storage settings are read from the environment rather than written in the shared directory
+    assert "secret" not in snakefile_text
+    assert LAZY_STORAGE_SETTINGS_VARIABLE in snakefile_text
+    storage_settings = json.loads(os.environ[LAZY_STORAGE_SETTINGS_VARIABLE])
+    assert storage_settings == LAZY_TEST_STORAGE_SETTINGS
+
+    fetch_from_storage(working_directory, "dummy-files/dummy-file1.txt", storage_settings)
+    (working_directory/"count.txt").write_text("42")
+    raise SystemExit
+
+
+class TestRunLazy(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.connection = MockConnection(base_url="http://www.example.com", token="token") # ensure first
+        self.project = models.Project.objects.create(name="project", workflow=LAZY_TEST_SNAKEFILE)
+        self.dataset = models.Dataset.objects.create(parent=self.project, name="dataset", base_file_path=str(TEST_DIR))
+
+    @pytest.mark.django_db
+    def test_run_lazy(self):
+        with tempfile.TemporaryDirectory() as remote_dir:
+            remote_dir = Path(remote_dir)
+            storage = FileSystemStorage(location=remote_dir.absolute(), base_url="http://www.example.com")
+            storages.copy_recursive_to_storage(TEST_DIR, "./", storage=storage)
+
+            with tempfile.TemporaryDirectory() as local_dir:
+                with patch('crunch.django.app.storages.default_storage', storage):
+                    run = Run(
+                        connection=self.connection, 
+                        dataset_slug="project:dataset", 
+                        storage_settings=LAZY_TEST_STORAGE_SETTINGS, 
+                        working_directory=local_dir,
+                        workflow_type=enums.WorkflowType.snakemake, 
+                        exclude=["settings.*"],
+                        lazy_download=True,
+                    )
+                    run.base_file_path = str(remote_dir)
+                    assert run.setup() == enums.RunResult.SUCCESS
+
+                    # only the manifest is downloaded in setup
+                    working_directory = run.working_directory
+                    manifest = json.loads((working_directory/".crunch/manifest.json").read_text())
+                    assert sorted(manifest["files"]) == [
+                        "dummy-files/dummy-file1.txt", "dummy-files/dummy-file2.txt", "dummy-files2/dummy-file3.txt", 
+                        "dummy-workflow", "dummy-workflow-fail",
+                    ]
+                    assert not (working_directory/"dummy-files").exists()
+
+                    # only the input needed by the workflow is fetched
+                    with patch('snakemake.main', mock_snakemake_main_lazy):
+                        assert run.workflow() == enums.RunResult.SUCCESS
+                    assert (working_directory/"count.txt").exists()
+                    assert LAZY_STORAGE_SETTINGS_VARIABLE not in os.environ
+                    assert (working_directory/"dummy-files/dummy-file1.txt").exists()
+                    assert not (working_directory/"dummy-files/dummy-file2.txt").exists()
+                    assert list(run.fetched_md5_checksums()) == ["dummy-files/dummy-file1.txt"]
+
+                    # the fetched file is not uploaded again because it was not modified
+                    with patch.object(storages, "copy_to_storage") as copy_to_storage:
+                        assert run.upload() == enums.RunResult.SUCCESS
+                    uploaded = {str(path.relative_to(working_directory)) for path in copy_to_storage.call_args.args[0]}
+                    assert "count.txt" in uploaded
+                    assert "dummy-files/dummy-file1.txt" not in uploaded
+
+
+    @pytest.mark.django_db
+    def test_run_lazy_with_snakemake(self):
+        snakemake = pytest.importorskip("snakemake")
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            storage = FileSystemStorage(location=remote_dir, base_url="http://www.example.com")
+            storages.copy_recursive_to_storage(TEST_DIR, "./", storage=storage)
+
+            with patch('crunch.django.app.storages.default_storage', storage):
+                run = Run(
+                    connection=self.connection, 
+                    dataset_slug="project:dataset", 
+                    storage_settings={}, 
+                    working_directory=Path(local_dir, "runs"),
+                    workflow_type=enums.WorkflowType.snakemake, 
+                    exclude=["settings.*"],
+                    lazy_download=True,
+                )
+                run.base_file_path = str(Path(remote_dir).absolute())
+                assert run.setup() == enums.RunResult.SUCCESS
+
+                # a workflow rule can make files in the same directory as the files in the manifest
+                run.workflow_path = Path(local_dir, "workflow.smk")
+                run.workflow_path.write_text(
+                    'rule all:\n    input: "count.txt"\n\n'
+                    'rule count:\n    input: "dummy-files/dummy-file1.txt", "dummy-files/made.txt"\n    output: "count.txt"\n    shell: "cat {input} > {output}"\n\n'
+                    'rule make:\n    output: "dummy-files/{name}.txt"\n    shell: "echo made > {output}"\n'
+                )
+                snakefile = run.write_lazy_snakefile()
+                jobs = []
+
+                def log_handler(message):
+                    if message.get("level") == "job_info":
+                        jobs.extend((message["name"], output) for output in message["output"])
+
+                assert snakemake.snakemake(
+                    str(snakefile), workdir=str(run.working_directory), cores=1, dryrun=True, log_handler=[log_handler],
+                )
+
+                # the file in the manifest is fetched rather than made by the workflow
+                assert sorted(jobs) == [
+                    ("count", "count.txt"),
+                    ("crunch_fetch", "dummy-files/dummy-file1.txt"),
+                    ("make", "dummy-files/made.txt"),
+                ]
+
+
+def test_manifest_wildcard_pattern():
+    pattern = re.compile(manifest_wildcard_pattern(["a.txt", "results/b.txt", "results/deep/c.txt"]))
+    assert pattern.fullmatch("a.txt")
+    assert pattern.fullmatch("results/other.txt")
+    assert pattern.fullmatch("results/deep/other.txt")
+    assert not pattern.fullmatch("other/b.txt")
+    assert not pattern.fullmatch("results/deeper/c.txt")
+
+    assert not re.fullmatch(manifest_wildcard_pattern(["results/b.txt"]), "b.txt")
+    assert re.fullmatch(manifest_wildcard_pattern(["a.txt"]), "b.txt")
+    assert not re.fullmatch(manifest_wildcard_pattern([]), "a.txt")
+
+
+class TestRunUploadFilters(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.connection = MockConnection(base_url="http://www.example.com", token="token") # ensure first
+        self.project = models.Project.objects.create(name="project", workflow=LAZY_TEST_SNAKEFILE)
+        self.dataset = models.Dataset.objects.create(parent=self.project, name="dataset", base_file_path=str(TEST_DIR))
+
+    def uploaded(self, run) -> set:
+        with patch.object(storages, "copy_to_storage") as copy_to_storage:
+            assert run.upload() == enums.RunResult.SUCCESS
+        return {str(path.relative_to(run.working_directory)) for path in copy_to_storage.call_args.args[0]}
+
+    def make_run(self, local_dir, **kwargs):
+        run = Run(
+            connection=self.connection, 
+            dataset_slug="project:dataset", 
+            storage_settings={}, 
+            working_directory=local_dir,
+            workflow_type=enums.WorkflowType.snakemake, 
+            **kwargs,
+        )
+        for name in ["results/result.txt", "scratch/tmp.txt", "notes.txt", ".snakemake/log/run.log"]:
+            path = run.working_directory/name
+            path.parent.mkdir(exist_ok=True, parents=True)
+            path.write_text(name)
+        return run
+
+    @pytest.mark.django_db
+    def test_run_upload_patterns(self):
+        with tempfile.TemporaryDirectory() as local_dir:
+            run = self.make_run(local_dir, upload_exclude=["*.txt"], upload_include=["results", "notes.*", "scratch"])
+            run.project_data = dict(upload_exclude="scratch\n\n", upload_include="")
+            assert run.upload_patterns() == (["results", "notes.*", "scratch"], [".snakemake", "*.txt", "scratch"])
+
+            run = self.make_run(local_dir)
+            run.project_data = dict(upload_exclude="scratch\n", upload_include="")
+            run.setup_md5_checksums = {"notes.txt": utils.file_md5(run.working_directory/"notes.txt"), "scratch/old.txt": "abc"}
+            assert self.uploaded(run) == {"results/result.txt", ".crunch/upload_md5_checksums.json", ".crunch/deleted.txt"}
+            # excluded files are not hashed and are not reported as deleted
+            assert set(run.upload_md5_checksums) == {"results/result.txt", "notes.txt"}
+            assert (run.crunch_subdir/"deleted.txt").read_text() == ""
+
+    @pytest.mark.django_db
+    def test_run_upload_packed(self):
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            storage = FileSystemStorage(location=remote_dir, base_url="http://www.example.com")
+            with patch('crunch.django.app.storages.default_storage', storage):
+                run = self.make_run(Path(local_dir, "upload"), pack=True, pack_compression="gzip")
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                # the small files are packed into one archive instead of being saved individually
+                _, packs = storage.listdir("dataset/.crunch/packs")
+                assert len(packs) == 2
+                assert not storage.exists("dataset/notes.txt")
+                indexed = dict(self.dataset.indexed_files.values_list("path", "shard"))
+                assert indexed["results/result.txt"].endswith(".tar.gz")
+
+                # the files are extracted in the setup of the next run
+                run = self.make_run(Path(local_dir, "setup"))
+                for path in run.working_directory.rglob("*.txt"):
+                    path.unlink()
+                run.base_file_path = "dataset"
+                assert run.setup() == enums.RunResult.SUCCESS
+                assert (run.working_directory/"results/result.txt").read_text() == "results/result.txt"
+                assert not (run.working_directory/".crunch/packs").exists()
+                assert "results/result.txt" in run.setup_md5_checksums
+
+    @pytest.mark.django_db
+    def test_run_upload_unpacked_after_packed(self):
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            storage = FileSystemStorage(location=remote_dir, base_url="http://www.example.com")
+            with patch('crunch.django.app.storages.default_storage', storage):
+                run = self.make_run(Path(local_dir, "packed"), pack=True)
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                # a later run uploads a new version of the file by itself
+                run = self.make_run(Path(local_dir, "unpacked"))
+                (run.working_directory/"results/result.txt").write_text("new version")
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                run = self.make_run(Path(local_dir, "setup"))
+                for path in run.working_directory.rglob("*.txt"):
+                    path.unlink()
+                run.base_file_path = "dataset"
+                assert run.setup() == enums.RunResult.SUCCESS
+                assert (run.working_directory/"results/result.txt").read_text() == "new version"
+                assert (run.working_directory/"notes.txt").read_text() == "notes.txt"
+
+    @pytest.mark.django_db
+    def test_run_upload_chunked(self):
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            storage = FileSystemStorage(location=remote_dir, base_url="http://www.example.com")
+            with patch('crunch.django.app.storages.default_storage', storage):
+                run = self.make_run(Path(local_dir, "upload"), chunk=True, chunk_file_size=18)
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                # only the large files are split into chunks
+                assert storage.exists("dataset/notes.txt")
+                assert not storage.exists("dataset/results/result.txt")
+                indexed = dict(self.dataset.indexed_files.values_list("path", "shard"))
+                assert indexed["results/result.txt"].startswith(".crunch/chunks/")
+                assert indexed["notes.txt"] == ""
+
+                # the chunked files are rebuilt in the setup of the next run
+                run = self.make_run(Path(local_dir, "setup"))
+                for path in run.working_directory.rglob("*.txt"):
+                    path.unlink()
+                run.base_file_path = "dataset"
+                assert run.setup() == enums.RunResult.SUCCESS
+                assert (run.working_directory/"results/result.txt").read_text() == "results/result.txt"
+                assert not (run.working_directory/".crunch/chunks").exists()
+
+    @pytest.mark.django_db
+    def test_run_upload_deduplicated(self):
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            storage = FileSystemStorage(location=remote_dir, base_url="http://www.example.com")
+            with patch('crunch.django.app.storages.default_storage', storage):
+                run = self.make_run(Path(local_dir, "upload"), deduplicate=True)
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                assert not storage.exists("dataset/results/result.txt")
+                blob_directories, _ = storage.listdir(storages.blobs_path())
+                assert blob_directories
+                indexed = dict(self.dataset.indexed_files.values_list("path", "shard"))
+                assert indexed["results/result.txt"].startswith(".crunch/manifests/")
+
+                # the files are copied from the blobs in the setup of the next run
+                run = self.make_run(Path(local_dir, "setup"), lazy_download=True)
+                for path in run.working_directory.rglob("*.txt"):
+                    path.unlink()
+                run.base_file_path = "dataset"
+                assert run.setup() == enums.RunResult.SUCCESS
+                assert (run.working_directory/"results/result.txt").read_text() == "results/result.txt"
+                assert "results/result.txt" in run.setup_md5_checksums
+
+    @pytest.mark.django_db
+    def test_run_upload_unchunked_after_chunked(self):
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            storage = FileSystemStorage(location=remote_dir, base_url="http://www.example.com")
+            with patch('crunch.django.app.storages.default_storage', storage):
+                run = self.make_run(Path(local_dir, "chunked"), chunk=True, chunk_file_size=18)
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                # the file shrinks below the size for chunking so it is uploaded by itself
+                run = self.make_run(Path(local_dir, "shrunk"), chunk=True, chunk_file_size=18)
+                (run.working_directory/"results/result.txt").write_text("small")
+                run.base_file_path = "dataset"
+                assert run.upload() == enums.RunResult.SUCCESS
+
+                run = self.make_run(Path(local_dir, "setup"))
+                for path in run.working_directory.rglob("*.txt"):
+                    path.unlink()
+                run.base_file_path = "dataset"
+                assert run.setup() == enums.RunResult.SUCCESS
+                assert (run.working_directory/"results/result.txt").read_text() == "small"
+
+                # the tree of files on the site agrees with setup
+                root = storages.storage_walk("dataset", storage=storage)
+                assert {str(file.path()): file.shard for file in root.file_descendents()}["dataset/results/result.txt"] is None
+
+    @pytest.mark.django_db
+    def test_run_upload_outputs_only(self):
+        with tempfile.TemporaryDirectory() as local_dir:
+            run = self.make_run(local_dir, upload_outputs_only=True)
+            metadata = run.working_directory/".snakemake/metadata"
+            metadata.mkdir(parents=True)
+            (metadata/base64.urlsafe_b64encode(b"results/result.txt").decode()).write_text("{}")
+
+            assert self.uploaded(run) == {"results/result.txt", ".crunch/upload_md5_checksums.json", ".crunch/deleted.txt"}
+            assert set(run.upload_md5_checksums) == {"results/result.txt"}
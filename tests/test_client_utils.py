@@ -1,7 +1,9 @@
 import os 
+import base64
 import tempfile
 from unittest.mock import patch
 import subprocess
+from pathlib import Path
 
 from crunch.client import utils, enums
 
@@ -47,6 +49,26 @@ def test_write_workflow_snakemake():
         assert str(path.parent) == str(tmpdir)
 
 
+def test_write_shared_workflow():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = utils.write_shared_workflow("echo test\r\n", tmpdir, enums.WorkflowType.script)
+        assert path.name == "script.sh"
+        assert path.parent.parent == Path(tmpdir, "workflows")
+        assert path.read_text() == "echo test\n"
+        assert os.access(path, os.X_OK)
+        modified = path.stat().st_mtime_ns
+
+        # the same version of the workflow is not written again
+        assert utils.write_shared_workflow("echo test\n", tmpdir, enums.WorkflowType.script) == path
+        assert path.stat().st_mtime_ns == modified
+        assert len(list(path.parent.iterdir())) == 1
+
+        # a new version goes in a new location
+        new_path = utils.write_shared_workflow("echo changed", tmpdir, enums.WorkflowType.script)
+        assert new_path != path
+        assert new_path.read_text() == "echo changed"
+
+
 def test_md5_checksums():
     md5_checksums = utils.md5_checksums(TEST_DIR)
     assert md5_checksums == {
@@ -57,4 +79,35 @@ def test_md5_checksums():
         "dummy-files2/dummy-file3.txt":"e0fd2de670cc2b9e43b198a7ff5f952d",
         'dummy-workflow-fail': '8e7afad177af27fd5e93af0c199dc7c7',
         'dummy-workflow': 'e0f10798ad1df2b1032189ec5c7b62f6',
-    }
\ No newline at end of file
+    }
+
+def test_md5_checksums_include_exclude():
+    md5_checksums = utils.md5_checksums(TEST_DIR, include=["dummy-*", "*.toml"], exclude=["dummy-files2", "*-fail"])
+    assert md5_checksums == {
+        "settings.toml":"47bfe028dba88f4f04a72b9e60f0b54a",
+        "dummy-files/dummy-file1.txt":"d35cf79ba12e01ed0f9b850263c3692d",
+        "dummy-files/dummy-file2.txt":"3efe3d9bd803f9514e0eeb8033114efe",
+        'dummy-workflow': 'e0f10798ad1df2b1032189ec5c7b62f6',
+    }
+    assert utils.file_md5(TEST_DIR/"settings.toml") == "47bfe028dba88f4f04a72b9e60f0b54a"
+
+
+def test_snakemake_outputs(tmp_path):
+    metadata = tmp_path/".snakemake/metadata"
+    metadata.mkdir(parents=True)
+    long_name = "results/" + "/".join(["d" * 50] * 5) + "/b.txt"
+    for name in ["results/a.txt", "missing.txt", long_name]:
+        if name != "missing.txt":
+            path = tmp_path/name
+            path.parent.mkdir(exist_ok=True, parents=True)
+            path.write_text(name)
+        b64id = base64.urlsafe_b64encode(name.encode()).decode()
+        # Snakemake splits long names into subdirectories prefixed with '@'
+        parts = [b64id[i:i+254] for i in range(0, len(b64id), 254)]
+        record = metadata.joinpath(*["@" + part for part in parts[:-1]], parts[-1])
+        record.parent.mkdir(exist_ok=True, parents=True)
+        record.write_text("{}")
+    (metadata/"tmp_4x1.cmVzdWx0").write_text("{}")
+
+    assert utils.snakemake_outputs(tmp_path) == {"results/a.txt", long_name}
+    assert utils.snakemake_outputs(tmp_path/"no-workflow") == set()
@@ -0,0 +1,119 @@
+import gzip
+import pytest
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from rest_framework import status as drf_status
+from rest_framework.test import APITestCase
+
+from crunch.django.app import models, compression, renderers
+
+from .test_models import CrunchTestCase
+
+
+def compress(content, accept_encoding, content_type="application/json", min_size=100):
+    request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING=accept_encoding)
+    with override_settings(CRUNCH_COMPRESSION_MIN_SIZE=min_size):
+        middleware = compression.CompressionMiddleware(lambda request: HttpResponse(content, content_type=content_type))
+        return middleware(request)
+
+
+def test_gzip():
+    content = b'{"key": "value"}' * 100
+    response = compress(content, "gzip, deflate")
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    assert gzip.decompress(response.content) == content
+    assert int(response["Content-Length"]) == len(response.content)
+
+
+def test_brotli():
+    brotli = pytest.importorskip("brotli")
+    content = b'{"key": "value"}' * 100
+    response = compress(content, "gzip, deflate, br")
+    assert response["Content-Encoding"] == "br"
+    assert brotli.decompress(response.content) == content
+
+
+def test_below_threshold():
+    content = b'{"key": "value"}'
+    response = compress(content, "gzip")
+    assert not response.has_header("Content-Encoding")
+    assert response.content == content
+
+
+def test_not_accepted():
+    content = b'{"key": "value"}' * 100
+    response = compress(content, "")
+    assert not response.has_header("Content-Encoding")
+    assert "Accept-Encoding" in response["Vary"]
+
+
+def test_incompressible_type():
+    content = b"\x89PNG" * 100
+    response = compress(content, "gzip", content_type="image/png")
+    assert not response.has_header("Content-Encoding")
+
+
+@pytest.mark.parametrize("content_type", ["text/html; charset=utf-8", "text/plain"])
+def test_text_not_compressed(content_type):
+    content = b"<input name='csrfmiddlewaretoken' value='secret'>" * 100
+    response = compress(content, "gzip, br", content_type=content_type)
+    assert not response.has_header("Content-Encoding")
+    assert response.content == content
+
+
+def test_weak_etag():
+    request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+
+    def get_response(request):
+        response = HttpResponse(b"a" * 2000, content_type="application/json")
+        response["ETag"] = '"abc"'
+        return response
+
+    response = compression.CompressionMiddleware(get_response)(request)
+    assert response["ETag"] == 'W/"abc"'
+
+
+def test_streaming():
+    request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+    lines = [b'{"line": 1}\n', b'{"line": 2}\n']
+    middleware = compression.CompressionMiddleware(
+        lambda request: StreamingHttpResponse(iter(lines), content_type="application/x-ndjson")
+    )
+    response = middleware(request)
+    assert response["Content-Encoding"] == "gzip"
+    assert gzip.decompress(b"".join(response.streaming_content)) == b"".join(lines)
+
+
+class MessagePackTests(CrunchTestCase, APITestCase):
+    def setUp(self):
+        super().setUp()
+        if not renderers.msgpack_available():
+            pytest.skip("msgpack is not installed")
+        User = get_user_model()
+        self.user = User.objects.create_superuser(username="username", password="password-for-unit-testing")
+        self.client.login(username="username", password="password-for-unit-testing")
+        self.project = models.Project.objects.create(name="Test Project")
+        self.dataset = models.Dataset.objects.create(name="Test Dataset", parent=self.project)
+        models.LatLongAttribute.objects.create(item=self.dataset, key="location", latitude=50, longitude=20)
+
+    def test_render(self):
+        url = reverse('crunch:api:dataset-detail', kwargs={'slug': self.dataset.slug})
+        response = self.client.get(url, HTTP_ACCEPT=renderers.MSGPACK_MEDIA_TYPE)
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response["Content-Type"] == renderers.MSGPACK_MEDIA_TYPE
+        data = renderers.msgpack.unpackb(response.content, raw=False)
+        assert data["slug"] == self.dataset.slug
+        assert data["attributes"] == [{"key": "location", "latitude": 50.0, "longitude": 20.0}]
+
+        # JSON is still the default
+        response = self.client.get(url, HTTP_ACCEPT="application/json")
+        assert response.json()["slug"] == self.dataset.slug
+
+    def test_parse(self):
+        data = renderers.msgpack.packb(dict(parent=self.dataset.slug, name="New Item"))
+        response = self.client.post(reverse('crunch:api:item-list'), data, content_type=renderers.MSGPACK_MEDIA_TYPE)
+        self.assertEqual(response.status_code, drf_status.HTTP_201_CREATED)
+        assert models.Item.objects.filter(name="New Item", parent=self.dataset).exists()
@@ -0,0 +1,63 @@
+import json
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from rest_framework import status as drf_status
+from rest_framework.test import APITestCase
+
+from crunch.django.app import models, export
+
+from .test_models import CrunchTestCase
+
+
+class ExportTests(CrunchTestCase, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.project = models.Project.objects.create(name="Test Project")
+        self.dataset = models.Dataset.objects.create(name="Test Dataset", parent=self.project)
+        self.item = models.Item.objects.create(name="Test Item", parent=self.dataset)
+        self.other_project = models.Project.objects.create(name="Other Project")
+        models.Dataset.objects.create(name="Other Dataset", parent=self.other_project)
+        models.CharAttribute.objects.create(item=self.dataset, key="char", value="value")
+        models.FloatAttribute.objects.create(item=self.item, key="float", value=0.5)
+        models.LatLongAttribute.objects.create(item=self.item, key="location", latitude=50, longitude=20)
+
+    def test_attribute_value_fields(self):
+        assert export.attribute_value_fields(models.CharAttribute) == ["value"]
+        assert export.attribute_value_fields(models.LatLongAttribute) == ["latitude", "longitude"]
+        assert models.FilesizeAttribute in export.attribute_models()
+
+    def test_export_project(self):
+        # one query for the items and one for each type of attribute in each of the two chunks
+        with self.assertNumQueries(1 + 2 * len(export.attribute_models())):
+            results = list(export.export_project(self.project, chunk_size=2))
+
+        assert [result["slug"] for result in results] == [
+            "test-project", "test-project:test-dataset", "test-project:test-dataset:test-item"
+        ]
+        assert [result["type"] for result in results] == ["project", "dataset", "item"]
+        assert results[0]["parent"] is None
+        assert results[1]["parent"] == "test-project"
+        assert results[1]["base_file_path"] == "crunch/test-project"
+        assert "base_file_path" not in results[2]
+        assert results[1]["attributes"] == [dict(type="charattribute", key="char", value="value")]
+        assert dict(type="floatattribute", key="float", value=0.5) in results[2]["attributes"]
+        assert len(results[2]["attributes"]) == 2
+
+    def test_export_api(self):
+        User = get_user_model()
+        User.objects.create_superuser(username="username", password="password-for-unit-testing")
+        self.client.login(username="username", password="password-for-unit-testing")
+        response = self.client.get(reverse('crunch:project-api-export', kwargs={'slug': self.project.slug}))
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response["Content-Type"] == "application/x-ndjson"
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        assert len(lines) == 3
+        item = json.loads(lines[2])
+        assert {"type": "latlongattribute", "key": "location", "latitude": 50.0, "longitude": 20.0} in item["attributes"]
+
+    def test_export_api_missing(self):
+        User = get_user_model()
+        User.objects.create_superuser(username="username", password="password-for-unit-testing")
+        self.client.login(username="username", password="password-for-unit-testing")
+        response = self.client.get(reverse('crunch:project-api-export', kwargs={'slug': "missing"}))
+        self.assertEqual(response.status_code, drf_status.HTTP_404_NOT_FOUND)
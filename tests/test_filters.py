@@ -0,0 +1,60 @@
+import datetime
+import pytest
+
+from crunch.django.app import models
+from crunch.django.app.filters import parse_attribute_filter, AttributeFilterException
+
+
+def test_parse_attribute_filter_exact():
+    assert parse_attribute_filter("char:species", "Homo sapiens") == (
+        models.CharAttribute, "species", "value", "exact", "Homo sapiens",
+    )
+
+
+def test_parse_attribute_filter_lookup():
+    assert parse_attribute_filter("float:quality__gte", "0.9") == (
+        models.FloatAttribute, "quality", "value", "gte", 0.9,
+    )
+
+
+def test_parse_attribute_filter_in():
+    assert parse_attribute_filter("integer:count__in", "1,2,3") == (
+        models.IntegerAttribute, "count", "value", "in", [1, 2, 3],
+    )
+
+
+def test_parse_attribute_filter_key_with_underscores():
+    assert parse_attribute_filter("boolean:is__valid", "false") == (
+        models.BooleanAttribute, "is__valid", "value", "exact", False,
+    )
+
+
+def test_parse_attribute_filter_date():
+    assert parse_attribute_filter("date:collected__lt", "2022-03-01")[-1] == datetime.date(2022, 3, 1)
+
+
+def test_parse_attribute_filter_latlong():
+    model, key, field_name, lookup, value = parse_attribute_filter("latlong:site__latitude__lt", "-30.5")
+    assert model == models.LatLongAttribute
+    assert (key, field_name, lookup) == ("site", "latitude", "lt")
+    assert float(value) == -30.5
+
+
+def test_parse_attribute_filter_latlong_no_field():
+    with pytest.raises(AttributeFilterException, match="latitude, longitude"):
+        parse_attribute_filter("latlong:site__lt", "0")
+
+
+def test_parse_attribute_filter_unknown_type():
+    with pytest.raises(AttributeFilterException, match="Unknown attribute type"):
+        parse_attribute_filter("colour:key", "red")
+
+
+def test_parse_attribute_filter_no_key():
+    with pytest.raises(AttributeFilterException, match="No attribute key"):
+        parse_attribute_filter("float:", "1")
+
+
+def test_parse_attribute_filter_invalid_value():
+    with pytest.raises(AttributeFilterException, match="Invalid value"):
+        parse_attribute_filter("integer:count", "many")
@@ -0,0 +1,16 @@
+from crunch.django.app.geohash import encode_geohash
+
+
+def test_encode_geohash():
+    assert encode_geohash(57.64911, 10.40744, precision=11) == "u4pruydqqvj"
+    assert encode_geohash(-25.38262, -49.26561, precision=8) == "6gkzwgjz"
+
+
+def test_encode_geohash_prefix():
+    assert encode_geohash(48.8566, 2.3522).startswith(encode_geohash(48.8566, 2.3522, precision=5))
+    assert len(encode_geohash(0, 0)) == 12
+
+
+def test_encode_geohash_decimal():
+    from decimal import Decimal
+    assert encode_geohash(Decimal("57.64911"), Decimal("10.40744"), precision=5) == "u4pru"
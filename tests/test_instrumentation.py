@@ -0,0 +1,93 @@
+from django.test import override_settings
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from rest_framework import status as drf_status
+from rest_framework.test import APITestCase
+
+from crunch.django.app import models, instrumentation, serializers
+
+from .test_models import CrunchTestCase
+
+
+def test_histogram():
+    histogram = instrumentation.Histogram((1, 5, 10))
+    for value in [0.5, 1, 3, 7, 20]:
+        histogram.observe(value)
+
+    assert histogram.count == 5
+    assert histogram.sum == 31.5
+    assert histogram.cumulative_counts() == [("1", 2), ("5", 3), ("10", 4), ("+Inf", 5)]
+
+
+def test_server_timing():
+    metrics = instrumentation.RequestMetrics()
+    metrics.queries = 3
+    metrics.db_time = 0.002
+    metrics.serializer_time = 0.001
+    assert metrics.server_timing(0.01) == 'db;dur=2.00;desc="3 queries", serializer;dur=1.00, total;dur=10.00'
+
+
+def test_registry_render():
+    registry = instrumentation.MetricsRegistry()
+    metrics = instrumentation.RequestMetrics()
+    metrics.queries = 12
+    registry.observe("crunch:next", metrics, 0.03)
+    rendered = registry.render()
+    assert "# TYPE crunch_request_duration_seconds histogram" in rendered
+    assert 'crunch_request_duration_seconds_bucket{view="crunch:next",le="0.05"} 1' in rendered
+    assert 'crunch_db_queries_bucket{view="crunch:next",le="10"} 0' in rendered
+    assert 'crunch_db_queries_bucket{view="crunch:next",le="20"} 1' in rendered
+    assert 'crunch_db_queries_count{view="crunch:next"} 1' in rendered
+
+
+@override_settings(CRUNCH_INSTRUMENTATION=True)
+class InstrumentationTests(CrunchTestCase, APITestCase):
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        self.username = "username"
+        self.password = "password-for-unit-testing"
+        self.user = User.objects.create_superuser(username=self.username, password=self.password)
+        self.project = models.Project.objects.create(name="Test Project")
+        self.dataset = models.Dataset.objects.create(name="Test Dataset", parent=self.project)
+        instrumentation.registry.clear()
+
+    def test_server_timing_header(self):
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse('crunch:api:dataset-detail', kwargs={'slug': self.dataset.slug}))
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response["Server-Timing"].startswith("db;dur=")
+        assert "queries" in response["Server-Timing"]
+        assert "total;dur=" in response["Server-Timing"]
+
+    def test_metrics_endpoint(self):
+        self.client.login(username=self.username, password=self.password)
+        self.client.get(reverse('crunch:api:dataset-detail', kwargs={'slug': self.dataset.slug}))
+        response = self.client.get(reverse('crunch:metrics'))
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response["Content-Type"].startswith("text/plain")
+        content = response.content.decode()
+        assert 'crunch_request_duration_seconds_count{view="crunch:api:dataset-detail"} 1' in content
+        assert 'crunch_serializer_duration_seconds_count{view="crunch:api:dataset-detail"} 1' in content
+
+    def test_metrics_endpoint_requires_staff(self):
+        response = self.client.get(reverse('crunch:metrics'))
+        assert response.status_code in [drf_status.HTTP_401_UNAUTHORIZED, drf_status.HTTP_403_FORBIDDEN]
+
+    def test_serializer_time(self):
+        metrics = instrumentation.RequestMetrics()
+        token = instrumentation._current_metrics.set(metrics)
+        try:
+            data = serializers.DatasetSerializer(self.dataset).data
+        finally:
+            instrumentation._current_metrics.reset(token)
+        assert data["slug"] == self.dataset.slug
+        assert metrics.serializer_time > 0.0
+        assert metrics.serializer_depth == 0
+
+
+class InstrumentationDisabledTests(CrunchTestCase, APITestCase):
+    def test_no_server_timing_header(self):
+        project = models.Project.objects.create(name="Test Project")
+        response = self.client.get(reverse('crunch:api:project-detail', kwargs={'slug': project.slug}))
+        assert not response.has_header("Server-Timing")
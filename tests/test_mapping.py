@@ -1,4 +1,12 @@
+import io
+from unittest.mock import patch
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+
 from crunch.django.app import models, enums, mapping
+from crunch.django.app.geohash import encode_geohash
 from .test_models import CrunchTestCase
 
 
@@ -20,3 +28,196 @@ class MappingTests(CrunchTestCase):
             '"Test Item", "latitude": 50.0, "longitude": 20.0, "url": "/items/test-item/"'
             in html
         )
+
+    def test_map_empty(self):
+        assert mapping.item_map(models.Item.objects.create(name="No Locations")) is None
+
+
+class MappingTreeTests(CrunchTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.project = models.Project.objects.create(name="Test Project")
+        self.dataset = models.Dataset.objects.create(name="Test Dataset", parent=self.project)
+        self.item = models.Item.objects.create(name="Test Item", parent=self.dataset)
+        models.LatLongAttribute.objects.create(item=self.dataset, key="site", latitude=-37.8, longitude=145.0)
+        models.LatLongAttribute.objects.create(item=self.item, key="site", latitude=50, longitude=20)
+
+    def test_item_locations_single_query(self):
+        ContentType.objects.get_for_models(models.Project, models.Dataset)
+        with self.assertNumQueries(1):
+            df = mapping.item_locations(self.project)
+        assert df.to_dict("records") == [
+            dict(latitude=-37.8, longitude=145.0, item="Test Dataset", url=self.dataset.get_absolute_url()),
+            dict(latitude=50.0, longitude=20.0, item="Test Item", url=self.item.get_absolute_url()),
+        ]
+
+    def test_item_geojson(self):
+        geojson = mapping.item_geojson(self.dataset)
+        assert geojson["type"] == "FeatureCollection"
+        assert geojson["features"][1] == dict(
+            type="Feature",
+            geometry=dict(type="Point", coordinates=[20.0, 50.0]),
+            properties=dict(item="Test Item", url="/items/test-project:test-dataset:test-item/"),
+        )
+        assert len(mapping.item_geojson(self.item)["features"]) == 1
+
+    def test_item_map_html_cached(self):
+        html = mapping.item_map_html(self.project)
+        assert "Test Item" in html
+        with self.assertNumQueries(0):
+            assert mapping.item_map_html(self.project) == html
+
+    def test_item_map_html_invalidated(self):
+        project_html = mapping.item_map_html(self.project)
+        mapping.item_map_html(self.item)
+
+        other = models.Project.objects.create(name="Other Project")
+        other_html = mapping.item_map_html(other)
+
+        attribute = models.LatLongAttribute.objects.create(item=self.item, key="second", latitude=10, longitude=10)
+        assert cache.get(mapping.map_cache_key(self.project.pk)) is None
+        assert cache.get(mapping.map_cache_key(self.item.pk)) is None
+        assert cache.get(mapping.map_cache_key(other.pk)) == other_html
+        assert mapping.item_map_html(self.project) != project_html
+
+        # moving a location invalidates the maps of the old and new items
+        mapping.item_map_html(self.item)
+        attribute.item = other
+        attribute.save()
+        assert cache.get(mapping.map_cache_key(self.item.pk)) is None
+        assert cache.get(mapping.map_cache_key(other.pk)) is None
+
+        mapping.item_map_html(other)
+        attribute.delete()
+        assert cache.get(mapping.map_cache_key(other.pk)) is None
+
+    def test_item_map_html_invalidated_by_rename(self):
+        mapping.item_map_html(self.project)
+        self.item.name = "Renamed Item"
+        self.item.save()
+        assert "Renamed Item" in mapping.item_map_html(self.project)
+
+    def test_item_map_html_invalidated_by_reslugify(self):
+        mapping.item_map_html(self.project)
+        mapping.item_map_html(self.item)
+        other = models.Project.objects.create(name="Other Project")
+        other_html = mapping.item_map_html(other)
+
+        models.Item.objects.filter(pk=self.project.pk).update(name="Renamed Project")
+        models.Item.objects.get(pk=self.project.pk).reslugify_descendants()
+        assert cache.get(mapping.map_cache_key(self.project.pk)) is None
+        assert cache.get(mapping.map_cache_key(self.item.pk)) is None
+        assert cache.get(mapping.map_cache_key(other.pk)) == other_html
+        assert "/items/renamed-project:test-dataset:test-item/" in mapping.item_map_html(self.project)
+
+    def test_item_map_html_invalidated_by_move_to(self):
+        other = models.Project.objects.create(name="Other Project")
+        mapping.item_map_html(self.project)
+        mapping.item_map_html(self.dataset)
+        mapping.item_map_html(other)
+
+        item = models.Item.objects.get(pk=self.item.pk)
+        item.move_to(other)
+        assert cache.get(mapping.map_cache_key(self.project.pk)) is None
+        assert cache.get(mapping.map_cache_key(self.dataset.pk)) is None
+        assert cache.get(mapping.map_cache_key(other.pk)) is None
+        assert "Test Item" not in mapping.item_map_html(self.project)
+        other.refresh_from_db()
+        assert "Test Item" in mapping.item_map_html(other)
+
+    def test_item_post_save_only_for_items(self):
+        with patch.object(mapping, "invalidate_item_maps") as invalidate:
+            models.CharAttribute.objects.create(item=self.dataset, key="description", value="text")
+            models.DatasetFile.objects.create(dataset=self.dataset, path="file.txt")
+            invalidate.assert_not_called()
+            models.Dataset.objects.create(name="Second Dataset", parent=self.project)
+            invalidate.assert_called_once()
+
+
+class ViewportTests(CrunchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.project = models.Project.objects.create(name="Test Project")
+        self.dataset = models.Dataset.objects.create(name="Test Dataset", parent=self.project)
+        # three locations around Melbourne and two in Europe
+        for latitude, longitude in [(-37.81, 144.96), (-37.82, 144.97), (-37.80, 144.95), (48.85, 2.35), (52.52, 13.40)]:
+            models.LatLongAttribute.objects.create(item=self.dataset, key="site", latitude=latitude, longitude=longitude)
+
+    def test_geohash_saved(self):
+        attribute = models.LatLongAttribute.objects.get(latitude=48.85)
+        assert attribute.geohash == encode_geohash(48.85, 2.35)
+        attribute.latitude = 52.52
+        attribute.longitude = 13.40
+        attribute.save()
+        assert models.LatLongAttribute.objects.get(pk=attribute.pk).geohash.startswith("u33")
+
+    def test_rebuild_geohashes(self):
+        # a location written without its geohash (e.g. loaded outside of the ORM) and a location moved with a queryset update
+        missing = models.LatLongAttribute.objects.get(latitude=-37.81)
+        models.LatLongAttribute.objects.filter(pk=missing.pk).update(geohash="")
+        moved = models.LatLongAttribute.objects.get(latitude=48.85)
+        models.LatLongAttribute.objects.filter(pk=moved.pk).update(latitude=52.52, longitude=13.40)
+        cache.set(mapping.map_cache_key(self.project.pk), "stale")
+
+        out = io.StringIO()
+        call_command("rebuild-geohashes", stdout=out)
+        assert "Rebuilt geohashes for 2 locations." in out.getvalue()
+        assert models.LatLongAttribute.objects.get(pk=missing.pk).geohash == encode_geohash(-37.81, 144.96)
+        assert models.LatLongAttribute.objects.get(pk=moved.pk).geohash.startswith("u33")
+        assert cache.get(mapping.map_cache_key(self.project.pk)) is None
+        assert mapping.rebuild_geohashes() == 0
+
+    def test_extent_zoom(self):
+        locations = mapping.item_locations(self.project)
+        assert mapping.extent_zoom(locations) == 1
+        # Paris and Berlin
+        assert mapping.extent_zoom(locations.iloc[3:]) == 5
+        assert mapping.extent_zoom(locations.iloc[:1]) == mapping.MAX_INITIAL_ZOOM
+
+    def test_parse_bbox(self):
+        assert mapping.parse_bbox("140,-40,150.5,-30") == (140, -40, 150.5, -30)
+        with pytest.raises(mapping.MapException, match="four numbers"):
+            mapping.parse_bbox("140,-40,150")
+        with pytest.raises(mapping.MapException, match="outside the range"):
+            mapping.parse_bbox("140,-30,150,-40")
+
+    def test_zoom_precision(self):
+        assert mapping.zoom_precision(-1) == 1
+        assert mapping.zoom_precision(0) == 1
+        assert mapping.zoom_precision(10) == 5
+        assert mapping.zoom_precision(100) == mapping.ZOOM_PRECISIONS[-1]
+
+    def test_viewport_points(self):
+        geojson = mapping.viewport_geojson(self.project, bbox=(140, -40, 150, -30), zoom=5)
+        assert len(geojson["features"]) == 3
+        assert geojson["features"][0]["properties"]["item"] == "Test Dataset"
+
+    def test_viewport_antimeridian(self):
+        geojson = mapping.viewport_geojson(self.project, bbox=(170, -90, 20, 90), zoom=1)
+        assert sorted(feature["geometry"]["coordinates"][0] for feature in geojson["features"]) == [2.35, 13.40]
+
+    def test_viewport_clusters(self):
+        geojson = mapping.viewport_geojson(self.project, zoom=1, max_points=2)
+        clusters = {feature["properties"]["geohash"]: feature for feature in geojson["features"]}
+        assert set(clusters) == {"r", "u"}
+        assert clusters["r"]["properties"] == dict(cluster=True, count=3, geohash="r")
+        longitude, latitude = clusters["r"]["geometry"]["coordinates"]
+        assert round(latitude, 2) == -37.81
+        assert round(longitude, 2) == 144.96
+
+        # zooming in splits clusters and at the highest zoom levels the locations are never clustered
+        geojson = mapping.viewport_geojson(self.project, zoom=8, max_points=2)
+        assert sum(feature["properties"]["count"] for feature in geojson["features"]) == 5
+        assert len(geojson["features"]) > 2
+        geojson = mapping.viewport_geojson(self.project, zoom=mapping.RAW_ZOOM, max_points=2)
+        assert len(geojson["features"]) == 5
+        assert "cluster" not in geojson["features"][0]["properties"]
+
+    def test_item_map_clusters(self):
+        with patch.object(mapping, "MAP_POINT_LIMIT", 2):
+            html = mapping.item_map(self.project).to_html(as_string=True)
+        assert "ScatterplotLayer" in html
+        assert '"count": 3' in html
+        # the clusters are spread around the world so the map starts zoomed out
+        assert '"zoom": 1' in html
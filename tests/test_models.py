@@ -1,5 +1,6 @@
 import pytest 
 from unittest.mock import patch
+from pathlib import Path
 from django.test import TestCase
 
 from crunch.django.app import models, enums
@@ -176,11 +177,27 @@ class DatasetTests(CrunchTestCase):
             self.dataset.base_file_path = TEST_DIR
             self.dataset.save()
 
+            # the files are read from the index which is empty until it is refreshed
+            assert list(self.dataset.files().file_descendents()) == []
+            assert self.dataset.files_html() == "<p>No files have been indexed for this dataset.</p>"
+            assert self.dataset.refresh_file_index(checksums=True) == 7
+
             root_dir = self.dataset.files()
             assert isinstance(root_dir, storages.StorageDirectory)
             files = list(root_dir.file_descendents())
             expected = ['dummy-file1.txt', 'dummy-file2.txt', 'dummy-file3.txt', 'dummy-workflow-fail', 'settings.json', 'dummy-workflow', 'settings.toml']
             assert set([x.short_str() for x in files]) == set(expected)
+            assert "http://www.example.com" in self.dataset.files_html()
+
+            indexed_file = self.dataset.indexed_files.get(path="dummy-files/dummy-file1.txt")
+            assert indexed_file.md5 == "d35cf79ba12e01ed0f9b850263c3692d"
+            assert indexed_file.size == Path(TEST_DIR, "dummy-files/dummy-file1.txt").stat().st_size
+            assert indexed_file.last_modified is not None
+
+    def test_dataset_index_files(self):
+        assert self.dataset.index_files([dict(path="a.txt", size=1), dict(path="b/c.txt", size=2, md5="abc")]) == 2
+        assert self.dataset.index_files([dict(path="a.txt", size=10)]) == 1
+        assert list(self.dataset.indexed_files.values_list("path", "size", "md5")) == [("a.txt", 10, ""), ("b/c.txt", 2, "abc")]
 
 
 class StatusTests(CrunchTestCase):
@@ -365,5 +382,151 @@ class ItemTests(CrunchTestCase):
         assert self.root.prev_in_order() == None
         assert self.root.prev_in_order(loop=True) == self.child3
 
+    def test_neighbours(self):
+        with self.assertNumQueries(2):
+            neighbours = self.child1.neighbours
+            assert self.child1.neighbours is neighbours
+        assert neighbours == (self.root, self.grandchild)
+        assert neighbours.prev == self.child1.prev_in_order()
+        assert neighbours.next == self.child1.next_in_order()
+
+        assert self.root.neighbours == (None, self.child1)
+        assert self.grandchild.neighbours == (self.child1, self.child2)
+        # refresh to get the position in the tree after the grandchild was added
+        self.child3.refresh_from_db()
+        assert self.child3.neighbours == (self.child2, None)
+
+    def test_neighbours_polymorphic(self):
+        project1 = models.Project.objects.create(name="Project 1")
+        project2 = models.Project.objects.create(name="Project 2")
+        project3 = models.Project.objects.create(name="Project 3")
+        neighbours = project2.neighbours
+        assert neighbours == (project1, project3)
+        assert isinstance(neighbours.prev, models.Project)
+
         
 
+
+    def test_filesize_rollups_update_and_delete(self):
+        attribute = models.FilesizeAttribute.objects.create(item=self.grandchild, key="filesize", value=1_000)
+        models.FilesizeAttribute.objects.create(item=self.child2, key="filesize", value=500)
+        assert self.root.descendant_total_filesize() == 1_500
+        assert self.child1.descendant_total_filesize() == 1_000
+
+        attribute.value = 3_000
+        attribute.save()
+        assert self.root.descendant_total_filesize() == 3_500
+        assert self.child1.descendant_total_filesize() == 3_000
+        assert self.grandchild.filesize_rollup.count == 1
+
+        attribute.item = self.child3
+        attribute.save()
+        assert self.root.descendant_total_filesize() == 3_500
+        assert self.child1.descendant_total_filesize() == None
+        assert self.child3.descendant_total_filesize() == 3_000
+
+        attribute.delete()
+        assert self.root.descendant_total_filesize() == 500
+        assert self.child3.descendant_total_filesize() == None
+
+    def test_filesize_rollups_move(self):
+        models.FilesizeAttribute.objects.create(item=self.grandchild, key="filesize", value=1_000)
+        other_root = models.Item.objects.create(name="other root")
+        assert self.child1.descendant_total_filesize() == 1_000
+
+        grandchild = models.Item.objects.get(pk=self.grandchild.pk)
+        grandchild.parent = other_root
+        grandchild.save()
+
+        assert self.child1.descendant_total_filesize() == None
+        assert self.root.descendant_total_filesize() == None
+        assert other_root.descendant_total_filesize() == 1_000
+
+    def test_filesize_rollups_move_to(self):
+        models.FilesizeAttribute.objects.create(item=self.grandchild, key="filesize", value=100)
+        other_root = models.Item.objects.create(name="other root")
+
+        grandchild = models.Item.objects.get(pk=self.grandchild.pk)
+        grandchild.move_to(other_root)
+
+        assert self.child1.descendant_total_filesize() == None
+        assert self.root.descendant_total_filesize() == None
+        assert other_root.descendant_total_filesize() == 100
+        assert grandchild.descendant_total_filesize() == 100
+
+        grandchild.move_to(self.child2)
+        assert other_root.descendant_total_filesize() == None
+        assert self.child2.descendant_total_filesize() == 100
+        assert self.root.descendant_total_filesize() == 100
+
+    def test_filesize_rollups_delete_subtree(self):
+        models.FilesizeAttribute.objects.create(item=self.grandchild, key="filesize", value=100)
+        models.FilesizeAttribute.objects.create(item=self.child2, key="filesize", value=50)
+
+        models.FilesizeAttribute.objects.create(item=self.child1, key="filesize", value=10)
+        project = models.Project.objects.create(name="project", parent=self.child2)
+        models.FilesizeAttribute.objects.create(item=project, key="filesize", value=1)
+        assert self.root.descendant_total_filesize() == 161
+
+        models.Item.objects.get(pk=self.child1.pk).delete()
+        assert self.root.descendant_total_filesize() == 51
+        assert models.FilesizeRollup.objects.get(item=self.root).count == 2
+
+        project.delete()
+        assert self.root.descendant_total_filesize() == 50
+        assert self.child2.descendant_total_filesize() == 50
+        assert models.FilesizeRollup.objects.get(item=self.root).count == 1
+
+    def test_rebuild_filesize_rollups(self):
+        from crunch.django.app import rollups
+
+        models.FilesizeAttribute.objects.create(item=self.root, key="filesize", value=2_000_000)
+        models.FilesizeAttribute.objects.create(item=self.grandchild, key="filesize", value=500_000)
+        models.FilesizeAttribute.objects.create(item=self.child2, key="filesize", value=5_000_000)
+        models.FilesizeRollup.objects.all().update(total=0, count=0)
+
+        assert rollups.rebuild_filesize_rollups() == 4
+        assert self.root.descendant_total_filesize() == 7_500_000
+        assert self.child1.descendant_total_filesize() == 500_000
+        assert self.child3.descendant_total_filesize() == None
+        assert models.FilesizeRollup.objects.get(item=self.root).count == 3
+
+    def test_reslugify_descendants_bulk(self):
+        project = models.Project.objects.create(name="Old Project")
+        dataset = models.Dataset.objects.create(name="Dataset", parent=project)
+        item = models.Item.objects.create(name="Item", parent=dataset)
+        assert dataset.slug == "old-project:dataset"
+        assert str(dataset.base_file_path) == "crunch/old-project"
+        custom = models.Dataset.objects.create(name="Custom", parent=project, base_file_path="custom/path")
+
+        models.Item.objects.filter(pk=project.pk).update(name="New Project")
+        project = models.Project.objects.get(pk=project.pk)
+        with self.assertNumQueries(9):
+            assert project.reslugify_descendants() == 4
+
+        assert models.Item.objects.get(pk=dataset.pk).slug == "new-project:dataset"
+        assert models.Item.objects.get(pk=item.pk).slug == "new-project:dataset:item"
+        assert str(models.Dataset.objects.get(pk=dataset.pk).base_file_path) == "crunch/new-project"
+        assert str(models.Dataset.objects.get(pk=custom.pk).base_file_path) == "custom/path"
+        assert project.reslugify_descendants() == 0
+
+    def test_reslugify_descendants_unique(self):
+        other = models.Item.objects.create(name="other")
+        models.Item.objects.filter(pk=other.pk).update(slug="root:child1-clash")
+        self.child1.name = "child1 clash"
+        self.child1.save()
+        self.root.reslugify_descendants()
+        assert models.Item.objects.get(pk=self.child1.pk).slug == "root:child1-clash-2"
+        assert models.Item.objects.get(pk=self.grandchild.pk).slug == "root:child1-clash-2:grandchild"
+
+    def test_reslugify_descendants_suffixed_clash(self):
+        models.Project.objects.create(name="alpha")
+        models.Project.objects.create(name="alpha 2")
+        beta = models.Project.objects.create(name="beta")
+        dataset = models.Dataset.objects.create(name="dataset", parent=beta)
+        models.Item.objects.filter(pk=beta.pk).update(name="Alpha")
+
+        beta = models.Project.objects.get(pk=beta.pk)
+        assert beta.reslugify_descendants() == 2
+        assert models.Item.objects.get(pk=beta.pk).slug == "alpha-3"
+        assert models.Item.objects.get(pk=dataset.pk).slug == "alpha-3:dataset"
@@ -0,0 +1,211 @@
+import io
+import json
+import os
+import tarfile
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+import pytest
+from django.core.files.storage import FileSystemStorage
+
+from crunch.django.app import models, packing, storages
+from .test_models import CrunchTestCase
+from .test_storages import MockS3Object
+
+
+def make_files(directory: Path, files: dict) -> list:
+    paths = []
+    for name, content in files.items():
+        path = directory/name
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.write_bytes(content)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def local_files(tmp_path):
+    local_dir = tmp_path/"local"
+    paths = make_files(local_dir, {
+        "a.txt": b"a" * 10,
+        "results/b.txt": b"b" * 20,
+        "results/deep/c.txt": b"c" * 30,
+        "large.bin": b"x" * 2000,
+    })
+    return local_dir, paths
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return FileSystemStorage(location=tmp_path/"remote", base_url="http://www.example.com/")
+
+
+def test_pack_to_storage(local_files, storage):
+    local_dir, paths = local_files
+    shards = packing.pack_to_storage(paths, local_dir, base="dataset", storage=storage, small_file_size=1000, shard_size=25)
+
+    # the large file is stored by itself and the small files are split into archives of about the shard size
+    assert storage.exists("dataset/large.bin")
+    assert set(shards) == {"a.txt", "results/b.txt", "results/deep/c.txt"}
+    assert shards["a.txt"] == shards["results/b.txt"]
+    assert shards["a.txt"] != shards["results/deep/c.txt"]
+    assert shards["a.txt"].startswith(".crunch/packs/") and shards["a.txt"].endswith("-00000.tar")
+
+    packed = storages.packed_files("dataset", storage=storage)
+    assert packed["results/b.txt"] == dict(path="results/b.txt", size=20, md5="", shard=shards["results/b.txt"], index=packed["results/b.txt"]["index"])
+    assert packed["results/b.txt"]["index"].startswith(".crunch/packs/") and packed["results/b.txt"]["index"].endswith(".json")
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_unpack_from_storage(local_files, storage, tmp_path, compression):
+    local_dir, paths = local_files
+    packing.pack_to_storage(paths, local_dir, base="dataset", storage=storage, small_file_size=1000, compression=compression)
+
+    target = tmp_path/"target"
+    extracted = packing.unpack_from_storage("dataset", target, storage=storage, exclude=["results/deep"])
+    assert sorted(extracted) == ["a.txt", "results/b.txt"]
+    assert (target/"results/b.txt").read_bytes() == b"b" * 20
+    assert not (target/"results/deep").exists()
+    assert not (target/"large.bin").exists()
+
+
+def test_unpack_most_recent(local_files, storage, tmp_path):
+    local_dir, paths = local_files
+    packing.pack_to_storage(paths, local_dir, base="dataset", storage=storage, small_file_size=1000)
+    (local_dir/"a.txt").write_bytes(b"changed")
+    packing.pack_to_storage([local_dir/"a.txt"], local_dir, base="dataset", storage=storage, small_file_size=1000)
+
+    target = tmp_path/"target"
+    assert sorted(packing.unpack_from_storage("dataset", target, storage=storage)) == ["a.txt", "results/b.txt", "results/deep/c.txt"]
+    assert (target/"a.txt").read_bytes() == b"changed"
+
+
+def set_modified_time(storage, name, timestamp):
+    os.utime(storage.path(name), (timestamp, timestamp))
+
+
+@pytest.mark.parametrize("packed_last", [False, True])
+def test_file_moved_between_layouts(local_files, storage, tmp_path, packed_last):
+    local_dir, _ = local_files
+    (local_dir/"a.txt").write_text("old")
+    packing.pack_to_storage([local_dir/"a.txt"], local_dir, base="dataset", storage=storage)
+    (local_dir/"a.txt").write_text("new version")
+    storages.copy_to_storage([local_dir/"a.txt"], local_dir=local_dir, base="dataset", storage=storage)
+
+    # the index of the archive is written either before or after the file was uploaded by itself
+    index_name = storages.packed_files("dataset", storage=storage)["a.txt"]["index"]
+    set_modified_time(storage, f"dataset/{index_name}", 2000 if packed_last else 1000)
+    set_modified_time(storage, "dataset/a.txt", 1500)
+    expected = "old" if packed_last else "new version"
+
+    target = tmp_path/"target"
+    remaining = storages.copy_recursive_from_storage("dataset", target, storage=storage)
+    packing.unpack_from_storage("dataset", target, storage=storage, files=remaining)
+    assert (target/"a.txt").read_text() == expected
+    assert list(remaining) == (["a.txt"] if packed_last else [])
+
+    # the tree shows the same copy
+    root = storages.storage_walk("dataset", storage=storage)
+    shards = {file.filename: file.shard for file in root.file_descendents()}
+    assert bool(shards["a.txt"]) == packed_last
+
+
+class FlatListingStorage(FileSystemStorage):
+    """ A storage on the local filesystem which is listed like an object store (see `storages.object_store_names`). """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = self
+        self.objects = self
+
+    def filter(self, Prefix):
+        root = Path(self.location)
+        return [
+            MockS3Object(path.relative_to(root).as_posix())
+            for path in sorted(root.rglob("*"))
+            if path.is_file() and path.relative_to(root).as_posix().startswith(Prefix)
+        ]
+
+    def _normalize_name(self, name):
+        return name.strip("/")
+
+    def listdir(self, path):
+        raise AssertionError("Object stores should not be listed by directory")
+
+
+def test_layouts_object_store(local_files, tmp_path):
+    local_dir, _ = local_files
+    storage = FlatListingStorage(location=tmp_path/"remote", base_url="http://www.example.com/")
+    shards = packing.pack_to_storage(
+        [local_dir/"a.txt", local_dir/"results/b.txt"], local_dir, base="dataset", storage=storage, small_file_size=1000,
+    )
+    storages.copy_to_storage([local_dir/"large.bin"], local_dir=local_dir, base="dataset", storage=storage)
+
+    # the indexes are found in the flat listing and the archives are not shown as files
+    assert list(storages.iter_latest_files("dataset", storage=storage)) == [
+        ("large.bin", None),
+        ("a.txt", storages.packed_files("dataset", storage=storage)["a.txt"]),
+        ("results/b.txt", storages.packed_files("dataset", storage=storage)["results/b.txt"]),
+    ]
+    root = storages.storage_walk("dataset", storage=storage)
+    assert {str(file.path()): file.shard for file in root.file_descendents()} == {
+        "dataset/large.bin": None, "dataset/a.txt": shards["a.txt"], "dataset/results/b.txt": shards["results/b.txt"],
+    }
+
+
+def test_unpack_outside_directory(storage, tmp_path):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("../evil.txt")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"evil"))
+    storage.save("dataset/.crunch/packs/pack-00000.tar", buffer)
+    index = dict(shards=[dict(name="pack-00000.tar", files=[dict(path="../evil.txt", size=4, md5="")])])
+    storage.save("dataset/.crunch/packs/pack.json", io.BytesIO(json.dumps(index).encode()))
+
+    with pytest.raises(packing.PackingException, match="outside"):
+        packing.unpack_from_storage("dataset", tmp_path/"target", storage=storage)
+    assert not (tmp_path/"evil.txt").exists()
+
+
+def test_check_compression():
+    with pytest.raises(packing.PackingException, match="compression from"):
+        packing.check_compression("lzma")
+    with patch.object(packing, "zstandard", None):
+        with pytest.raises(packing.PackingException, match="zstandard"):
+            packing.check_compression("zstd")
+
+
+def test_storage_walk_logical_tree(local_files, storage):
+    local_dir, paths = local_files
+    make_files(local_dir, {".crunch/deleted.txt": b""})
+    packing.pack_to_storage(paths, local_dir, base="dataset", storage=storage, small_file_size=1000)
+    storages.copy_to_storage([local_dir/".crunch/deleted.txt"], local_dir=local_dir, base="dataset", storage=storage)
+
+    root = storages.storage_walk("dataset", storage=storage)
+    files = {str(file.path()): file.shard for file in root.file_descendents()}
+    assert set(files) == {"dataset/a.txt", "dataset/results/b.txt", "dataset/results/deep/c.txt", "dataset/large.bin", "dataset/.crunch/deleted.txt"}
+    assert files["dataset/large.bin"] is None
+    assert files["dataset/a.txt"].startswith(".crunch/packs/")
+
+    html = root.render_html()
+    assert "<a href='http://www.example.com/dataset/large.bin'>large.bin</a>" in html
+    assert f"<span title='Packed in {files['dataset/a.txt']}'>a.txt</span>" in html
+
+
+class PackedDatasetTests(CrunchTestCase):
+    def test_refresh_file_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            storage = FileSystemStorage(location=tmpdir/"remote", base_url="http://www.example.com/")
+            local_dir = tmpdir/"local"
+            paths = make_files(local_dir, {"a.txt": b"a", "large.bin": b"x" * 2000})
+            project = models.Project.objects.create(name="project")
+            dataset = models.Dataset.objects.create(name="dataset", parent=project, base_file_path="dataset")
+            shards = packing.pack_to_storage(paths, local_dir, base="dataset", storage=storage, small_file_size=1000)
+
+            assert dataset.refresh_file_index(storage=storage) == 2
+            assert dict(dataset.indexed_files.values_list("path", "shard")) == {"a.txt": shards["a.txt"], "large.bin": ""}
+            with patch('crunch.django.app.storages.default_storage', storage):
+                html = dataset.files_html()
+            assert f"<span title='Packed in {shards['a.txt']}'>a.txt</span>" in html
+            assert "large.bin</a>" in html
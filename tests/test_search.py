@@ -0,0 +1,114 @@
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from crunch.django.app import models
+from crunch.django.app.search import SearchResults, search_terms, sqlite_query, postgresql_query
+
+from .test_models import CrunchTestCase
+
+
+def test_search_terms():
+    assert search_terms("Homo sapiens") == ["Homo", "sapiens"]
+    assert search_terms('"quoted" OR (brackets)* -minus') == ["quoted", "OR", "brackets", "minus"]
+    assert search_terms("") == []
+    assert search_terms(None) == []
+
+
+def test_sqlite_query():
+    assert sqlite_query(["homo", "sap"]) == '"homo" "sap"*'
+
+
+def test_postgresql_query():
+    assert postgresql_query(["homo", "sap"]) == "homo & sap:*"
+
+
+class SearchTests(CrunchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.project = models.Project.objects.create(name="Primates", description="Genomes of primates")
+        self.human = models.Dataset.objects.create(
+            name="Homo sapiens", parent=self.project, description="Human genome assembly",
+        )
+        self.chimp = models.Dataset.objects.create(
+            name="Pan troglodytes", parent=self.project, description="Chimpanzee genome", details="Closely related to *Homo sapiens*.",
+        )
+        self.rodents = models.Project.objects.create(name="Rodents")
+        self.mouse = models.Dataset.objects.create(name="Mus musculus", parent=self.rodents, description="Mouse genome")
+
+    def slugs(self, query):
+        return [item.slug for item in SearchResults(query)[:10]]
+
+    def test_search_ranked(self):
+        # a match in the name ranks above a match in the details
+        assert self.slugs("sapiens") == [self.human.slug, self.chimp.slug]
+
+    def test_search_all_terms(self):
+        assert self.slugs("chimpanzee genome") == [self.chimp.slug]
+        assert self.slugs("chimpanzee mouse") == []
+
+    def test_search_prefix(self):
+        assert self.slugs("primat") == [self.project.slug]
+
+    def test_search_stemmed(self):
+        assert self.slugs("genomes") == self.slugs("genome")
+        assert len(self.slugs("genomes")) == 4
+
+    def test_search_count(self):
+        results = SearchResults("genome")
+        assert results.count() == 4
+        assert len(results) == 4
+        assert len(results[1:3]) == 2
+        assert results[0].search_rank >= results[3].search_rank
+
+    def test_search_empty(self):
+        results = SearchResults("  ** ")
+        assert results.count() == 0
+        assert results[:10] == []
+
+    def test_search_index_current(self):
+        self.mouse.description = "House mouse"
+        self.mouse.save()
+        assert self.slugs("house") == [self.mouse.slug]
+        assert self.mouse.slug not in self.slugs("genome")
+
+        self.mouse.delete()
+        assert self.slugs("mouse") == []
+
+        models.Item.objects.filter(pk=self.chimp.pk).update(details="Bonobos are related")
+        assert self.slugs("bonobos") == [self.chimp.slug]
+
+
+class SearchViewTests(CrunchTestCase, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.username = "username"
+        self.password = "password-for-unit-testing"
+        get_user_model().objects.create_superuser(username=self.username, password=self.password)
+        self.project = models.Project.objects.create(name="Primates", description="Genomes of primates")
+        self.dataset = models.Dataset.objects.create(name="Homo sapiens", parent=self.project, description="Human genome")
+        self.client.login(username=self.username, password=self.password)
+
+    def test_search_api(self):
+        response = self.client.get(reverse("crunch:search-api"), {"q": "genome"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["count"] == 2
+        types = {result["slug"]: result["type"] for result in data["results"]}
+        assert types == {self.dataset.slug: "dataset", self.project.slug: "project"}
+        assert all(result["rank"] > 0 for result in data["results"])
+
+    def test_search_api_paginated(self):
+        first = self.client.get(reverse("crunch:search-api"), {"q": "genome", "page_size": 1}).json()
+        second = self.client.get(first["next"]).json()
+        assert second["count"] == 2
+        assert len(first["results"]) == len(second["results"]) == 1
+        assert first["results"][0]["slug"] != second["results"][0]["slug"]
+        assert second["next"] is None
+
+    def test_search_view(self):
+        response = self.client.get(reverse("crunch:search"), {"q": "sapiens"})
+        assert response.status_code == 200
+        assert response.context["query"] == "sapiens"
+        assert response.context["paginator"].count == 1
+        assert [item.slug for item in response.context["page_obj"]] == [self.dataset.slug]
@@ -3,6 +3,7 @@ import os
 from pathlib import Path
 import tempfile
 from unittest.mock import patch
+from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
 
 from crunch.django.app import storages
@@ -195,3 +196,241 @@ def test_copy_recursive_to_storage():
 
             assert_test_data(tmpdir)
 
+
+
+def test_storage_tree():
+    root = storages.storage_tree("base", ["b.txt", "dir/sub/c.txt", "a.txt", "dir/d.txt"])
+    assert [line.rstrip() for line in root.render().splitlines()] == [
+        "base",
+        "├── dir",
+        "│   ├── sub",
+        "│   │   └── c.txt",
+        "│   └── d.txt",
+        "├── a.txt",
+        "└── b.txt",
+    ]
+    assert [str(file.path()) for file in root.file_descendents()] == ["base/dir/sub/c.txt", "base/dir/d.txt", "base/a.txt", "base/b.txt"]
+
+
+def test_storage_md5():
+    storage = FileSystemStorage(location=TEST_DIR.absolute())
+    assert storages.storage_md5("dummy-files/dummy-file1.txt", storage=storage) == "d35cf79ba12e01ed0f9b850263c3692d"
+
+
+class MockS3Object():
+    def __init__(self, key):
+        self.key = key
+
+
+class MockS3Objects():
+    def __init__(self, keys):
+        self.keys = keys
+        self.prefixes = []
+
+    def filter(self, Prefix):
+        self.prefixes.append(Prefix)
+        return [MockS3Object(key) for key in self.keys if key.startswith(Prefix)]
+
+
+class MockS3Bucket():
+    def __init__(self, keys):
+        self.objects = MockS3Objects(keys)
+
+
+class MockS3Storage():
+    """ Imitates the parts of the S3 storage from django-storages which are used for flat listings. """
+    def __init__(self, keys, location="media"):
+        self.location = location
+        self.bucket = MockS3Bucket(keys)
+
+    def _normalize_name(self, name):
+        return f"{self.location}/{name}".rstrip("/")
+
+    def listdir(self, path):
+        raise AssertionError("Object stores should not be listed by directory")
+
+
+def test_storage_walk_object_store():
+    storage = MockS3Storage([
+        "media/crunch/project/dataset/a.txt",
+        "media/crunch/project/dataset/results/",
+        "media/crunch/project/dataset/results/b.txt",
+        "media/crunch/project/dataset/results/deeper/c.txt",
+        "media/crunch/project/dataset2/d.txt",
+    ])
+    root = storages.storage_walk("crunch/project/dataset", storage=storage)
+    assert storage.bucket.objects.prefixes == ["media/crunch/project/dataset/"]
+    assert [str(file.path()) for file in root.file_descendents()] == [
+        "crunch/project/dataset/results/deeper/c.txt",
+        "crunch/project/dataset/results/b.txt",
+        "crunch/project/dataset/a.txt",
+    ]
+    assert root.storage is storage
+
+
+def test_object_store_names_unsupported():
+    assert storages.object_store_names(FileSystemStorage(location=TEST_DIR.absolute()), ".") is None
+
+
+def test_storage_walk_parallel():
+    storage = FileSystemStorage(location=TEST_DIR.absolute())
+    serial = storages.storage_walk(".", storage=storage, max_workers=1)
+    parallel = storages.storage_walk(".", storage=storage, max_workers=4)
+    assert serial.render() == parallel.render()
+    assert len(list(parallel.file_descendents())) == 7
+
+
+def test_iter_storage_files():
+    storage = FileSystemStorage(location=TEST_DIR.absolute())
+    files = storages.iter_storage_files(".", storage=storage)
+    # the generator yields files before the whole storage has been listed
+    with patch.object(storage, "listdir", wraps=storage.listdir) as listdir:
+        first = next(files)
+        listed = listdir.call_count
+        entries = [first] + list(files)
+    assert listed < listdir.call_count
+    assert len(entries) == 7
+    assert sorted(entry.path for entry in entries) == sorted(
+        str(file.path()) for file in storages.storage_walk(".", storage=storage).file_descendents()
+    )
+
+
+def test_storage_entry_slots():
+    entry = storages.StorageEntry("crunch/dataset", "a.txt")
+    assert entry.path == "crunch/dataset/a.txt"
+    assert repr(entry) == "StorageEntry('crunch/dataset/a.txt')"
+    assert not hasattr(entry, "__dict__")
+    with pytest.raises(AttributeError):
+        entry.size = 1
+
+
+def test_iter_storage_files_object_store():
+    storage = MockS3Storage([
+        "media/crunch/project/dataset/a.txt",
+        "media/crunch/project/dataset/results/",
+        "media/crunch/project/dataset/results/b.txt",
+        "media/crunch/project/dataset2/d.txt",
+    ])
+    entries = list(storages.iter_storage_files("crunch/project/dataset", storage=storage))
+    assert entries == [
+        storages.StorageEntry("crunch/project/dataset", "a.txt"),
+        storages.StorageEntry("crunch/project/dataset/results", "b.txt"),
+    ]
+
+
+def test_copy_recursive_from_storage():
+    storage = FileSystemStorage(location=TEST_DIR.absolute())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storages.copy_recursive_from_storage(".", tmpdir, storage=storage)
+        copied = sorted(str(path.relative_to(tmpdir)) for path in Path(tmpdir).glob("**/*") if path.is_file())
+    assert copied == sorted(
+        str(file.path()) for file in storages.storage_walk(".", storage=storage).file_descendents()
+    )
+
+
+def test_storage_tree_depth():
+    root = storages.storage_tree("base", ["b.txt", "dir/sub/c.txt", "a.txt", "dir/d.txt", "other/deep/e.txt"], depth=1)
+    assert [line.rstrip() for line in root.render().splitlines()] == [
+        "base",
+        "├── dir",
+        "│   ├── sub",
+        "│   └── d.txt",
+        "├── other",
+        "│   └── deep",
+        "├── a.txt",
+        "└── b.txt",
+    ]
+    assert [str(directory) for directory in root.directory_descendents() if directory.collapsed] == ["base/dir/sub", "base/other/deep"]
+    assert "".join(root.iter_render()) == root.render()
+
+
+class CountingStorage(FileSystemStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.url_count = 0
+
+    def url(self, name):
+        self.url_count += 1
+        return super().url(name)
+
+
+def test_storage_urls_cached():
+    cache.clear()
+    storage = CountingStorage(location=TEST_DIR.absolute(), base_url="http://www.example.com/counting/")
+    urls = storages.storage_urls(["a.txt", "dir/b.txt"], storage=storage)
+    assert urls == {"a.txt": "http://www.example.com/counting/a.txt", "dir/b.txt": "http://www.example.com/counting/dir/b.txt"}
+    assert storage.url_count == 2
+
+    assert storages.storage_urls(["a.txt", "c.txt"], storage=storage)["a.txt"] == urls["a.txt"]
+    assert storage.url_count == 3
+
+    # the cache is not shared with storages at other URLs
+    other = FileSystemStorage(location=TEST_DIR.absolute(), base_url="http://www.example.org/")
+    assert storages.storage_urls(["a.txt"], storage=other) == {"a.txt": "http://www.example.org/a.txt"}
+
+
+def test_storage_url_cache_key():
+    def s3_storage(bucket_name, location):
+        storage = MockS3Storage([], location=location)
+        storage.bucket_name = bucket_name
+        return storage
+
+    key = storages.storage_url_cache_key(s3_storage("first-bucket", "media"), "a.txt")
+    assert key == storages.storage_url_cache_key(s3_storage("first-bucket", "media"), "a.txt")
+    assert key != storages.storage_url_cache_key(s3_storage("second-bucket", "media"), "a.txt")
+    assert key != storages.storage_url_cache_key(s3_storage("first-bucket", "static"), "a.txt")
+    assert key != storages.storage_url_cache_key(s3_storage("first-bucket", "media"), "b.txt")
+
+
+def test_render_html_collapsed():
+    cache.clear()
+    storage = CountingStorage(location=TEST_DIR.absolute(), base_url="http://www.example.com/")
+    root = storages.storage_tree("base", ["a.txt", "dir/<b>.txt", "dir/sub/c.txt"], storage=storage, depth=1)
+    html = root.render_html(expand_url=lambda directory: f"/files/?path={directory.short_str()}&depth=1")
+    assert "<a href='http://www.example.com/base/a.txt'>a.txt</a>" in html
+    assert "&lt;b&gt;.txt</a>" in html
+    assert "<details class='crunch-files' data-url='/files/?path=sub&amp;depth=1'>" in html
+    assert "c.txt" not in html
+    # only the URLs of the files which are shown are generated
+    assert storage.url_count == 2
+
+    assert "<details" not in root.render_html()
+
+
+def test_path_included():
+    assert storages.path_matches("results/sample/reads.bam", ["*.bam"])
+    assert storages.path_matches("raw/sample/reads.fastq", ["raw"])
+    assert not storages.path_matches("results/raw.txt", ["raw"])
+    assert storages.path_included("a.txt")
+    assert storages.path_included("inputs/a.txt", include=["inputs"])
+    assert not storages.path_included("outputs/a.txt", include=["inputs"])
+    assert not storages.path_included("inputs/a.log", include=["inputs"], exclude=["*.log"])
+
+
+def test_iter_storage_files_include_exclude():
+    storage = FileSystemStorage(location=TEST_DIR.absolute())
+    with patch.object(storage, "listdir", wraps=storage.listdir) as listdir:
+        entries = storages.iter_storage_files(".", storage=storage, include=["dummy-files*", "*.toml"], exclude=["dummy-files2"])
+        assert sorted(entry.path for entry in entries) == [
+            "dummy-files/dummy-file1.txt", "dummy-files/dummy-file2.txt", "settings.toml",
+        ]
+    # excluded directories are not listed
+    assert [call.args[0] for call in listdir.call_args_list] == [".", "dummy-files"]
+
+    storage = MockS3Storage([
+        "media/dataset/a.txt",
+        "media/dataset/raw/b.txt",
+        "media/dataset/results/c.csv",
+    ])
+    entries = list(storages.iter_storage_files("dataset", storage=storage, exclude=["raw"]))
+    assert [entry.path for entry in entries] == ["dataset/a.txt", "dataset/results/c.csv"]
+    entries = list(storages.iter_storage_files("dataset", storage=storage, include=["*.csv"]))
+    assert [entry.path for entry in entries] == ["dataset/results/c.csv"]
+
+
+def test_copy_recursive_from_storage_exclude():
+    storage = FileSystemStorage(location=TEST_DIR.absolute())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storages.copy_recursive_from_storage(".", tmpdir, storage=storage, exclude=["dummy-files*"])
+        copied = sorted(str(path.relative_to(tmpdir)) for path in Path(tmpdir).glob("**/*") if path.is_file())
+    assert copied == ["dummy-workflow", "dummy-workflow-fail", "settings.json", "settings.toml"]
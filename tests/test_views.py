@@ -1,9 +1,13 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status as drf_status
-from rest_framework.test import APITestCase
+from rest_framework import viewsets
+from rest_framework.test import APIRequestFactory, APITestCase, force_authenticate
 from crunch.django.app.models import Status
 from django.contrib.auth import get_user_model
-from crunch.django.app import models, enums
+from crunch.django.app import models, enums, serializers
+from crunch.django.app.conditional import ConditionalRetrieveMixin
 
 from .test_models import CrunchTestCase
 
@@ -84,6 +88,44 @@ class ViewsTests(CrunchTestCase, APITestCase):
         data = response.json()
         assert data == {'dataset': '', 'project': ''}
 
+    def test_item_geojson_api_view(self):
+        models.LatLongAttribute.objects.create(item=self.dataset1, latitude=50, longitude=20)
+        url = reverse('crunch:item-api-geojson', kwargs={'slug': self.project1.slug})
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response["Content-Type"] == "application/geo+json"
+        assert response.json() == {
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [20.0, 50.0]},
+                "properties": {"item": "Test Dataset 1", "url": "/projects/test-project-1/datasets/test-project-1:test-dataset-1"},
+            }],
+        }
+
+        response = self.client.get(reverse('crunch:item-api-geojson', kwargs={'slug': 'missing'}))
+        self.assertEqual(response.status_code, drf_status.HTTP_404_NOT_FOUND)
+
+    def test_item_locations_api_view(self):
+        models.LatLongAttribute.objects.create(item=self.dataset1, latitude=50, longitude=20)
+        models.LatLongAttribute.objects.create(item=self.dataset1, latitude=-37.8, longitude=145)
+        url = reverse('crunch:item-api-locations', kwargs={'slug': self.project1.slug})
+        self.client.login(username=self.username, password=self.password)
+
+        response = self.client.get(url, {'bbox': '0,0,40,60', 'zoom': 3})
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response["Content-Type"] == "application/geo+json"
+        features = response.json()["features"]
+        assert [feature["geometry"]["coordinates"] for feature in features] == [[20.0, 50.0]]
+
+        assert len(self.client.get(url).json()["features"]) == 2
+
+        response = self.client.get(url, {'bbox': 'everywhere'})
+        self.assertEqual(response.status_code, drf_status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'zoom': 'close'})
+        self.assertEqual(response.status_code, drf_status.HTTP_400_BAD_REQUEST)
+
     def test_item_map_view(self):
         url = reverse('crunch:item-map', kwargs={'slug': self.project1.slug})
         latitude = 50
@@ -131,6 +173,243 @@ class ViewsTests(CrunchTestCase, APITestCase):
             "base_file_path":"crunch/test-project-1"
             }
         
+    def test_item_api_cursor_pagination(self):
+        for index in range(5):
+            models.Item.objects.create(name=f"Item {index}", parent=self.dataset1)
+
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse('crunch:api:item-list'), {'page_size': 3})
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        data = response.json()
+        assert "count" not in data
+        assert data["previous"] is None
+        assert [result["name"] for result in data["results"]] == ["Test Project 1", "Test Project 2", "Test Dataset 1"]
+        assert "cursor=" in data["next"]
+
+        slugs = [result["slug"] for result in data["results"]]
+        while data["next"]:
+            data = self.client.get(data["next"]).json()
+            slugs += [result["slug"] for result in data["results"]]
+        assert slugs == list(models.Item.objects.order_by("created", "pk").values_list("slug", flat=True))
+
+    def test_status_api_cursor_pagination(self):
+        for stage in [enums.Stage.SETUP, enums.Stage.WORKFLOW, enums.Stage.UPLOAD]:
+            models.Status.objects.create(dataset=self.dataset1, stage=stage, state=enums.State.SUCCESS)
+
+        self.client.login(username=self.username, password=self.password)
+        data = self.client.get(reverse('crunch:status-list'), {'page_size': 2}).json()
+        assert [result["stage"] for result in data["results"]] == [enums.Stage.SETUP, enums.Stage.WORKFLOW]
+        data = self.client.get(data["next"]).json()
+        assert [result["stage"] for result in data["results"]] == [enums.Stage.UPLOAD]
+        assert data["next"] is None
+
+    def test_conditional_get_default_validators(self):
+        class ItemConditionalAPI(ConditionalRetrieveMixin, viewsets.ReadOnlyModelViewSet):
+            queryset = models.Item.objects.all()
+            serializer_class = serializers.ItemSerializer
+            lookup_field = 'slug'
+
+        def get(**headers):
+            url = reverse('crunch:api:item-detail', kwargs={'slug': self.dataset1.slug})
+            request = APIRequestFactory().get(url, **headers)
+            force_authenticate(request, user=self.user)
+            return ItemConditionalAPI.as_view({"get": "retrieve"})(request, slug=self.dataset1.slug)
+
+        response = get()
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        etag = response["ETag"]
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, drf_status.HTTP_304_NOT_MODIFIED)
+
+        self.dataset1.description = "changed"
+        self.dataset1.save()
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, drf_status.HTTP_200_OK)
+
+    def test_dataset_api_conditional_get(self):
+        url = reverse('crunch:api:dataset-detail', kwargs={'slug': self.dataset1.slug})
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        etag = response["ETag"]
+        assert etag.startswith('"')
+        assert "Last-Modified" in response
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, drf_status.HTTP_304_NOT_MODIFIED)
+        assert response.content == b""
+        assert response["ETag"] == etag
+
+        # Adding an attribute to an item in the dataset changes the response
+        item = models.Item.objects.create(name="Item", parent=self.dataset1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        etag = response["ETag"]
+        models.CharAttribute.objects.create(item=item, key="key", value="value")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response.json()["items"][0]["attributes"] == [{"key": "key", "value": "value"}]
+
+    def test_project_api_conditional_get(self):
+        url = reverse('crunch:api:project-detail', kwargs={'slug': self.project1.slug})
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(url)
+        etag = response["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, drf_status.HTTP_304_NOT_MODIFIED)
+
+        self.project1.workflow = "echo changed"
+        self.project1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response.json()["workflow"] == "echo changed"
+
+        response = self.client.get(reverse('crunch:api:project-detail', kwargs={'slug': "missing"}))
+        self.assertEqual(response.status_code, drf_status.HTTP_404_NOT_FOUND)
+
+    def test_dataset_api_sparse_fields(self):
+        item = models.Item.objects.create(name="Item", parent=self.dataset1)
+        models.CharAttribute.objects.create(item=item, key="key", value="value")
+        models.CharAttribute.objects.create(item=self.dataset1, key="dataset-key", value="value")
+        url = reverse('crunch:api:dataset-detail', kwargs={'slug': self.dataset1.slug})
+        self.client.login(username=self.username, password=self.password)
+
+        response = self.client.get(url, {'fields': 'id,slug,parent,base_file_path'})
+        self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+        assert response.json() == {
+            "id": self.dataset1.id,
+            "slug": "test-project-1:test-dataset-1",
+            "parent": "test-project-1",
+            "base_file_path": "crunch/test-project-1",
+        }
+
+        response = self.client.get(url, {'fields': 'slug,items.slug'})
+        assert response.json() == {
+            "slug": "test-project-1:test-dataset-1",
+            "items": [{"slug": "test-project-1:test-dataset-1:item"}],
+        }
+
+        # an empty expand leaves out all nested relations
+        data = self.client.get(url, {'expand': ''}).json()
+        assert "items" not in data
+        assert "attributes" not in data
+        assert data["description"] == "description1"
+
+        data = self.client.get(url, {'expand': 'items'}).json()
+        assert "attributes" not in data
+        assert data["items"][0]["slug"] == "test-project-1:test-dataset-1:item"
+        assert "attributes" not in data["items"][0]
+
+        data = self.client.get(url, {'expand': 'items.attributes'}).json()
+        assert data["items"][0]["attributes"] == [{"key": "key", "value": "value"}]
+
+    def test_dataset_api_sparse_fields_queries(self):
+        for index in range(3):
+            item = models.Item.objects.create(name=f"Item {index}", parent=self.dataset1)
+            models.CharAttribute.objects.create(item=item, key="key", value="value")
+        url = reverse('crunch:api:dataset-detail', kwargs={'slug': self.dataset1.slug})
+        self.client.login(username=self.username, password=self.password)
+
+        with CaptureQueriesContext(connection) as full:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as sparse:
+            self.client.get(url, {'fields': 'id,slug,parent,base_file_path'})
+
+        # the items and their attributes are neither prefetched nor used for the ETag
+        assert len(sparse.captured_queries) < len(full.captured_queries)
+        assert not any("crunch_charattribute" in query["sql"] for query in sparse.captured_queries)
+
+    def test_dataset_api_attribute_filters(self):
+        dataset3 = models.Dataset.objects.create(name="Test Dataset 3", parent=self.project1)
+        models.FloatAttribute.objects.create(item=self.dataset1, key="quality", value=0.95)
+        models.CharAttribute.objects.create(item=self.dataset1, key="species", value="Homo sapiens")
+        models.FloatAttribute.objects.create(item=self.dataset2, key="quality", value=0.99)
+        models.CharAttribute.objects.create(item=self.dataset2, key="species", value="Mus musculus")
+        models.FloatAttribute.objects.create(item=dataset3, key="quality", value=0.5)
+        models.CharAttribute.objects.create(item=dataset3, key="species", value="Homo sapiens")
+        url = reverse('crunch:api:dataset-list')
+        self.client.login(username=self.username, password=self.password)
+
+        def slugs(params):
+            response = self.client.get(url, {**params, 'fields': 'slug'})
+            self.assertEqual(response.status_code, drf_status.HTTP_200_OK)
+            return [result["slug"] for result in response.json()["results"]]
+
+        assert slugs({'float:quality__gt': '0.9'}) == ["test-project-1:test-dataset-1", "test-project-2:test-dataset-2"]
+        assert slugs({'float:quality__gt': '0.9', 'char:species': 'Homo sapiens'}) == ["test-project-1:test-dataset-1"]
+        assert slugs({'char:species': 'Homo sapiens', 'project': 'test-project-1'}) == [
+            "test-project-1:test-dataset-1", "test-project-1:test-dataset-3",
+        ]
+        assert slugs({'char:species__in': 'Mus musculus,Pan troglodytes'}) == ["test-project-2:test-dataset-2"]
+        # the key has to match as well as the value
+        assert slugs({'float:depth__gt': '0'}) == []
+
+    def test_dataset_api_attribute_filters_invalid(self):
+        url = reverse('crunch:api:dataset-list')
+        self.client.login(username=self.username, password=self.password)
+
+        response = self.client.get(url, {'colour:key': 'red'})
+        self.assertEqual(response.status_code, drf_status.HTTP_400_BAD_REQUEST)
+        assert "Unknown attribute type 'colour'" in response.json()["detail"]
+
+        response = self.client.get(url, {'float:quality__gt': 'high'})
+        self.assertEqual(response.status_code, drf_status.HTTP_400_BAD_REQUEST)
+        assert "Invalid value 'high'" in response.json()["detail"]
+
+    def test_dataset_files_api(self):
+        url = reverse('crunch:dataset-api-files', kwargs={'slug': self.dataset1.slug})
+        self.client.login(username=self.username, password=self.password)
+
+        files = [
+            {"path": "results/output.txt", "size": 12, "md5": "abc", "last_modified": "2022-03-01T00:00:00Z"},
+            {"path": "input.txt", "size": 3},
+        ]
+        response = self.client.post(url, files, format="json")
+        self.assertEqual(response.status_code, drf_status.HTTP_201_CREATED)
+        assert response.json() == {"indexed": 2}
+
+        response = self.client.post(url, {"path": "input.txt", "size": 4}, format="json")
+        self.assertEqual(response.status_code, drf_status.HTTP_201_CREATED)
+
+        results = self.client.get(url).json()["results"]
+        assert sorted((result["path"], result["size"]) for result in results) == [("input.txt", 4), ("results/output.txt", 12)]
+        assert self.client.get(reverse('crunch:dataset-api-files', kwargs={'slug': self.dataset2.slug})).json()["results"] == []
+
+        response = self.client.post(url, [{"size": 4}], format="json")
+        self.assertEqual(response.status_code, drf_status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('crunch:dataset-api-files', kwargs={'slug': 'missing'}), files, format="json")
+        self.assertEqual(response.status_code, drf_status.HTTP_404_NOT_FOUND)
+
+    def test_dataset_files_view(self):
+        self.dataset1.index_files([dict(path="a.txt"), dict(path="results/b.txt"), dict(path="results/deep/c.txt")])
+        self.client.login(username=self.username, password=self.password)
+
+        html = self.dataset1.files_html()
+        assert "a.txt</a>" in html
+        assert "c.txt" not in html
+        expand_url = self.dataset1.files_url("results/deep")
+        assert f"data-url='{expand_url}'" in html
+
+        response = self.client.get(expand_url)
+        self.assertEqual(response.status_code, 200)
+        assert response.streaming
+        html = b"".join(response.streaming_content).decode()
+        assert html.startswith(f"<div>{self.dataset1.base_file_path}/results/deep<br>")
+        assert "c.txt</a>" in html
+        assert "b.txt" not in html
+
+    def test_item_api_sparse_fields(self):
+        models.CharAttribute.objects.create(item=self.dataset1, key="key", value="value")
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse('crunch:api:item-list'), {'fields': 'slug'})
+        assert response.json()["results"][0] == {"slug": "test-project-1"}
+
+        response = self.client.get(reverse('crunch:api:item-detail', kwargs={'slug': self.dataset1.slug}), {'fields': 'slug,attributes'})
+        assert response.json() == {"slug": "test-project-1:test-dataset-1", "attributes": [{"key": "key", "value": "value"}]}
+
+    def test_project_api_sparse_fields(self):
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse('crunch:api:project-detail', kwargs={'slug': self.project1.slug}), {'fields': 'slug,workflow'})
+        assert response.json() == {"slug": "test-project-1", "workflow": ""}
+
     def test_project_detail_view(self):
         url = reverse('crunch:project-detail', kwargs={'slug': self.project1.slug})
         latitude = 50